@@ -0,0 +1,218 @@
+"""asyncioのイベントループを止めずにバックテストを実行する関数を提供する
+
+backtest_for_multiple_dataやwalkforwardは終わるまで戻らず、進捗もtqdmで標準エラーに出すだけなので、
+asyncioで動くサービスから呼ぶとイベントループが止まる。
+このモジュールの関数はプロセスプールで計算し、銘柄(ウォークフォワードでは銘柄×期間)ごとの
+結果をBacktestEventとして非同期イテレータで返す::
+
+    async for event in aio.backtest_for_multiple_data(data_name_tpl_lst, EmaCross):
+        print(f'{event.done}/{event.total}', event.name, len(event.trades))
+
+イテレータを途中で閉じる(acloseやcontextlib.aclosing)か、実行中のタスクをキャンセルすると、
+まだワーカーで始まっていない単位は取り消す。ワーカーで計算中の単位は終わるまで動く。
+"""
+
+from __future__ import annotations
+
+import os
+import asyncio
+import warnings
+import multiprocessing as mp
+from typing import TYPE_CHECKING, AsyncIterator, Callable, NamedTuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+from .backtest import _walkforward_windows, _walkforward_window
+from .utils import cut_not_closed_trades
+
+if TYPE_CHECKING:
+    from backtesting import Strategy
+
+# ワーカーのプロセスが受け持つ計算の単位 initializerで設定する
+_UNITS = None
+
+
+class BacktestEvent(NamedTuple):
+    """1つの単位の計算が終わるたびに返すイベント
+
+    Attributes:
+        name: 銘柄名
+        window: ウォークフォワードの期間の番号 古い期間から0, 1, 2... バックテストではNone
+        trades: トレード履歴 backtest_for_multiple_dataの結果と同じ形式
+        result: ウォークフォワードの期間の結果の概要 バックテストではNone
+        done: 終わった単位の数
+        total: すべての単位の数
+
+    """
+    name: str
+    window: int | None
+    trades: pd.DataFrame
+    result: dict | None
+    done: int
+    total: int
+
+
+async def backtest_for_multiple_data(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        strategy: Strategy,
+        backtest_config: dict | None = None,
+        max_workers: int | None = None,
+        max_in_flight: int | None = None,
+        ) -> AsyncIterator[BacktestEvent]:
+    """多数のデータを同じ戦略で計算し、銘柄ごとに結果を返す
+
+    Args:
+        data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+        strategy: 戦略クラス インスタンスではない
+        backtest_config: バックテストクラス用の設定
+        max_workers: ワーカーの数 省略するとCPU数
+        max_in_flight: 同時に投入しておく単位の数の上限 省略するとワーカーの数の2倍
+
+    Yields:
+        銘柄ごとのBacktestEvent 終わった順に返す
+
+    """
+    units = [(data, name, strategy, backtest_config or {}) for data, name in data_name_tpl_lst]
+    async for event in _run_units(_backtest_unit, units, max_workers, max_in_flight):
+        yield event
+
+
+async def walkforward(
+        df: pd.DataFrame,
+        MyStrategy: Strategy,
+        in_period: float,
+        out_period: float,
+        optimize_params: dict,
+        name: str = '',
+        max_workers: int | None = None,
+        ) -> AsyncIterator[BacktestEvent]:
+    """ウォークフォワードテストを行い、期間ごとに結果を返す
+
+    期間ごとに別のワーカーで計算し、ワーカーの中の最適化はマルチプロセスにしない。
+
+    Args:
+        df: 価格データ
+        MyStrategy: 戦略クラス
+        in_period: インサンプルの期間を年数で指定する
+        out_period: アウトサンプルの期間を年数で指定する
+        optimize_params: 最適化パラメータ 詳しくはbacktesting.py
+        name: イベントにつける銘柄名
+        max_workers: ワーカーの数 省略するとCPU数
+
+    Yields:
+        期間ごとのBacktestEvent 終わった順に返す
+
+    """
+    async for event in walkforward_for_multiple_data(
+            [(df, name)], MyStrategy, in_period, out_period, optimize_params, max_workers):
+        yield event
+
+
+async def walkforward_for_multiple_data(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        MyStrategy: Strategy,
+        in_period: float,
+        out_period: float,
+        optimize_params: dict,
+        max_workers: int | None = None,
+        max_in_flight: int | None = None,
+        ) -> AsyncIterator[BacktestEvent]:
+    """多数のデータでウォークフォワードテストを行い、銘柄×期間ごとに結果を返す
+
+    Args:
+        data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+        MyStrategy: 戦略クラス インスタンスではない
+        in_period: インサンプルの期間を年数で指定する
+        out_period: アウトサンプルの期間を年数で指定する
+        optimize_params: 最適化パラメータ 詳しくはbacktesting.py
+        max_workers: ワーカーの数 省略するとCPU数
+        max_in_flight: 同時に投入しておく単位の数の上限 省略するとワーカーの数の2倍
+
+    Yields:
+        銘柄×期間ごとのBacktestEvent 終わった順に返す
+
+    """
+    units = []
+    for data, name in data_name_tpl_lst:
+        windows = _walkforward_windows(data.index, in_period, out_period)[::-1]
+        for i, window in enumerate(windows):
+            sub = data[(window[0] <= data.index) & (data.index < window[2])]
+            units.append((sub, name, i, window, MyStrategy, optimize_params))
+    async for event in _run_units(_walkforward_unit, units, max_workers, max_in_flight):
+        yield event
+
+
+async def _run_units(
+        func: Callable[..., BacktestEvent],
+        units: list[tuple],
+        max_workers: int | None,
+        max_in_flight: int | None,
+        ) -> AsyncIterator[BacktestEvent]:
+    """単位の番号をワーカーに投入し、終わった順にイベントを返す"""
+    total = len(units)
+    if total == 0:
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * max_workers
+    executor = _make_executor(units, max_workers)
+    # スレッドで計算するときは、同時に実行している他の呼び出しと混ざらないよう単位を直接渡す
+    args = () if isinstance(executor, ProcessPoolExecutor) else (units,)
+    loop = asyncio.get_running_loop()
+
+    pending = iter(range(total))
+    running = set()
+    done_count = 0
+    try:
+        # 投入済みの単位の数を抑え、取り消すときにワーカーに残る単位を少なくする
+        for j in pending:
+            running.add(loop.run_in_executor(executor, func, j, *args))
+            if len(running) >= max_in_flight:
+                break
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                done_count += 1
+                yield future.result()._replace(done=done_count, total=total)
+            for j in pending:
+                running.add(loop.run_in_executor(executor, func, j, *args))
+                if len(running) >= max_in_flight:
+                    break
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _make_executor(units: list[tuple], max_workers: int) -> Executor:
+    # 価格データやconstraintのlambdaをpickleしないよう、forkで起動するワーカーに引き継ぐ
+    if mp.get_start_method(allow_none=False) == 'fork':
+        return ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker, initargs=(units,))
+    if os.name == 'posix':
+        warnings.warn(
+                "For multiprocessing support"
+                "set multiprocessing start method to 'fork'.")
+    # forkできないときもイベントループを止めないよう、別のスレッドで1つずつ計算する
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def _init_worker(units: list[tuple]) -> None:
+    global _UNITS
+    _UNITS = units
+
+
+def _backtest_unit(j: int, units: list[tuple] | None = None) -> BacktestEvent:
+    from backtesting import Backtest
+
+    data, name, strategy, backtest_config = (units or _UNITS)[j]
+    stats = Backtest(data, strategy, **backtest_config).run()
+    trades = cut_not_closed_trades(stats).assign(name=name)
+    return BacktestEvent(name, None, trades, None, 0, 0)
+
+
+def _walkforward_unit(j: int, units: list[tuple] | None = None) -> BacktestEvent:
+    sub, name, i, window, MyStrategy, optimize_params = (units or _UNITS)[j]
+    result, fin_trades, _ = _walkforward_window(sub, MyStrategy, window, optimize_params, False)
+    trades = fin_trades.assign(name=name, window=i)
+    return BacktestEvent(name, i, trades, {'name': name, 'window': i, **result}, 0, 0)
@@ -2,17 +2,28 @@ from __future__ import annotations
 
 import os
 import warnings
+import shutil
 import multiprocessing as mp
 from datetime import date
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from itertools import islice
+from typing import TYPE_CHECKING, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
-from backtesting import Backtest, Strategy
-from backtesting._stats import _Stats
 
-from .utils import cut_not_closed_trades
+from .utils import cut_not_closed_trades, make_optimize_grid
+
+# backtesting.pyはbokehを、tqdmはそれ自体を読み込むのに時間がかかるので、使うときに読み込む
+# spawnで起動したワーカーもこのモジュールを読み込むため、起動が遅くならないようにしている
+if TYPE_CHECKING:
+    from backtesting import Strategy
+    from backtesting._stats import _Stats
+
+
+HEATMAP_METRICS = (
+        'SQN', 'Return [%]', 'Sharpe Ratio', 'Max. Drawdown [%]', 'Win Rate [%]', '# Trades')
 
 
 def out_of_sample(
@@ -21,8 +32,11 @@ def out_of_sample(
         in_date: tuple[date, date],
         out_date: tuple[date, date],
         optimize_params: dict,
-        backtest_config: dict | None = {'cash': 100_000, 'commission': .002}
-        ) -> tuple[_Stats, _Stats]:
+        backtest_config: dict | None = {'cash': 100_000, 'commission': .002},
+        parallel: bool = True,
+        return_heatmap: bool = False,
+        heatmap_metrics: tuple[str, ...] = HEATMAP_METRICS,
+        ) -> tuple[_Stats, _Stats] | tuple[_Stats, _Stats, pd.DataFrame]:
     """アウトオブサンプルテストを一度実行する
 
     インサンプル期間をつかって戦略のパラメータを最適化し、
@@ -35,29 +49,140 @@ def out_of_sample(
         out_date: アウトオブサンプルテストの開始と終了日
         optimize_params: 最適化パラメータ 詳しくはbacktesting.py
         backtest_config: バックテストクラス用の設定
+        parallel: Falseのときは最適化をマルチプロセスにせず、このプロセスで順に計算する
+            すでにマルチプロセスで動いているワーカーの中で使う
+        return_heatmap: Trueのときはインサンプルの最適化で計算したすべてのパラメータの評価値も返す
+        heatmap_metrics: 評価値として残すバックテスト結果の項目
 
     Returns:
         インサンプルテストとアウトオブサンプルテストの結果
+        return_heatmapがTrueのときは、パラメータをインデックス、評価値を列にしたDataFrameを加える
 
     """
+    from backtesting import Backtest
+
     df_in = df.query('@in_date[0] <= index < @in_date[1]')
     bt_in = Backtest(df_in, MyStrategy, **backtest_config)
-    stats_in = bt_in.optimize(**optimize_params)
+    if parallel and not return_heatmap:
+        stats_in = bt_in.optimize(**optimize_params)
+    else:
+        stats_in, heatmap = _optimize_grid(
+                bt_in, optimize_params,
+                heatmap_metrics if return_heatmap else (), parallel)
 
     df_out = df.query('@out_date[0] <= index < @out_date[1]')
     bt_out = Backtest(df_out, MyStrategy, **backtest_config)
     stats_out = bt_out.run(**stats_in._strategy._params)
+    if return_heatmap:
+        return stats_in, stats_out, heatmap
     return stats_in, stats_out
 
 
+def _optimize_grid(
+        bt,
+        optimize_params: dict,
+        metrics: tuple[str, ...] = (),
+        parallel: bool = False,
+        ) -> tuple[_Stats, pd.DataFrame]:
+    """Backtest.optimizeと同じ総当りの最適化を行い、各パラメータの評価値も返す
+
+    評価値はパラメータをインデックス、metricsの項目を列にしたDataFrameで、float32で持つ
+    maximizeが文字列のときはその項目も列に加え、関数のときは'Maximize'列に値を入れる
+    Backtest.optimizeと同じく、トレードのないパラメータのmaximizeの値はNaNにする
+    """
+    params = dict(optimize_params)
+    maximize = params.pop('maximize', 'SQN')
+    max_tries = params.pop('max_tries', None)
+    random_state = params.pop('random_state', None)
+    for key in ('method', 'return_heatmap', 'return_optimization'):
+        params.pop(key, None)
+    if isinstance(maximize, str):
+        maximize_col = maximize
+        metrics = tuple(dict.fromkeys([*metrics, maximize]))
+    else:
+        maximize_col = 'Maximize'
+
+    param_combos = make_optimize_grid(params)
+    if max_tries is not None:
+        frac = max_tries if 0 < max_tries <= 1 else max_tries / len(param_combos)
+        rand = np.random.default_rng(random_state).random
+        param_combos = [p for p in param_combos if rand() <= frac]
+    if not param_combos:
+        raise ValueError('No admissible parameter combinations to test')
+
+    global _mp_grid
+    _mp_grid = (bt, param_combos, maximize, metrics)
+    try:
+        index_batches = list(_batch(range(len(param_combos))))
+        if parallel and mp.get_start_method(allow_none=False) == 'fork':
+            with ProcessPoolExecutor() as executor:
+                values = np.vstack(list(executor.map(_evaluate_grid, index_batches)))
+        else:
+            values = _evaluate_grid(range(len(param_combos)))
+    finally:
+        _mp_grid = None
+
+    # float32に丸めると近い値が同じになることがあるので、丸める前の値で選ぶ
+    maximize_values = values[:, 0]
+    best = (int(np.nanargmax(maximize_values))
+            if np.isfinite(maximize_values).any() else 0)
+
+    heatmap = pd.DataFrame(
+            values[:, 1:] if isinstance(maximize, str) else values,
+            columns=list(metrics) if isinstance(maximize, str) else ['Maximize', *metrics],
+            index=pd.MultiIndex.from_tuples(
+                [tuple(p.values()) for p in param_combos],
+                names=list(param_combos[0].keys())),
+            dtype='float32',
+            )
+    if isinstance(maximize, str):
+        heatmap[maximize_col] = values[:, 0].astype('float32')
+    return bt.run(**param_combos[best]), heatmap
+
+
+_mp_grid = None
+
+
+def _evaluate_grid(index: range) -> np.ndarray:
+    """パラメータの組を順に実行し、maximizeの値とmetricsの値を行にして返す"""
+    bt, param_combos, maximize, metrics = _mp_grid
+    rows = []
+    for i in index:
+        stats = bt.run(**param_combos[i])
+        if not stats['# Trades']:
+            value = np.nan
+        elif isinstance(maximize, str):
+            value = stats[maximize]
+        else:
+            value = maximize(stats)
+        rows.append([value, *(stats[m] for m in metrics)])
+    return np.array(rows, dtype=float).reshape(len(rows), len(metrics) + 1)
+
+
+_WALKFORWARD_OUTPUT_PARAMS = {
+    'Start': '開始日',
+    'End': '終了日',
+    'Exposure Time [%]': '建玉日比率[%]',
+    '# Trades': 'トレード回数',
+    'Win Rate [%]': '勝率[%]',
+    'Best Trade [%]': 'ベストトレード[%]',
+    'Worst Trade [%]': 'ワーストトレード[%]',
+    'Avg. Trade [%]': '平均トレード[%]',
+    'Max. Trade Duration': '最大トレード期間',
+    'Avg. Trade Duration': '平均トレード期間',
+}
+
+
 def walkforward(
         df: pd.DataFrame,
         MyStrategy: Strategy,
         in_period: float,
         out_period: float,
         optimize_params: dict,
-        backtest_config: dict | None = {'cash': 1_000_000, 'commission': .002}
-        ) -> pd.DataFrame:
+        backtest_config: dict | None = {'cash': 1_000_000, 'commission': .002},
+        parallel: bool = True,
+        return_heatmap: bool = False,
+        ) -> tuple[pd.DataFrame, pd.DataFrame] | tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """ウォークフォワードテストを行う
 
     入力したデータの日付インデックスから、アウトサンプル期間、インサンプル期間のデータを
@@ -71,110 +196,323 @@ def walkforward(
         out_period: アウトサンプルの期間を年数で指定する
         optimize_params: 最適化パラメータ 詳しくはbacktesting.py
         backtest_config: バックテストクラス用の設定
+        parallel: Falseのときは最適化をマルチプロセスにしない 詳しくはout_of_sample
+        return_heatmap: Trueのときは各期間のインサンプルの最適化の評価値も返す
+            詳しくはout_of_sample select_paramsで別の基準のパラメータを選び直せる
 
     Returns:
         テストの結果の概要とトレード履歴
+        return_heatmapがTrueのときは、期間の番号(window, 結果の概要の行番号)と
+        パラメータをインデックスにした評価値を加える
 
     """
-    torelance = 0.9  # インサンプル期間が指定日数のx以下だと、そのデータはテストしない
-    output_params = {
-        'Start': '開始日',
-        'End': '終了日',
-        'Exposure Time [%]': '建玉日比率[%]',
-        '# Trades': 'トレード回数',
-        'Win Rate [%]': '勝率[%]',
-        'Best Trade [%]': 'ベストトレード[%]',
-        'Worst Trade [%]': 'ワーストトレード[%]',
-        'Avg. Trade [%]': '平均トレード[%]',
-        'Max. Trade Duration': '最大トレード期間',
-        'Avg. Trade Duration': '平均トレード期間',
-    }
     results = []
     trades = pd.DataFrame({})
+    heatmaps = []
+    for window in _walkforward_windows(df.index, in_period, out_period):
+        result, fin_trades, heatmap = _walkforward_window(
+                df, MyStrategy, window, optimize_params, parallel, return_heatmap)
+        trades = pd.concat([trades, fin_trades])
+        results.append(result)
+        heatmaps.append(heatmap)
+
+    results = pd.DataFrame(results)
+    if return_heatmap:
+        return results, trades, _concat_heatmaps(heatmaps, range(len(heatmaps)), ['window'])
+    return results, trades
+
 
-    end_date = df.index[-1]
-    check_in_data_period = True
-    while check_in_data_period:
+def _concat_heatmaps(heatmaps: list[pd.DataFrame], keys: list, names: list[str]) -> pd.DataFrame:
+    if not heatmaps:
+        return pd.DataFrame({})
+    return pd.concat(heatmaps, keys=keys, names=names)
 
+
+def _walkforward_windows(
+        index: pd.DatetimeIndex,
+        in_period: float,
+        out_period: float,
+        ) -> list[tuple[pd.Timestamp, pd.Timestamp, pd.Timestamp]]:
+    """ウォークフォワードテストの期間(開始日、インサンプルの終了日、終了日)を新しい順に返す"""
+    torelance = 0.9  # インサンプル期間が指定日数のx以下だと、そのデータはテストしない
+    windows = []
+    end_date = index[-1]
+    while True:
         mid_date = end_date - pd.Timedelta(365 * out_period, 'd')
         start_date = mid_date - pd.Timedelta(365 * in_period, 'd')
-        in_df = df.query('@start_date < index < @mid_date')
+        in_index = index[(start_date < index) & (index < mid_date)]
         # インサンプル期間が十分取得できているかを確認する
-        check_in_data_period = (
-                (in_df.index[-1] - in_df.index[0]) >
-                pd.Timedelta(365 * in_period * torelance, 'd')
-                )
-        if not check_in_data_period:
+        if len(in_index) == 0 or (
+                (in_index[-1] - in_index[0]) <=
+                pd.Timedelta(365 * in_period * torelance, 'd')):
             break
-
-        _, stats_out = out_of_sample(
-                df,
-                MyStrategy,
-                (start_date, mid_date),
-                (mid_date, end_date),
-                optimize_params=optimize_params,
-                )
-        out_bars = len(df.query('@mid_date <= index < @end_date')) - 1
+        windows.append((start_date, mid_date, end_date))
         end_date = mid_date
+    return windows
 
-        # アウトサンプル期間の最後まで持っている玉は除去する
-        # queryのみだとビューを返し、その後代入するときにワーニングがでるためcopy()する
-        fin_trades = stats_out._trades.query('ExitBar != @out_bars').copy()
-        fin_trades['Strategy'] = str(stats_out._strategy)
-        trades = pd.concat([trades, fin_trades])
 
-        result = dict()
-        for k, v in output_params.items():
-            result.update({v: stats_out[k]})
+def _walkforward_window(
+        df: pd.DataFrame,
+        MyStrategy: Strategy,
+        window: tuple[pd.Timestamp, pd.Timestamp, pd.Timestamp],
+        optimize_params: dict,
+        parallel: bool = True,
+        return_heatmap: bool = False,
+        ) -> tuple[dict, pd.DataFrame, pd.DataFrame | None]:
+    """ウォークフォワードテストの1つの期間でアウトオブサンプルテストを行う"""
+    start_date, mid_date, end_date = window
+    _, stats_out, *heatmap = out_of_sample(
+            df,
+            MyStrategy,
+            (start_date, mid_date),
+            (mid_date, end_date),
+            optimize_params=optimize_params,
+            parallel=parallel,
+            return_heatmap=return_heatmap,
+            )
+    out_bars = len(df.query('@mid_date <= index < @end_date')) - 1
+
+    # アウトサンプル期間の最後まで持っている玉は除去する
+    # queryのみだとビューを返し、その後代入するときにワーニングがでるためcopy()する
+    fin_trades = stats_out._trades.query('ExitBar != @out_bars').copy()
+    fin_trades['Strategy'] = str(stats_out._strategy)
+
+    result = dict()
+    for k, v in _WALKFORWARD_OUTPUT_PARAMS.items():
+        result.update({v: stats_out[k]})
+
+    for k, v in stats_out._strategy._params.items():
+        result.update({k: v})
+
+    return result, fin_trades, heatmap[0] if heatmap else None
+
+
+def walkforward_for_multiple_data(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        MyStrategy: Strategy,
+        in_period: float,
+        out_period: float,
+        optimize_params: dict,
+        max_workers: int | None = None,
+        return_heatmap: bool = False,
+        ) -> tuple[pd.DataFrame, pd.DataFrame] | tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """多数のデータでウォークフォワードテストを行う
 
-        for k, v in stats_out._strategy._params.items():
-            result.update({k: v})
+    銘柄×期間を1つの単位にして、すべての単位を1つのプロセスプールで計算する。
+    インサンプル期間の足が多い(時間のかかる)単位から順に投入し、最後に長い単位が残らないようにする。
+    ワーカーの中の最適化はマルチプロセスにしないので、CPU数より多くのプロセスは動かない。
 
-        results.append(result)
+    Args:
+        data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+        MyStrategy: 戦略クラス インスタンスではない
+        in_period: インサンプルの期間を年数で指定する
+        out_period: アウトサンプルの期間を年数で指定する
+        optimize_params: 最適化パラメータ 詳しくはbacktesting.py
+        max_workers: ワーカーの数 省略するとCPU数
+        return_heatmap: Trueのときは各期間のインサンプルの最適化の評価値も返す
 
-    results = pd.DataFrame(results)
+    Returns:
+        テストの結果の概要とトレード履歴 どちらも銘柄名(name)と期間の番号(window)の列をもつ
+        期間の番号は古い期間から0, 1, 2...とつける
+        return_heatmapがTrueのときは、銘柄名、期間の番号、パラメータをインデックスにした評価値を加える
 
-    # print(results)
-    # print(trades)
+    """
+    from tqdm import tqdm
+
+    units = []
+    for data, name in data_name_tpl_lst:
+        windows = _walkforward_windows(data.index, in_period, out_period)[::-1]
+        for i, window in enumerate(windows):
+            # ワーカーではその期間のデータだけを使う
+            sub = data[(window[0] <= data.index) & (data.index < window[2])]
+            cost = int(((window[0] <= sub.index) & (sub.index < window[1])).sum())
+            units.append((cost, sub, name, i, window))
+    units.sort(key=lambda u: u[0], reverse=True)
+
+    # backtesting.pyの最適化と同じく、forkで引き継がれるグローバル変数にデータを置き、
+    # ワーカーには番号だけを送る constraintのlambdaなどはpickleできないため
+    global _mp_walkforward
+    _mp_walkforward = ([u[1:] for u in units], MyStrategy, optimize_params, return_heatmap)
+    # 重い順に並べた単位を配るように振り分け、重い単位が1つのバッチに偏らないようにする
+    n_batches = len(list(_batch(range(len(units)))))
+    index_batches = [range(k, len(units), n_batches) for k in range(n_batches)]
+    outputs = []
+    try:
+        if mp.get_start_method(allow_none=False) == 'fork':
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                        executor.submit(_batch_walkforward, b_index)
+                        for b_index in index_batches]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    outputs.extend(future.result())
+        else:
+            if os.name == 'posix':
+                warnings.warn(
+                        "For multiprocessing support"
+                        "set multiprocessing start method to 'fork'.")
+            outputs = _batch_walkforward(range(len(units)))
+    finally:
+        _mp_walkforward = None
+
+    results = pd.DataFrame([
+        {'name': name, 'window': i, **result} for name, i, result, _, _ in outputs])
+    trades = pd.concat(
+            [t.assign(name=name, window=i) for name, i, _, t, _ in outputs]
+            or [pd.DataFrame({})])
+    if not results.empty:
+        results = results.sort_values(['name', 'window'], ignore_index=True)
+    if return_heatmap:
+        heatmaps = _concat_heatmaps(
+                [h for *_, h in outputs], [(name, i) for name, i, *_ in outputs],
+                ['name', 'window'])
+        return results, trades, heatmaps.sort_index(level=['name', 'window'], sort_remaining=False)
     return results, trades
 
 
+_mp_walkforward = None
+
+
+def _batch_walkforward(
+        index: range,
+        ) -> list[tuple[str, int, dict, pd.DataFrame, pd.DataFrame | None]]:
+    units, MyStrategy, optimize_params, return_heatmap = _mp_walkforward
+    outputs = []
+    for sub, name, i, window in (units[j] for j in index):
+        result, fin_trades, heatmap = _walkforward_window(
+                sub, MyStrategy, window, optimize_params, False, return_heatmap)
+        outputs.append((name, i, result, fin_trades, heatmap))
+    return outputs
+
+
 def backtest_for_multiple_data(
         data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
-        strategy: Strategy
-        ) -> pd.DataFrame:
+        strategy: Strategy,
+        output_dir: str | Path | None = None,
+        max_in_flight: int | None = None,
+        ) -> pd.DataFrame | TradeResultSet:
     """
     多数のデータを同じ戦略で計算する 高速化のためマルチプロセスで計算させている
 
+    output_dirを指定すると、ワーカーがトレード履歴を戦略ごとのparquetファイルに直接書き出し、
+    親プロセスには書き出した件数だけを返す。すべてのトレード履歴をメモリに持たないので、
+    全銘柄を多数の戦略で計算するときに使う。
+
     Args:
         data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
         strategy: 戦略クラス インスタンスではない
+        output_dir: トレード履歴を書き出すディレクトリ
+            output_dir/strategy=戦略名/part-番号.parquetに書き出す 同じ戦略の前回の結果は消す
+        max_in_flight: 同時に投入しておくバッチの数の上限 省略するとCPU数の2倍
 
     Returns:
         バックテストのトレード履歴
         バックテスト期間の最後まで保持していたポジションは削除している
+        output_dirを指定したときは、書き出したトレード履歴を読み込むためのTradeResultSet
 
     """
+    from tqdm import tqdm
+
     code_batches = list(_batch(data_name_tpl_lst))
+    max_in_flight = max_in_flight or 2 * (os.cpu_count() or 1)
+    if output_dir is not None:
+        part_dir = Path(output_dir).joinpath(f'strategy={strategy.__name__}')
+        if part_dir.exists():
+            shutil.rmtree(part_dir)
+        part_dir.mkdir(parents=True)
+        tasks = [
+                (_batch_backtest_to_parquet, b_code_lst, strategy,
+                 part_dir.joinpath(f'part-{i:05d}.parquet'))
+                for i, b_code_lst in enumerate(code_batches)]
+    else:
+        tasks = [(_batch_backtest, b_code_lst, strategy) for b_code_lst in code_batches]
 
+    results = []
     if mp.get_start_method(allow_none=False) == 'fork':
-        trades = pd.DataFrame({})
         with ProcessPoolExecutor() as executor:
-            futures = [
-                    executor.submit(_batch_backtest, b_code_lst, strategy)
-                    for b_code_lst in code_batches]
-
-            for future in tqdm(as_completed(futures), total=len(futures)):
-                trades = pd.concat([trades, future.result()])
+            # 結果を受け取った分だけ次のバッチを投入し、投入済みのバッチの数を抑える
+            pending = iter(tasks)
+            running = {executor.submit(*t) for t in islice(pending, max_in_flight)}
+            with tqdm(total=len(tasks)) as bar:
+                while running:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results.append(future.result())
+                        bar.update()
+                    running |= {executor.submit(*t) for t in islice(pending, len(done))}
 
     else:
         if os.name == 'posix':
             warnings.warn(
                     "For multiprocessing support"
                     "set multiprocessing start method to 'fork'.")
-        trades = _batch_backtest(data_name_tpl_lst, strategy)
+        results = [func(*args) for func, *args in tasks]
 
-    return trades
+    if output_dir is not None:
+        return TradeResultSet(output_dir)
+    return pd.concat(results) if results else pd.DataFrame({})
+
+
+class TradeResultSet:
+    """backtest_for_multiple_dataでparquetに書き出したトレード履歴を必要なときに読み込む
+
+    Args:
+        path: backtest_for_multiple_dataのoutput_dir
+
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+
+    @property
+    def files(self) -> list[Path]:
+        """書き出したparquetファイル"""
+        return sorted(self.path.glob('strategy=*/part-*.parquet'))
+
+    @property
+    def strategies(self) -> list[str]:
+        """書き出した戦略名"""
+        return sorted(p.name.split('=', 1)[1] for p in self.path.glob('strategy=*'))
+
+    def __len__(self) -> int:
+        import pyarrow.parquet as pq
+        return sum(pq.read_metadata(f).num_rows for f in self.files)
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        """ファイルごとにトレード履歴を返す 全体をメモリに読み込まずに処理するときに使う"""
+        for f in self.files:
+            yield pd.read_parquet(f).assign(Strategy=f.parent.name.split('=', 1)[1])
+
+    def read(
+            self,
+            strategies: str | list[str] | None = None,
+            names: list[str] | None = None,
+            columns: list[str] | None = None,
+            ) -> pd.DataFrame:
+        """トレード履歴を読み込む
+
+        Args:
+            strategies: 読み込む戦略名 省略するとすべて
+            names: 読み込む銘柄名 省略するとすべて
+            columns: 読み込む列 省略するとすべて
+
+        Returns:
+            トレード履歴 戦略名はStrategy列に入る
+
+        """
+        filters = []
+        if strategies is not None:
+            filters.append(('strategy', 'in', _as_list(strategies)))
+        if names is not None:
+            filters.append(('name', 'in', [str(n) for n in names]))
+        if columns is not None:
+            columns = [*columns, 'strategy']
+        trades = pd.read_parquet(self.path, columns=columns, filters=filters or None)
+        trades['strategy'] = trades['strategy'].astype(str)
+        return trades.rename(columns={'strategy': 'Strategy'})
+
+
+def _as_list(x) -> list:
+    return list(x) if isinstance(x, (list, tuple, set)) else [x]
 
 
 def _batch(seq: list):
@@ -187,6 +525,8 @@ def _batch_backtest(
         data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
         strategy: Strategy
         ) -> pd.DataFrame:
+    from backtesting import Backtest
+    from tqdm import tqdm
 
     trades = pd.DataFrame({})
     for data_name_tpl in tqdm(data_name_tpl_lst):
@@ -202,5 +542,18 @@ def _batch_backtest(
     return trades
 
 
+def _batch_backtest_to_parquet(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        strategy: Strategy,
+        part_file: Path,
+        ) -> dict:
+    trades = _batch_backtest(data_name_tpl_lst, strategy)
+    if not trades.empty:
+        # バッチごとに型が変わらないよう、名前は文字列にそろえる
+        trades['name'] = trades['name'].astype(str)
+        trades.to_parquet(part_file, index=False)
+    return {'file': str(part_file), 'codes': len(data_name_tpl_lst), 'trades': len(trades)}
+
+
 if __name__ == '__main__':
     pass
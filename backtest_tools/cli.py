@@ -0,0 +1,43 @@
+"""コマンドラインからパイプラインを実行する
+
+使い方::
+
+    backtest_tools config.json [--force]
+
+"""
+
+from __future__ import annotations
+
+import sys
+import argparse
+
+from .pipeline import Pipeline, load_config
+
+
+def main(argv: list[str] | None = None) -> int:
+    """設定ファイルのパイプラインを実行し、段階ごとにかかった時間を表示する
+
+    Args:
+        argv: コマンドライン引数 省略するとsys.argvを使う
+
+    Returns:
+        終了コード
+
+    """
+    parser = argparse.ArgumentParser(
+            prog='backtest_tools',
+            description='設定ファイルにしたがってバックテストからレポート作成までを実行する',
+            )
+    parser.add_argument('config', help='jsonの設定ファイル')
+    parser.add_argument(
+            '--force', action='store_true', help='キャッシュを使わずにすべてやり直す')
+    args = parser.parse_args(argv)
+
+    pipeline = Pipeline(load_config(args.config), force=args.force)
+    pipeline.run()
+    print(pipeline.timing_table().to_string(float_format='{:.2f}'.format))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""bokehのプロットを小さなhtmlとして保存する関数を提供する"""
+
+from __future__ import annotations
+
+import json
+import shutil
+import filecmp
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from bokeh.models import Model
+
+_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+  <meta charset="utf-8">
+  <title>{title}</title>
+{scripts}
+</head>
+<body>
+  <div id="root"></div>
+  <script src="{data_file}"></script>
+  <script>Bokeh.embed.embed_item(BACKTEST_TOOLS_ITEM, "root");</script>
+</body>
+</html>
+"""
+
+
+def save_compact(
+        obj: Model,
+        filename: str | Path,
+        title: str = 'Bokeh Plot',
+        float_dtype: str = 'float32',
+        ) -> None:
+    """プロットのデータを別ファイルに分け、BokehJSを共有のローカルファイルから読み込むhtmlを保存する
+
+    htmlにはレイアウトとスクリプトの読み込みだけを書き、
+    プロットのデータは同じ名前の.data.jsファイルに書き出す。
+    BokehJSは出力先のstatic/jsに一度だけコピーし、同じディレクトリのすべてのhtmlで共有する。
+    データの浮動小数点はfloat_dtypeに、int32に収まる整数はint32に変換し、
+    bokehのバイナリ(base64)形式で小さく書き出す。
+
+    Args:
+        obj: 保存するbokehのレイアウトやfigure
+        filename: 出力するhtmlのパス
+        title: htmlのタイトル
+        float_dtype: 浮動小数点の列を変換する型 Noneのときは変換しない
+
+    """
+    from bokeh.embed import json_item
+    from bokeh.embed.bundle import bundle_for_objs_and_resources
+    from bokeh.models import ColumnDataSource
+    from bokeh.resources import Resources
+    from bokeh.util.paths import bokehjsdir
+
+    filename = Path(filename)
+    out_dir = filename.parent
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    bundle = bundle_for_objs_and_resources(
+            [obj], Resources(mode='server', root_url='./'))
+    js_dir = Path(bokehjsdir()).joinpath('js')
+    for url in bundle.js_files:
+        src = js_dir.joinpath(Path(url).name)
+        dst = out_dir.joinpath(url)
+        # bokehを更新したときに古いBokehJSを使い続けないよう、中身が違えばコピーし直す
+        if not dst.exists() or not filecmp.cmp(src, dst, shallow=False):
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(src, dst)
+
+    # 型の変換は書き出す間だけにして、呼び出し側のプロットのデータは元に戻す
+    original = []
+    try:
+        if float_dtype is not None:
+            for source in obj.select({'type': ColumnDataSource}):
+                original.append((source, dict(source.data)))
+                source.data = {
+                        k: _downcast(v, np.dtype(float_dtype))
+                        for k, v in source.data.items()}
+        item = json.dumps(json_item(obj), separators=(',', ':'))
+    finally:
+        for source, data in original:
+            source.data = data
+
+    data_file = filename.with_suffix('.data.js')
+    with data_file.open('w', encoding='utf-8') as f:
+        f.write(f'var BACKTEST_TOOLS_ITEM = {item};\n')
+
+    scripts = '\n'.join(
+            f'  <script src="{url}"></script>' for url in bundle.js_files)
+    with filename.open('w', encoding='utf-8') as f:
+        f.write(_TEMPLATE.format(
+            title=title, scripts=scripts, data_file=data_file.name))
+
+
+def _downcast(values, float_dtype: np.dtype):
+    if not isinstance(values, np.ndarray):
+        return values
+    if values.dtype.kind == 'f' and values.dtype.itemsize > float_dtype.itemsize:
+        return values.astype(float_dtype)
+    if values.dtype.kind in 'iu' and values.dtype.itemsize > 4 and len(values):
+        if np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+            return values.astype(np.int32)
+    return values
@@ -0,0 +1,174 @@
+"""全銘柄の指標を日付×銘柄のパネルでまとめて計算し、保存する関数を提供する
+
+戦略のinitで銘柄ごとにTA-Libで計算する代わりに、
+価格のパネル(make_price_panel)から全銘柄の指標を一度に計算しておく。
+計算した指標はattach_featuresで価格データの列に加えられるので、
+戦略からはself.data.EMA_20のように読むだけでよい::
+
+    class EmaCross(Strategy):
+        def init(self):
+            self.ema1 = self.I(lambda: self.data.EMA_20)
+
+指標は各銘柄の取引のある足だけで計算し、TA-Libと同じ初期値(最初のn本の平均)から始める。
+"""
+
+from __future__ import annotations
+
+import pickle
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+
+_DEFAULT_CACHE = Path(__file__).parent.joinpath('data/features.pkl')
+
+
+def compute_features(
+        panel: dict[str, pd.DataFrame],
+        indicators: dict[str, tuple[str, int]],
+        ) -> dict[str, pd.DataFrame]:
+    """指標をパネル全体で計算する
+
+    Args:
+        panel: make_price_panelで作ったパネル
+        indicators: 指標の名前をキーに、(種類, 期間)を値にした辞書
+            種類は'SMA', 'EMA', 'RSI', 'ATR'のいずれか
+            例えば {'EMA_20': ('EMA', 20), 'ATR_14': ('ATR', 14)}
+
+    Returns:
+        指標の名前をキーにした、日付×銘柄のDataFrameの辞書
+
+    """
+    close = panel['Close']
+    valid = close.notna().to_numpy()
+    # 銘柄ごとに取引のある足を上に詰め、すべての銘柄の足の番号をそろえる
+    order = np.argsort(~valid, axis=0, kind='stable')
+    packed = {
+            col: np.take_along_axis(panel[col].to_numpy(dtype=float), order, axis=0)
+            for col in ('High', 'Low', 'Close') if col in panel}
+
+    features = {}
+    for name, (kind, n) in indicators.items():
+        if kind not in _INDICATORS:
+            raise ValueError(f'未対応の指標: {kind}')
+        values = _INDICATORS[kind](packed, n)
+        unpacked = np.full(values.shape, np.nan)
+        np.put_along_axis(unpacked, order, values, axis=0)
+        unpacked[~valid] = np.nan
+        features[name] = pd.DataFrame(unpacked, index=close.index, columns=close.columns)
+    return features
+
+
+def attach_features(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        features: dict[str, pd.DataFrame],
+        ) -> list[tuple[pd.DataFrame, str]]:
+    """価格データに指標の列を加える
+
+    Args:
+        data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+        features: compute_featuresやread_featuresで得た指標
+
+    Returns:
+        指標の名前の列を加えたデータと名前のリスト
+
+    """
+    attached = []
+    for data, name in data_name_tpl_lst:
+        columns = {
+                key: feature[str(name)].reindex(data.index)
+                for key, feature in features.items() if str(name) in feature.columns}
+        attached.append((data.assign(**columns), name))
+    return attached
+
+
+def cache_features(
+        indicators: dict[str, tuple[str, int]],
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]] | None = None,
+        cache_file: Path = _DEFAULT_CACHE,
+        ) -> dict[str, pd.DataFrame]:
+    """指標を計算して価格のキャッシュと同じディレクトリに保存する
+
+    Args:
+        indicators: 計算する指標 詳しくはcompute_features
+        data_name_tpl_lst: 価格データ 省略すると価格のキャッシュ(read_cache_data)を使う
+        cache_file: 保存先のパス
+
+    Returns:
+        計算した指標
+
+    """
+    from .portfolio import make_price_panel
+    from .read_zip_data import read_cache_data
+
+    if data_name_tpl_lst is None:
+        data_name_tpl_lst = read_cache_data()
+    features = compute_features(make_price_panel(data_name_tpl_lst), indicators)
+    with Path(cache_file).open('wb') as p:
+        pickle.dump(features, p)
+    return features
+
+
+def read_features(cache_file: Path = _DEFAULT_CACHE) -> dict[str, pd.DataFrame]:
+    """cache_featuresで保存した指標を読み込む
+
+    Args:
+        cache_file: 保存したパス
+
+    Returns:
+        指標の名前をキーにした、日付×銘柄のDataFrameの辞書
+
+    """
+    with Path(cache_file).open('rb') as p:
+        return pickle.load(p)
+
+
+def _sma(packed: dict[str, np.ndarray], n: int) -> np.ndarray:
+    return pd.DataFrame(packed['Close']).rolling(n).mean().to_numpy()
+
+
+def _ema(packed: dict[str, np.ndarray], n: int) -> np.ndarray:
+    return _smooth(packed['Close'], n, 2 / (n + 1), start=0)
+
+
+def _rsi(packed: dict[str, np.ndarray], n: int) -> np.ndarray:
+    close = packed['Close']
+    diff = np.vstack([np.full((1, close.shape[1]), np.nan), np.diff(close, axis=0)])
+    gain = _smooth(np.clip(diff, 0, None), n, 1 / n, start=1)
+    loss = _smooth(np.clip(-diff, 0, None), n, 1 / n, start=1)
+    total = gain + loss
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rsi = 100 * gain / total
+    # TA-Libと同じく、値動きのない期間は0にする
+    return np.where(total == 0, 0., rsi)
+
+
+def _atr(packed: dict[str, np.ndarray], n: int) -> np.ndarray:
+    high, low, close = packed['High'], packed['Low'], packed['Close']
+    prev_close = np.vstack([np.full((1, close.shape[1]), np.nan), close[:-1]])
+    tr = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+    tr[0] = np.nan
+    return _smooth(tr, n, 1 / n, start=1)
+
+
+def _smooth(x: np.ndarray, n: int, alpha: float, start: int) -> np.ndarray:
+    """最初のn本の平均を初期値にした指数平滑 TA-LibのEMAやWilderの平滑と同じ
+
+    時間方向にはループするが、各時点ですべての銘柄をまとめて計算する
+    """
+    out = np.full(x.shape, np.nan)
+    first = start + n - 1
+    if len(x) <= first:
+        return out
+    out[first] = x[start:first + 1].mean(axis=0)
+    for t in range(first + 1, len(x)):
+        out[t] = out[t - 1] + alpha * (x[t] - out[t - 1])
+    return out
+
+
+_INDICATORS = {
+        'SMA': _sma,
+        'EMA': _ema,
+        'RSI': _rsi,
+        'ATR': _atr,
+        }
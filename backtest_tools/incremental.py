@@ -0,0 +1,187 @@
+"""日々追加される価格データに対して、バックテスト結果を差分で更新するクラスを提供する"""
+
+from __future__ import annotations
+
+import os
+import pickle
+import inspect
+import hashlib
+import warnings
+import multiprocessing as mp
+from pathlib import Path
+from typing import TYPE_CHECKING
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from .backtest import _batch
+from .utils import cut_not_closed_trades
+
+if TYPE_CHECKING:
+    from backtesting import Strategy
+
+
+class IncrementalBacktest:
+    """銘柄ごとの状態を保存し、新しい足の分だけバックテストをやり直す
+
+    backtesting.pyは途中の状態から再開できないため、前回の実行の最後に
+    建玉していたトレードのエントリー日(建玉がなければ最後の足)を再開点として保存しておく。
+    更新時は再開点からwarmup本前の足からバックテストを実行し、
+    保存済みのトレード履歴のうち再開点より前にエントリーしたものに、再開点以降にエントリーしたトレードを加える。
+    指標の計算に必要な足(EMAの収束など)がwarmup本で足りることを前提にしている。
+    また、再開時の資金は初期資金に戻るため、SizeとPnLは全期間で実行したときと異なる場合がある。
+
+    保存済みの足の部分のデータが前回と変わっている銘柄(株式分割の調整など)は、
+    全期間でバックテストをやり直す。戦略のコードやパラメータ、設定を変えたときも同じ。
+
+    Args:
+        strategy: 戦略クラス インスタンスではない
+        state_dir: 銘柄ごとの状態を保存するディレクトリ
+        warmup: 再開点より前に含める足の本数
+        backtest_config: バックテストクラス用の設定
+
+    Attributes:
+        last_update(dict): 直前のupdateでの銘柄ごとの更新方法
+            'full'(全期間)、'incremental'(差分)、'unchanged'(新しい足なし)のいずれか
+
+    """
+
+    def __init__(
+            self,
+            strategy: Strategy,
+            state_dir: str | Path,
+            warmup: int = 200,
+            backtest_config: dict | None = None,
+            ) -> None:
+        self.strategy = strategy
+        self.state_dir = Path(state_dir)
+        self.warmup = warmup
+        self.backtest_config = backtest_config or {}
+        self.last_update = {}
+
+    def update(
+            self,
+            data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+            ) -> pd.DataFrame:
+        """価格データでバックテスト結果を更新する
+
+        Args:
+            data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+
+        Returns:
+            すべての銘柄のトレード履歴 backtest_for_multiple_dataの結果と同じ形式
+
+        """
+        from tqdm import tqdm
+
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        code_batches = list(_batch(data_name_tpl_lst))
+        results = []
+        if len(code_batches) > 1 and mp.get_start_method(allow_none=False) == 'fork':
+            with ProcessPoolExecutor() as executor:
+                futures = [executor.submit(self._batch_update, b) for b in code_batches]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    results.extend(future.result())
+        else:
+            if len(code_batches) > 1 and os.name == 'posix':
+                warnings.warn(
+                        "For multiprocessing support"
+                        "set multiprocessing start method to 'fork'.")
+            results = self._batch_update(data_name_tpl_lst)
+
+        self.last_update = {name: mode for name, mode, _ in results}
+        frames = [trades.assign(name=name) for name, _, trades in results]
+        return pd.concat(frames) if frames else pd.DataFrame({})
+
+    def _batch_update(
+            self,
+            data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+            ) -> list[tuple[str, str, pd.DataFrame]]:
+        return [
+                (name, *self._update_one(data, str(name)))
+                for data, name in data_name_tpl_lst]
+
+    def _update_one(self, data: pd.DataFrame, name: str) -> tuple[str, pd.DataFrame]:
+        from backtesting import Backtest
+
+        state_file = self.state_dir.joinpath(f'{name}.pkl')
+        state = None
+        if state_file.exists():
+            with state_file.open('rb') as p:
+                state = pickle.load(p)
+            n = state['n_bars']
+            if (state['key'] != self._key()
+                    or len(data) < n
+                    or _digest(data.iloc[:n]) != state['digest']):
+                state = None
+
+        if state is not None and len(data) == state['n_bars']:
+            return 'unchanged', state['trades']
+
+        if state is None:
+            mode = 'full'
+            stats = Backtest(data, self.strategy, **self.backtest_config).run()
+            trades = cut_not_closed_trades(stats)
+            open_trades = stats._trades.drop(trades.index)
+        else:
+            mode = 'incremental'
+            resume = state['resume_time']
+            start = max(data.index.searchsorted(resume) - self.warmup, 0)
+            stats = Backtest(data.iloc[start:], self.strategy, **self.backtest_config).run()
+            # 再開点より前のトレードは保存済みのものを使う
+            tail = stats._trades[stats._trades['EntryTime'] >= resume]
+            closed = cut_not_closed_trades(stats)
+            new_trades = tail[tail.index.isin(closed.index)]
+            open_trades = tail.drop(new_trades.index)
+            # 差分で実行した足の番号を全期間の番号にそろえる
+            new_trades = new_trades.assign(
+                    EntryBar=new_trades['EntryBar'] + start,
+                    ExitBar=new_trades['ExitBar'] + start,
+                    )
+            # 建玉中のトレードより後にエントリーして決済済みのトレードは差分の実行でも現れるので除く
+            kept = state['trades'][state['trades']['EntryTime'] < resume]
+            trades = pd.concat([kept, new_trades], ignore_index=True)
+
+        resume_time = (open_trades['EntryTime'].min() if len(open_trades)
+                       else data.index[-1])
+        state = {
+                'key': self._key(),
+                'n_bars': len(data),
+                'digest': _digest(data),
+                'resume_time': resume_time,
+                'trades': trades,
+                }
+        with state_file.open('wb') as p:
+            pickle.dump(state, p)
+        return mode, trades
+
+    def _key(self) -> str:
+        # 戦略のコードやクラス変数のパラメータを変えたときは、保存済みの結果を使わない
+        return repr((
+            self.strategy.__module__, self.strategy.__qualname__,
+            _strategy_source(self.strategy), sorted(_strategy_params(self.strategy).items()),
+            self.warmup, sorted(self.backtest_config.items())))
+
+
+def _strategy_source(strategy: Strategy) -> str:
+    try:
+        return inspect.getsource(strategy)
+    except (OSError, TypeError):
+        # 対話環境で定義したクラスなどはソースを取得できないので、パラメータだけで判定する
+        return ''
+
+
+def _strategy_params(strategy: Strategy) -> dict:
+    """戦略クラスのクラス変数のパラメータ backtesting.pyがrunの引数で上書きできるもの"""
+    params = {}
+    for name in dir(strategy):
+        if name.startswith('_'):
+            continue
+        value = getattr(strategy, name)
+        if not callable(value) and not isinstance(value, property):
+            params[name] = value
+    return params
+
+
+def _digest(data: pd.DataFrame) -> str:
+    return hashlib.sha1(pd.util.hash_pandas_object(data).to_numpy().tobytes()).hexdigest()
@@ -1,15 +1,22 @@
 from __future__ import annotations
-import random
-from datetime import timedelta
-from tqdm import tqdm
+import os
+from statistics import NormalDist
+from typing import Callable, Iterator, Sequence
+from typing import TYPE_CHECKING
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from bokeh.plotting import save, figure, output_file
-from bokeh.layouts import gridplot
-from bokeh.models import ColumnDataSource, CustomJS, Range1d, LinearAxis
-from bokeh.models import HoverTool
-from bokeh.events import DoubleTap
-from bokeh.plotting.figure import Figure
+
+from .compact_html import save_compact
+
+# bokehは使うときに読み込む 理由はbacktest.pyの冒頭を参照
+if TYPE_CHECKING:
+    from bokeh.plotting.figure import Figure
+
+_YEAR = pd.Timedelta(days=365).value
+_SUMMARY_Q = (0.05, 0.5, 0.95)
+# confidence_intervalsで求める項目 ci_targetsに指定できる
+_CI_ITEMS = ('Ruin Rate', 'Return 50%', 'Max. Drawdown 50%')
 
 
 class Montecarlo:
@@ -30,9 +37,15 @@ class Montecarlo:
         trades(pd.DataFrame): トレード履歴
         init_assets(float): 初期資産
         ruin_point(float): 破産とする資産の閾値
+        seed_seq(np.random.SeedSequence): シミュレーションの分割ごとの乱数列を派生させる元
+        horizons(list[float]): シミュレーションの期間[年]のリスト
+        results(dict): 期間ごとの集計結果 MontecarloRecorderかMontecarloAccumulator
+        result(MontecarloRecorder | MontecarloAccumulator): 最初の期間の集計結果
         ret_list(list[float]): シミュレーション結果 リターンのリスト
         dd_list(list[float]): シミュレーション結果 ドローダウンのリスト
         ruin_list(list[bool]): シミュレーション結果 破産したかのリスト
+        convergence(dict): ci_targetsを指定して実行したときの
+            シミュレーション回数、目標に達したか、信頼区間
 
     """
 
@@ -43,99 +56,815 @@ class Montecarlo:
             ruin_point: float,
             seed: int = 2022
             ) -> None:
-        random.seed(seed)
+        self.seed_seq = np.random.SeedSequence(seed)
         self.trades = trades
         self.init_assets = init_assets
         self.ruin_point = ruin_point
+        self.horizons = [1]
+        # トレード履歴はシミュレーション中に何度も参照するため、最初に配列にしておく
+        self._returns = trades['ReturnPct'].to_numpy(dtype='float')
+        self._durations = (
+                pd.to_timedelta(trades['Duration']).to_numpy().astype('int64')
+                )
 
     def _montecarlo_a_year(
             self,
-            ) -> tuple[float, float, bool]:
-        """1年分のモンテカルロテストを行う
+            sim_times: int,
+            n_jobs: int | None = 1,
+            chunk_size: int = 10_000,
+            ) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """horizonsの期間分のモンテカルロテストをまとめて行う
 
         バックテスト結果からランダムにトレードを選択し、
-        そのリターン比率を資産にかけるという操作を1年分繰り返す
+        そのリターン比率を資産にかけるという操作を最長の期間分繰り返し、
+        途中の各期間の時点での結果も記録する
         このテストはバックテストの各トレードが独立した結果であることを仮定している
+        シミュレーションはchunk_sizeごとに分割し、分割ごとに独立した乱数列を割り当てる
+        分割の仕方はn_jobsによらないため、プロセス数を変えても結果は変わらない
 
-        Returns:
-            1年分のシミュレート結果のリターン資産, 最大ドロップダウン, 破産したかのブール値
+        Args:
+            sim_times: シミュレーションの回数
+            n_jobs: 計算に使うプロセス数 Noneのときはcpu数
+            chunk_size: 1プロセスに一度に割り当てるシミュレーションの回数
+
+        Yields:
+            分割ごとの各パスのリターン資産, 最大ドロップダウン, 破産したかのブール値の配列
+            それぞれ(期間の数 x シミュレーションの回数)の配列
 
         """
-        num_trades = len(self.trades)
-        sum_duration = timedelta(days=0)
-        asset_hist = [self.init_assets]
-        has_ruin = False
+        horizons = _horizons_ns(self.horizons)
+        sizes = _chunk_sizes(sim_times, chunk_size)
+        tasks = [
+                (self._returns, self._durations, horizons,
+                 self.init_assets, self.ruin_point, size, seed_seq)
+                for size, seed_seq in zip(sizes, self.seed_seq.spawn(len(sizes)))
+                ]
+        yield from _map_chunks(_simulate_chunk, tasks, n_jobs)
+
+    def run(
+            self,
+            sim_times: int = 1500,
+            n_jobs: int | None = 1,
+            chunk_size: int = 10_000,
+            streaming: bool = False,
+            ci_targets: dict[str, float] | None = None,
+            max_sim_times: int = 100_000,
+            confidence: float = 0.95,
+            horizons: Sequence[float] = (1,),
+            ) -> None:
+        """モンテカルロテストを所定回数行う
 
-        while sum_duration < timedelta(days=365):
-            i = random.randrange(num_trades)  # 無作為抽出部分
-            sum_duration += self.trades.Duration.iat[i]
-            current_asset = asset_hist[-1]
-            asset_hist.append(
-                    current_asset + asset_hist[-1] * self.trades.ReturnPct.iat[i]
-                    )
+        _montecarlo_a_year関数で指定回数分のシミュレーションを行い、
+        その結果(リターン,ドロップダウン、破産したかどうか)をリストに格納する
+        このリストを元にモンテカルロテストの集計やグラフ化を行う
+        streamingを指定すると、リストの代わりにMontecarloAccumulatorで逐次集計し、
+        シミュレーション回数によらず一定のメモリで集計できる
 
-        sr_asset = pd.Series(asset_hist, dtype='float')
-        if sr_asset.min() < self.ruin_point:
-            has_ruin = True
+        ci_targetsを指定すると、sim_times回ずつシミュレーションを追加し、
+        破産確率やメジアンの信頼区間の幅が目標以下になるか、
+        max_sim_timesに達するまで続ける。結果はconvergenceに格納する
 
-        ret = float(sr_asset.iat[-1] / self.init_assets - 1.0)
-        max_dd = float((sr_asset / sr_asset.cummax() - 1).min())
-        return ret, max_dd, has_ruin
+        horizonsに複数の期間を指定すると、各パスを最長の期間まで一度だけシミュレートし、
+        各期間の時点でのリターン、最大ドロップダウン、破産を記録する
 
-    def run(self, sim_times: int = 1500) -> None:
-        """モンテカルロテストを所定回数行う
+        Args:
+            sim_times: シミュレーションの回数 多いほど集計結果が信頼できるが、時間がかかる
+                ci_targetsを指定したときは1回に追加するシミュレーションの回数
+            n_jobs: 計算に使うプロセス数 Noneのときはcpu数
+            chunk_size: 1プロセスに一度に割り当てるシミュレーションの回数
+                結果の再現にはseedとchunk_sizeを揃える必要がある
+            streaming: 結果をリストに保持せず、逐次集計する
+            ci_targets: 信頼区間の幅の目標
+                {'Ruin Rate': 0.01, 'Return 50%': 0.02, 'Max. Drawdown 50%': 0.01}
+                のように、summaryの項目名で指定する 判定には最初の期間の結果を使う
+            max_sim_times: ci_targetsを指定したときのシミュレーション回数の上限
+            confidence: 信頼区間の信頼水準
+            horizons: シミュレーションの期間[年]のリスト
 
-        _montecarlo_a_year関数を指定回数行い、その結果(リターン,ドロップダウン、破産したかどうか)を
-        リストに格納する
-        このリストを元にモンテカルロテストの集計やグラフ化を行う
+        """
+        self.horizons = list(horizons)
+        recorder = MontecarloAccumulator if streaming else MontecarloRecorder
+        self.results = {h: recorder() for h in self.horizons}
+        self.result = self.results[self.horizons[0]]
+        self.convergence = None
+
+        unknown = set(ci_targets or {}) - set(_CI_ITEMS)
+        if unknown:
+            raise KeyError(f'ci_targetsに指定できない項目: {sorted(unknown)} 指定できるのは{_CI_ITEMS}')
+
+        done = 0
+        while True:
+            for ret, dd, ruin in self._montecarlo_a_year(sim_times, n_jobs, chunk_size):
+                for i, h in enumerate(self.horizons):
+                    self.results[h].update(ret[i], dd[i], ruin[i])
+            done += sim_times
+
+            if ci_targets is None:
+                break
+            intervals = self.confidence_intervals(confidence).loc[list(ci_targets)]
+            intervals['target'] = pd.Series(ci_targets)
+            converged = bool((intervals['width'] <= intervals['target']).all())
+            self.convergence = {
+                    'Sim Times': done,
+                    'Converged': converged,
+                    'Intervals': intervals,
+                    }
+            if converged or done + sim_times > max_sim_times:
+                break
+
+    @property
+    def ret_list(self) -> list[float] | None:
+        return getattr(self.result, 'ret_list', None)
+
+    @property
+    def dd_list(self) -> list[float] | None:
+        return getattr(self.result, 'dd_list', None)
+
+    @property
+    def ruin_list(self) -> list[bool] | None:
+        return getattr(self.result, 'ruin_list', None)
+
+    def summary(self, horizon: float | None = None) -> pd.Series | pd.DataFrame:
+        """シミュレーション結果の要約統計量を返す
 
         Args:
-            sim_times: シミュレーションの回数 多いほど集計結果が信頼できるが、時間がかかる
+            horizon: 期間[年] Noneのときは期間が1つならSeries、複数ならDataFrameで返す
+
+        Returns:
+            リターンとドロップダウンの分位点、破産確率、シミュレーション回数
 
         """
-        self.ret_list = []
-        self.dd_list = []
-        self.ruin_list = []
-        for i in tqdm(range(sim_times)):
-            ret, dd, has_ruin = self._montecarlo_a_year()
-            self.ret_list.append(ret)
-            self.dd_list.append(dd)
-            self.ruin_list.append(has_ruin)
+        if horizon is not None:
+            return self.results[horizon].summary()
+        if len(self.horizons) == 1:
+            return self.result.summary()
+        return pd.DataFrame(
+                {h: self.results[h].summary() for h in self.horizons}).T.rename_axis('Horizon')
+
+    def confidence_intervals(
+            self,
+            confidence: float = 0.95,
+            horizon: float | None = None,
+            ) -> pd.DataFrame:
+        """破産確率とメジアンの信頼区間を返す
+
+        破産確率はWilsonの区間、メジアンは順序統計量による分布によらない区間で求める
 
-    def make_report_graph(self, filename: str) -> None:
+        Args:
+            confidence: 信頼水準
+            horizon: 期間[年] Noneのときは最初の期間
+
+        Returns:
+            項目ごとの信頼区間の下限、上限、幅
+
+        """
+        result = self.result if horizon is None else self.results[horizon]
+        n = result.sim_times
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        p = result.ruin_count / n
+        center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+        half = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+
+        # メジアンの信頼区間は順位がn/2 ± z√n/2の順序統計量になる
+        q_lo = max(0.5 - z / (2 * np.sqrt(n)), 0)
+        q_hi = min(0.5 + z / (2 * np.sqrt(n)), 1)
+        intervals = pd.DataFrame({
+            'Ruin Rate': (center - half, center + half),
+            'Return 50%': (result.quantile('ret', q_lo), result.quantile('ret', q_hi)),
+            'Max. Drawdown 50%': (result.quantile('dd', q_lo), result.quantile('dd', q_hi)),
+            }, index=['lower', 'upper']).T
+        intervals['width'] = intervals['upper'] - intervals['lower']
+        return intervals
+
+    def make_report_graph(self, filename: str, compact: bool = False) -> None:
         """モンテカルロテストのレポートグラフを作成する
 
-        runメソッド後にできるリターンリスト、ドロップダウンリストから、
+        runメソッド後にできるリターンリスト、ドロップダウンリスト
+        (streamingのときはMontecarloAccumulator)から、
         ヒストグラムとメジアンを計算し、プロットする
+        期間が複数あるときは、期間ごとに1行ずつ並べる
         プロットはhtmlファイルを出力する
         リターンとドロップダウンのメジアンの比率は1.5以上はほしい
 
         Args:
             filename: 出力するグラフのファイル名
+            compact: データを別ファイルに分けた小さなhtmlで保存する 詳しくはsave_compact
+
+        """
+        from bokeh.plotting import save, output_file
+        from bokeh.layouts import gridplot
+
+        figs = []
+        for h in self.horizons:
+            result = self.results[h]
+            prefix = f'{h}年 ' if len(self.horizons) > 1 else ''
+            ret50 = result.quantile('ret', 0.5)
+            dd50 = result.quantile('dd', 0.5)
+            figs.append(_make_hist(
+                *result.histogram('ret', 50), f'{prefix}リターンメジアン:{ret50:.3f}'))
+            figs.append(_make_hist(
+                *result.histogram('dd', 50), f'{prefix}最大ドロップダウンメジアン:{dd50:.3f}'))
+        layout = gridplot(figs, sizing_mode='stretch_width', height=400, ncols=2)
+        if compact:
+            save_compact(layout, filename)
+            return
+        output_file(filename)
+        save(layout)
+
+
+class GroupedMontecarlo:
+    """トレード履歴をグループに分け、まとめてモンテカルロテストを行うクラス
+
+    戦略ごと、ウォークフォワードの期間ごと、業種ごとなどにトレード履歴を分け、
+    すべてのグループを1回の計算でシミュレートする。
+    トレードの無作為抽出には全グループで同じ乱数を使うため、
+    グループ間の差が乱数のばらつきに埋もれにくい。
+
+    Args:
+        trades: トレード履歴
+        by: グループ分けに使う列名 Strategy、name、legendなど
+        init_assets: 初期資産
+        ruin_point: 破産とする資産の閾値
+        seed: ランダム値を再現するための設定
+
+    Attributes:
+        by(list[str]): グループ分けに使う列名
+        groups(list): グループ名のリスト
+        horizons(list[float]): シミュレーションの期間[年]のリスト
+        results(dict): (グループ名, 期間)ごとの集計結果
+
+    """
+
+    def __init__(
+            self,
+            trades: pd.DataFrame,
+            by: str | list[str],
+            init_assets: float,
+            ruin_point: float,
+            seed: int = 2022
+            ) -> None:
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.by = [by] if isinstance(by, str) else list(by)
+        self.init_assets = init_assets
+        self.ruin_point = ruin_point
+        self.horizons = [1]
+
+        self.groups = []
+        self._arrays = []
+        for key, group in trades.groupby(self.by if len(self.by) > 1 else self.by[0]):
+            self.groups.append(key)
+            self._arrays.append((
+                group['ReturnPct'].to_numpy(dtype='float'),
+                pd.to_timedelta(group['Duration']).to_numpy().astype('int64'),
+                ))
+
+    def run(
+            self,
+            sim_times: int = 1500,
+            n_jobs: int | None = 1,
+            chunk_size: int = 10_000,
+            streaming: bool = False,
+            horizons: Sequence[float] = (1,),
+            ) -> None:
+        """すべてのグループのモンテカルロテストを所定回数行う
+
+        引数の意味はMontecarlo.runと同じ
+
+        Args:
+            sim_times: シミュレーションの回数
+            n_jobs: 計算に使うプロセス数 Noneのときはcpu数
+            chunk_size: 1プロセスに一度に割り当てるシミュレーションの回数
+            streaming: 結果をリストに保持せず、逐次集計する
+            horizons: シミュレーションの期間[年]のリスト
+
+        """
+        self.horizons = list(horizons)
+        recorder = MontecarloAccumulator if streaming else MontecarloRecorder
+        self.results = {
+                (g, h): recorder() for g in self.groups for h in self.horizons}
+
+        sizes = _chunk_sizes(sim_times, chunk_size)
+        tasks = [
+                (self._arrays, _horizons_ns(self.horizons),
+                 self.init_assets, self.ruin_point, size, seed_seq)
+                for size, seed_seq in zip(sizes, self.seed_seq.spawn(len(sizes)))
+                ]
+        for group_results in _map_chunks(_simulate_group_chunk, tasks, n_jobs):
+            for g, (ret, dd, ruin) in zip(self.groups, group_results):
+                for i, h in enumerate(self.horizons):
+                    self.results[(g, h)].update(ret[i], dd[i], ruin[i])
+
+    def summary(self) -> pd.DataFrame:
+        """グループと期間ごとの要約統計量を1行ずつ並べた表を返す
+
+        Returns:
+            グループ名の列、Horizon列と、Montecarlo.summaryの項目の列をもつ表
+
+        """
+        rows = []
+        for (g, h), result in self.results.items():
+            keys = g if isinstance(g, tuple) else (g,)
+            rows.append({
+                **dict(zip(self.by, keys)),
+                'Horizon': h,
+                **result.summary().to_dict(),
+                })
+        return pd.DataFrame(rows)
+
+    def make_report_graph(self, filename: str, compact: bool = False) -> None:
+        """グループを比較するレポートグラフを作成する
+
+        期間ごとに、リターンと最大ドロップダウンの度数分布をグループごとの線で重ねて描き、
+        その下に要約統計量の表を置く
+
+        Args:
+            filename: 出力するグラフのファイル名
+            compact: データを別ファイルに分けた小さなhtmlで保存する 詳しくはsave_compact
 
         """
-        ret50 = pd.Series(self.ret_list, dtype='float').median()
-        dd50 = pd.Series(self.dd_list, dtype='float').median()
-        p1 = _make_hist(self.ret_list, f'リターンメジアン:{ret50:.3f}', 50)
-        p2 = _make_hist(self.dd_list, f'最大ドロップダウンメジアン:{dd50:.3f}', 50)
+        from bokeh.plotting import save, figure, output_file
+        from bokeh.layouts import gridplot, column
+        from bokeh.models import ColumnDataSource, DataTable, TableColumn
+        from bokeh.palettes import Category10_10 as palette
+
+        figs = []
+        for h in self.horizons:
+            prefix = f'{h}年 ' if len(self.horizons) > 1 else ''
+            for kind, title in (('ret', 'リターン'), ('dd', '最大ドロップダウン')):
+                p = figure(
+                        title=f'{prefix}{title}',
+                        tools='pan,wheel_zoom,crosshair,save',
+                        background_fill_color='#fafafa',
+                        )
+                for i, g in enumerate(self.groups):
+                    hist, edges = self.results[(g, h)].histogram(kind, 50)
+                    p.line(
+                            (edges[:-1] + edges[1:]) / 2, hist,
+                            legend_label=str(g),
+                            line_width=3, alpha=0.8,
+                            color=palette[i % 10],
+                            )
+                p.legend.click_policy = 'hide'
+                figs.append(p)
+
+        summary = self.summary()
+        table = DataTable(
+                source=ColumnDataSource(summary.astype({'Horizon': str}).assign(
+                    **{str(c): summary[c].astype(str) for c in self.by})),
+                columns=[TableColumn(field=str(c), title=str(c)) for c in summary.columns],
+                sizing_mode='stretch_width',
+                height=25 * (len(summary) + 1),
+                )
+        layout = column(
+            gridplot(figs, sizing_mode='stretch_width', height=400, ncols=2),
+            table,
+            sizing_mode='stretch_width',
+            )
+        if compact:
+            save_compact(layout, filename)
+            return
         output_file(filename)
-        save(gridplot([p1, p2], sizing_mode='stretch_width', height=400, ncols=2))
+        save(layout)
 
 
-def _make_hist(lst: list[float], title: str, bins: int | None = 50) -> Figure:
+class MontecarloRecorder:
+    """モンテカルロテストの結果をすべて保持して集計する
+
+    Attributes:
+        ret_list(list[float]): シミュレーション結果 リターンのリスト
+        dd_list(list[float]): シミュレーション結果 ドローダウンのリスト
+        ruin_list(list[bool]): シミュレーション結果 破産したかのリスト
+
+    """
+
+    def __init__(self) -> None:
+        self.ret_list = []
+        self.dd_list = []
+        self.ruin_list = []
+
+    def update(self, ret: np.ndarray, dd: np.ndarray, ruin: np.ndarray) -> None:
+        """シミュレーション結果を加える
+
+        Args:
+            ret: 各パスのリターン
+            dd: 各パスの最大ドロップダウン
+            ruin: 各パスが破産したか
+
+        """
+        self.ret_list.extend(ret.tolist())
+        self.dd_list.extend(dd.tolist())
+        self.ruin_list.extend(ruin.tolist())
+
+    @property
+    def sim_times(self) -> int:
+        """シミュレーションの回数"""
+        return len(self.ret_list)
+
+    @property
+    def ruin_count(self) -> int:
+        """破産したシミュレーションの回数"""
+        return int(np.count_nonzero(self.ruin_list))
+
+    def quantile(self, kind: str, q: float) -> float:
+        """分位点を返す
+
+        Args:
+            kind: リターン('ret')かドロップダウン('dd')
+            q: 0から1の分位
+
+        """
+        return float(np.quantile(self._values(kind), q))
+
+    def histogram(self, kind: str, bins: int = 50) -> tuple[np.ndarray, np.ndarray]:
+        """密度のヒストグラムを返す
+
+        Args:
+            kind: リターン('ret')かドロップダウン('dd')
+            bins: ビン数
+
+        """
+        return np.histogram(self._values(kind), density=True, bins=bins)
+
+    def summary(self) -> pd.Series:
+        """要約統計量を返す"""
+        return _summary(self)
+
+    def _values(self, kind: str) -> np.ndarray:
+        return np.asarray(self.ret_list if kind == 'ret' else self.dd_list, dtype='float')
+
+
+class MontecarloAccumulator:
+    """モンテカルロテストの結果を一定のメモリで逐次集計する
+
+    シミュレーション結果を保持せず、分割ごとの結果を受け取るたびに
+    固定ビン数のヒストグラム、分位点のスケッチ、破産回数を更新する。
+
+    Args:
+        bins: 集計用ヒストグラムのビン数
+        compression: 分位点スケッチの圧縮度 大きいほど分位点が正確になる
+
+    Attributes:
+        sim_times(int): 集計したシミュレーションの回数
+        ruin_count(int): 破産したシミュレーションの回数
+        ret_hist(StreamingHistogram): リターンのヒストグラム
+        dd_hist(StreamingHistogram): 最大ドロップダウンのヒストグラム
+        ret_sketch(QuantileSketch): リターンの分位点スケッチ
+        dd_sketch(QuantileSketch): 最大ドロップダウンの分位点スケッチ
+
+    """
+
+    def __init__(self, bins: int = 1000, compression: int = 200) -> None:
+        self.sim_times = 0
+        self.ruin_count = 0
+        self.ret_hist = StreamingHistogram(bins)
+        self.dd_hist = StreamingHistogram(bins)
+        self.ret_sketch = QuantileSketch(compression)
+        self.dd_sketch = QuantileSketch(compression)
+
+    def update(self, ret: np.ndarray, dd: np.ndarray, ruin: np.ndarray) -> None:
+        """シミュレーション結果を集計に加える
+
+        Args:
+            ret: 各パスのリターン
+            dd: 各パスの最大ドロップダウン
+            ruin: 各パスが破産したか
+
+        """
+        self.sim_times += len(ret)
+        self.ruin_count += int(np.count_nonzero(ruin))
+        self.ret_hist.update(ret)
+        self.dd_hist.update(dd)
+        self.ret_sketch.update(ret)
+        self.dd_sketch.update(dd)
+
+    def quantile(self, kind: str, q: float) -> float:
+        """分位点のスケッチから分位点を返す
+
+        Args:
+            kind: リターン('ret')かドロップダウン('dd')
+            q: 0から1の分位
+
+        """
+        return (self.ret_sketch if kind == 'ret' else self.dd_sketch).quantile(q)
+
+    def histogram(self, kind: str, bins: int = 50) -> tuple[np.ndarray, np.ndarray]:
+        """集計用ヒストグラムからおよそbins個のビンの密度のヒストグラムを返す
+
+        Args:
+            kind: リターン('ret')かドロップダウン('dd')
+            bins: ビン数の目安
+
+        """
+        return (self.ret_hist if kind == 'ret' else self.dd_hist).histogram(bins)
+
+    def summary(self) -> pd.Series:
+        """集計結果の要約統計量を返す"""
+        return _summary(self)
+
+
+class StreamingHistogram:
+    """範囲を自動で広げる固定ビン数のヒストグラム
+
+    最初に受け取ったデータの範囲でビンを決め、範囲外のデータが来たら
+    隣り合うビンを2つずつ統合してビン幅を倍にし、範囲を広げる。
+    ビン数は変わらないため、メモリはデータ数によらない。
+
+    Args:
+        bins: ビン数(偶数)
+
+    """
+
+    def __init__(self, bins: int = 1000) -> None:
+        self.bins = bins + bins % 2
+        self.counts = np.zeros(self.bins, dtype='int64')
+        self.lo = None
+        self.width = None
+
+    def update(self, x: np.ndarray) -> None:
+        """データを加える
+
+        Args:
+            x: 加えるデータ
+
+        """
+        x = np.asarray(x, dtype='float')
+        if len(x) == 0:
+            return
+        x_min, x_max = x.min(), x.max()
+        if self.lo is None:
+            self.lo = x_min
+            self.width = max(x_max - x_min, 1e-12) * (1 + 1e-9) / self.bins
+
+        while x_min < self.lo or x_max >= self.lo + self.width * self.bins:
+            half = self.bins // 2
+            merged = self.counts.reshape(half, 2).sum(axis=1)
+            if x_min < self.lo:
+                self.counts = np.concatenate([np.zeros(half, dtype='int64'), merged])
+                self.lo -= self.width * self.bins
+            else:
+                self.counts = np.concatenate([merged, np.zeros(half, dtype='int64')])
+            self.width *= 2
+
+        i = ((x - self.lo) / self.width).astype(np.intp)
+        self.counts += np.bincount(np.clip(i, 0, self.bins - 1), minlength=self.bins)
+
+    def histogram(self, bins: int = 50) -> tuple[np.ndarray, np.ndarray]:
+        """データのある範囲をおよそbins個のビンにまとめた密度のヒストグラムを返す
+
+        Args:
+            bins: 出力するヒストグラムのビン数の目安
+
+        Returns:
+            np.histogram(density=True)と同じ形式の密度とビンの境界
+
+        """
+        nonzero = np.flatnonzero(self.counts)
+        first, last = nonzero[0], nonzero[-1] + 1
+        group = int(np.ceil((last - first) / bins))
+        counts = self.counts[first:last]
+        counts = np.pad(counts, (0, -len(counts) % group))
+        hist = counts.reshape(-1, group).sum(axis=1)
+        width = self.width * group
+        edges = self.lo + self.width * first + width * np.arange(len(hist) + 1)
+        return hist / (hist.sum() * width), edges
+
+
+class QuantileSketch:
+    """t-digestに倣った分位点のスケッチ
+
+    データを重み付きの重心にまとめて保持する。
+    分布の端ほど重心を細かく保つため、メジアンだけでなく裾の分位点も精度よく求まる。
+
+    Args:
+        compression: 圧縮度 保持する重心の数はこのおよそ半分になる
+
+    """
+
+    def __init__(self, compression: int = 200) -> None:
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, x: np.ndarray) -> None:
+        """データを加えて重心を圧縮し直す
+
+        Args:
+            x: 加えるデータ
+
+        """
+        x = np.asarray(x, dtype='float')
+        if len(x) == 0:
+            return
+        self.min = min(self.min, x.min())
+        self.max = max(self.max, x.max())
+
+        means = np.concatenate([self.means, x])
+        weights = np.concatenate([self.weights, np.ones(len(x))])
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+
+        # 累積の分位からスケール関数k(q)を求め、kの整数部が同じ重心をまとめる
+        cum = np.cumsum(weights)
+        q = (cum - weights / 2) / cum[-1]
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        group = np.floor(k - k[0]).astype(np.intp)
+        starts = np.flatnonzero(np.diff(group, prepend=-1))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q: float) -> float:
+        """分位点を返す
+
+        Args:
+            q: 0から1の分位
+
+        Returns:
+            分位点の推定値
+
+        """
+        if len(self.weights) == 0:
+            return np.nan
+        cum = np.cumsum(self.weights)
+        centers = cum - self.weights / 2
+        positions = np.concatenate([[0], centers, [cum[-1]]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * cum[-1], positions, values))
+
+
+def _summary(result: MontecarloRecorder | MontecarloAccumulator) -> pd.Series:
+    return pd.Series({
+        **{f'Return {q:.0%}': result.quantile('ret', q) for q in _SUMMARY_Q},
+        **{f'Max. Drawdown {q:.0%}': result.quantile('dd', q) for q in _SUMMARY_Q},
+        'Ruin Rate': result.ruin_count / result.sim_times,
+        'Sim Times': result.sim_times,
+        })
+
+
+def _simulate_paths(
+        returns: np.ndarray,
+        durations: np.ndarray,
+        horizons: np.ndarray,
+        init_assets: float,
+        ruin_point: float,
+        sim_times: int,
+        rng: np.random.Generator,
+        uniforms: _UniformStream | None = None,
+        ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """トレードを無作為抽出して資産の推移をシミュレートする
+
+    保有期間の合計が最長の期間に達するまでトレードを抽出する。
+    必要な抽出回数はパスごとに異なるため、平均保有期間から見積もった列数で抽出し、
+    足りないパスがあれば列を追加する。期間に達した後のトレードは資産を変化させない。
+    各期間の結果は、保有期間の合計がその期間に達したトレードの時点の値をとる。
+
+    Args:
+        returns: トレードのリターン比率
+        durations: トレードの保有期間[ns]
+        horizons: シミュレートする期間[ns]の配列
+        init_assets: 初期資産
+        ruin_point: 破産とする資産の閾値
+        sim_times: シミュレーションの回数
+        rng: 乱数生成器
+        uniforms: 抽出に使う[0, 1)の一様乱数の列 複数のトレード履歴で
+            同じ乱数を共有するときに指定する Noneのときはrngから生成する
+
+    Returns:
+        各パスのリターン, 最大ドロップダウン, 破産したかのブール値
+        それぞれ(期間の数 x シミュレーションの回数)の配列
+
+    """
+    num_trades = len(returns)
+    mean_duration = durations.mean() if num_trades else 0
+    if mean_duration <= 0:
+        raise ValueError('保有期間が0のトレードだけではシミュレートできない')
+
+    horizon = horizons.max()
+    steps = _estimate_steps(horizon, mean_duration)
+    if uniforms is None:
+        uniforms = _UniformStream(rng, sim_times)
+    idx = (uniforms.take(steps) * num_trades).astype(np.intp)
+    sum_duration = np.cumsum(durations[idx], axis=1)
+    while not (sum_duration[:, -1] >= horizon).all():
+        n_cols = idx.shape[1]
+        add = (uniforms.take(n_cols + steps)[:, n_cols:] * num_trades).astype(np.intp)
+        idx = np.hstack([idx, add])
+        sum_duration = np.hstack([
+            sum_duration,
+            sum_duration[:, -1:] + np.cumsum(durations[add], axis=1),
+            ])
+
+    # 保有期間の合計が期間に達したトレードまでを採用する
+    stop = np.argmax(sum_duration >= horizon, axis=1)
+    active = np.arange(idx.shape[1]) <= stop[:, np.newaxis]
+    growth = np.where(active, 1.0 + returns[idx], 1.0)
+
+    asset_hist = np.empty((sim_times, idx.shape[1] + 1))
+    asset_hist[:, 0] = init_assets
+    asset_hist[:, 1:] = init_assets * np.cumprod(growth, axis=1)
+    dd_hist = np.minimum.accumulate(
+            asset_hist / np.maximum.accumulate(asset_hist, axis=1) - 1, axis=1)
+    min_hist = np.minimum.accumulate(asset_hist, axis=1)
+
+    # 各期間に達したトレードの直後(asset_histでは1列後)の値を取り出す
+    rows = np.arange(sim_times)
+    cols = np.stack([np.argmax(sum_duration >= h, axis=1) + 1 for h in horizons])
+    ret = asset_hist[rows, cols] / init_assets - 1.0
+    max_dd = dd_hist[rows, cols]
+    has_ruin = min_hist[rows, cols] < ruin_point
+    return ret, max_dd, has_ruin
+
+
+def _simulate_chunk(task: tuple) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    *args, seed_seq = task
+    return _simulate_paths(*args, np.random.default_rng(seed_seq))
+
+
+def _simulate_group_chunk(task: tuple) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    groups, horizons, init_assets, ruin_point, sim_times, seed_seq = task
+    rng = np.random.default_rng(seed_seq)
+    # すべてのグループで同じ一様乱数を使い、グループ間の比較のばらつきを抑える
+    steps = max(
+            _estimate_steps(horizons.max(), durations.mean())
+            for _, durations in groups)
+    uniforms = _UniformStream(rng, sim_times)
+    uniforms.take(steps)
+    return [
+            _simulate_paths(
+                returns, durations, horizons, init_assets, ruin_point,
+                sim_times, rng, uniforms)
+            for returns, durations in groups]
+
+
+class _UniformStream:
+    """パスごとの[0, 1)の一様乱数の列
+
+    必要な列数が増えたときはrngから列を追加する。
+    複数のトレード履歴で共有すると、どのトレード履歴もj番目の抽出に同じ乱数を使う。
+
+    Args:
+        rng: 乱数生成器
+        sim_times: シミュレーションの回数(行数)
+
+    """
+
+    def __init__(self, rng: np.random.Generator, sim_times: int) -> None:
+        self.rng = rng
+        self.values = np.empty((sim_times, 0))
+
+    def take(self, stop: int) -> np.ndarray:
+        """先頭からstop列の乱数を返す 足りない列は追加する"""
+        if self.values.shape[1] < stop:
+            add = self.rng.random((len(self.values), stop - self.values.shape[1]))
+            self.values = np.hstack([self.values, add])
+        return self.values[:, :stop]
+
+
+def _estimate_steps(horizon: int, mean_duration: float) -> int:
+    return int(np.ceil(horizon / mean_duration * 1.2)) + 1 if mean_duration > 0 else 1
+
+
+def _horizons_ns(horizons: Sequence[float]) -> np.ndarray:
+    return np.array([_YEAR * h for h in horizons], dtype='int64')
+
+
+def _chunk_sizes(sim_times: int, chunk_size: int) -> list[int]:
+    sizes = [chunk_size] * (sim_times // chunk_size)
+    if sim_times % chunk_size:
+        sizes.append(sim_times % chunk_size)
+    return sizes
+
+
+def _map_chunks(func: Callable, tasks: list[tuple], n_jobs: int | None) -> Iterator:
+    """分割したシミュレーションを順番通りに計算する n_jobsが2以上ならマルチプロセスで計算する"""
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield func(task)
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as executor:
+            yield from executor.map(func, tasks)
+
+
+def _make_hist(hist: np.ndarray, edges: np.ndarray, title: str) -> Figure:
     """度数分布と累積度数分布を出力する
 
     Args:
-        lst: モンテカルロテストで得られたリターンやドロップダウンのリストを入力
+        hist: モンテカルロテストで得られたリターンやドロップダウンの度数(密度)
+        edges: ヒストグラムのビンの境界
         title: メジアンをタイトルにすると、結果がひと目でわかる
-        bins: ヒストグラムのビン数
 
     Returns:
         bokehのFigureを返す これを返却先でsaveする
 
     """
-    hist, edges = np.histogram(lst, density=True, bins=bins)
-    cum = np.cumsum(hist) * (edges[1] - edges[0])
+    from bokeh.plotting import figure
+    from bokeh.models import ColumnDataSource, CustomJS, Range1d, LinearAxis
+    from bokeh.models import HoverTool
+    from bokeh.events import DoubleTap
+
+    cum = np.cumsum(hist * np.diff(edges))
     source = ColumnDataSource(
             {'hist': hist, 'cum': cum, 'left': edges[:-1], 'right': edges[1:]}
             )
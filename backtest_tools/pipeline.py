@@ -0,0 +1,305 @@
+"""設定ファイルに書いたバックテストの一連の処理を、段階ごとにキャッシュしながら実行する
+
+段階(stage)は次の順に実行する
+
+* universe: 対象銘柄の価格データを読み込む
+* backtest: 戦略でバックテスト(またはウォークフォワードテスト)を行いトレード履歴を得る
+* montecarlo: トレード履歴でモンテカルロテストを行う
+* report: 散布図、モンテカルロテストのグラフ、銘柄ごとのチャートを出力する
+
+各段階は、その段階の設定と前の段階の出力の指紋が前回と同じなら、
+キャッシュした出力を使い、計算をやり直さない。
+universeだけは価格データをキャッシュに複製しないよう毎回読み込み、
+読み込んだデータから求めた指紋を後の段階の指紋に使う。
+
+設定ファイルはjsonで、次のように書く::
+
+    {
+        "strategy": "my_strategies:EmaCross",
+        "universe": {"filter": {"市場・商品区分": ["プライム（内国株式）"]}, "head": 100},
+        "walkforward": {"in_period": 3, "out_period": 1,
+                        "optimize_params": {"n1": [10, 20], "n2": [40, 60]}},
+        "montecarlo": {"init_assets": 1000000, "ruin_point": 800000, "sim_times": 5000},
+        "outputs": {"dir": "outputs", "charts": true},
+        "cache_dir": ".pipeline_cache"
+    }
+
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import importlib
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+_DEFAULT_CACHE_DIR = '.pipeline_cache'
+
+
+def load_config(path: str | Path) -> dict:
+    """設定ファイルを読み込む
+
+    Args:
+        path: jsonの設定ファイルのパス
+
+    設定ファイルのディレクトリをsys.pathに加え、隣に置いた戦略のモジュールを読み込めるようにする
+
+    Returns:
+        設定 相対パスは設定ファイルのディレクトリを基準にしている
+
+    """
+    path = Path(path)
+    with path.open(encoding='utf-8') as f:
+        config = json.load(f)
+    base = path.parent
+    if str(base.resolve()) not in sys.path:
+        sys.path.insert(0, str(base.resolve()))
+    config['cache_dir'] = str(base.joinpath(config.get('cache_dir', _DEFAULT_CACHE_DIR)))
+    outputs = config.setdefault('outputs', {})
+    outputs['dir'] = str(base.joinpath(outputs.get('dir', 'outputs')))
+    if 'cache' in config.get('universe', {}):
+        config['universe']['cache'] = str(base.joinpath(config['universe']['cache']))
+    return config
+
+
+def load_strategy(path: str) -> type:
+    """'モジュール名:クラス名'の形式で指定した戦略クラスを読み込む
+
+    Args:
+        path: 戦略クラスの場所 例えば'my_strategies:EmaCross'
+
+    Returns:
+        戦略クラス
+
+    """
+    module_name, _, class_name = path.partition(':')
+    if not class_name:
+        raise ValueError(f"戦略は'モジュール名:クラス名'で指定する: {path}")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class Pipeline:
+    """設定にしたがって、段階ごとにキャッシュしながらバックテストの一連の処理を実行する
+
+    Args:
+        config: 設定 詳しくはモジュールの説明を参照
+        force: キャッシュを使わずにすべての段階をやり直す
+
+    Attributes:
+        outputs(dict): 段階名ごとの出力
+        timings(dict): 段階名ごとにかかった秒数
+        cached(dict): 段階名ごとの、キャッシュを使ったかどうか
+
+    """
+
+    def __init__(self, config: dict, force: bool = False) -> None:
+        self.config = config
+        self.force = force
+        self.cache_dir = Path(config.get('cache_dir', _DEFAULT_CACHE_DIR))
+        self.outputs = {}
+        self.timings = {}
+        self.cached = {}
+        self._digests = {}
+
+    def run(self) -> dict:
+        """すべての段階を順に実行する
+
+        Returns:
+            段階名ごとの出力
+
+        """
+        for name, func, deps, sections, data_digest in STAGES:
+            self._run_stage(name, func, deps, sections, data_digest)
+        return self.outputs
+
+    def _run_stage(
+            self,
+            name: str,
+            func: Callable,
+            deps: tuple[str, ...],
+            sections: tuple[str, ...],
+            data_digest: Callable | None = None,
+            ) -> None:
+        start = time.perf_counter()
+        if data_digest is not None:
+            # 出力はキャッシュせず、出力から求めた指紋だけを後の段階に渡す
+            output, _ = func(self.config, *[self.outputs[d] for d in deps])
+            self.outputs[name] = output
+            self._digests[name] = data_digest(output)
+            self.cached[name] = False
+            self.timings[name] = time.perf_counter() - start
+            return
+
+        key = _digest((
+            name,
+            json.dumps({s: self.config.get(s) for s in sections},
+                       sort_keys=True, ensure_ascii=False, default=str),
+            [self._digests[d] for d in deps],
+            _external_inputs(name, self.config),
+            ))
+
+        cache_file = self.cache_dir.joinpath(f'{name}.pkl')
+        cache = None
+        if not self.force and cache_file.exists():
+            with cache_file.open('rb') as p:
+                cache = pickle.load(p)
+            # 出力ファイルを書く段階は、ファイルが消されていたらやり直す
+            if cache['key'] != key or not all(Path(f).exists() for f in cache['files']):
+                cache = None
+
+        if cache is None:
+            output, files = func(self.config, *[self.outputs[d] for d in deps])
+            cache = {'key': key, 'digest': _digest(output), 'output': output, 'files': files}
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with cache_file.open('wb') as p:
+                pickle.dump(cache, p)
+            self.cached[name] = False
+        else:
+            self.cached[name] = True
+
+        self.outputs[name] = cache['output']
+        self._digests[name] = cache['digest']
+        self.timings[name] = time.perf_counter() - start
+
+    def timing_table(self) -> pd.DataFrame:
+        """段階ごとにかかった秒数と、キャッシュを使ったかどうかを表にする"""
+        return pd.DataFrame({
+            'Seconds': pd.Series(self.timings),
+            'Cached': pd.Series(self.cached),
+            }).rename_axis('Stage')
+
+
+def _digest(obj) -> str:
+    return hashlib.sha1(pickle.dumps(obj, protocol=4)).hexdigest()
+
+
+def _data_digest(data_name_tpl_lst: list[tuple[pd.DataFrame, str]]) -> str:
+    """価格データの指紋 データ全体をpickleせず、pandasのハッシュから求める"""
+    h = hashlib.sha1()
+    for data, name in data_name_tpl_lst:
+        h.update(str(name).encode())
+        h.update(pd.util.hash_pandas_object(data).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def _external_inputs(name: str, config: dict) -> list:
+    """設定以外で段階の結果を変えるもの(戦略のソース)を指紋にする"""
+    if name == 'backtest':
+        return inspect.getsource(load_strategy(config['strategy']))
+    return []
+
+
+def _universe_stage(config: dict) -> tuple[list[tuple[pd.DataFrame, str]], list]:
+    from .code_list import CodeList
+    from .read_zip_data import set_multiple_data_from_codes, read_cache_data
+
+    universe = config.get('universe', {})
+    if 'cache' in universe:
+        data_name_tpl_lst = read_cache_data(Path(universe['cache']))
+        if 'codes' in universe:
+            codes = set(map(str, universe['codes']))
+            data_name_tpl_lst = [t for t in data_name_tpl_lst if str(t[1]) in codes]
+    else:
+        if 'codes' in universe:
+            codes = [str(c) for c in universe['codes']]
+        else:
+            code_list = CodeList().read()
+            for col, values in universe.get('filter', {}).items():
+                code_list = code_list[code_list[col].isin(values)]
+            codes = code_list['コード'].tolist()
+        data_name_tpl_lst = set_multiple_data_from_codes(codes)
+
+    if 'head' in universe:
+        data_name_tpl_lst = data_name_tpl_lst[:universe['head']]
+    return data_name_tpl_lst, []
+
+
+def _backtest_stage(
+        config: dict,
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        ) -> tuple[pd.DataFrame, list]:
+    from .backtest import backtest_for_multiple_data, walkforward_for_multiple_data
+
+    strategy = load_strategy(config['strategy'])
+    wf = config.get('walkforward')
+    if wf is None:
+        return backtest_for_multiple_data(data_name_tpl_lst, strategy), []
+
+    _, trades = walkforward_for_multiple_data(
+            data_name_tpl_lst, strategy, wf['in_period'], wf['out_period'],
+            optimize_params=wf['optimize_params'],
+            )
+    return trades, []
+
+
+def _montecarlo_stage(config: dict, trades: pd.DataFrame) -> tuple[pd.DataFrame | None, list]:
+    from .montecarlo import Montecarlo
+
+    params = config.get('montecarlo')
+    if params is None or trades.empty:
+        return None, []
+    params = dict(params)
+    mont = Montecarlo(
+            trades, params.pop('init_assets'), params.pop('ruin_point'),
+            seed=params.pop('seed', 2022),
+            )
+    mont.run(**params)
+    return mont, []
+
+
+def _report_stage(
+        config: dict,
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        trades: pd.DataFrame,
+        mont,
+        ) -> tuple[None, list[str]]:
+    from .plottings import PlotTradeResults
+    from .report import build_report
+
+    outputs = config['outputs']
+    out_dir = Path(outputs['dir'])
+    out_dir.mkdir(parents=True, exist_ok=True)
+    compact = outputs.get('compact', False)
+    files = []
+
+    if not trades.empty:
+        filename = out_dir.joinpath('scatter.html')
+        plot = PlotTradeResults(
+                title=config['strategy'], max_points=outputs.get('max_points'))
+        legend = 'Strategy' if 'Strategy' in trades.columns else None
+        for key, trade in (trades.groupby(legend) if legend else [('all', trades)]):
+            plot.add_record(trade.copy(), str(key))
+        plot.save(str(filename), compact=compact)
+        files.append(str(filename))
+
+    if mont is not None:
+        filename = out_dir.joinpath('montecarlo.html')
+        mont.make_report_graph(str(filename), compact=compact)
+        files.append(str(filename))
+
+    if outputs.get('charts', False):
+        report_file = out_dir.joinpath('report.html')
+        build_report(
+                data_name_tpl_lst, trades, out_dir.joinpath('charts'), report_file,
+                max_bars=outputs.get('max_bars'), compact=compact,
+                )
+        files.append(str(report_file))
+    return None, files
+
+
+# 段階名、処理、入力に使う前の段階、指紋に含める設定の項目、
+# 出力をキャッシュしない段階の、出力から指紋を求める関数
+STAGES = [
+        ('universe', _universe_stage, (), ('universe',), _data_digest),
+        ('backtest', _backtest_stage, ('universe',), ('strategy', 'walkforward'), None),
+        ('montecarlo', _montecarlo_stage, ('backtest',), ('montecarlo',), None),
+        ('report', _report_stage, ('universe', 'backtest', 'montecarlo'),
+         ('strategy', 'outputs'), None),
+        ]
@@ -1,47 +1,54 @@
 from __future__ import annotations
 
 from datetime import date
+from typing import TYPE_CHECKING
 
 import pandas as pd
 import numpy as np
 
-from bokeh.plotting import figure, save, output_file
-from bokeh.layouts import gridplot
-from bokeh.models import ColumnDataSource, CDSView, CustomJS
-from bokeh.models import HoverTool, Span, BoxAnnotation
-from bokeh.models import GroupFilter
-from bokeh.models import NumeralTickFormatter
-from bokeh.models import Model
-from bokeh.events import DoubleTap
-from bokeh.palettes import Category10_10 as palette
+from .compact_html import save_compact
 
-from backtesting import Backtest, Strategy
+# bokehとbacktesting.pyは使うときに読み込む 理由はbacktest.pyの冒頭を参照
+if TYPE_CHECKING:
+    from bokeh.models import GlyphRenderer
+    from bokeh.plotting.figure import Figure
+    from backtesting import Strategy
 
 
 class StackCharts:
+    """複数のローソク足チャートを縦に積み重ねて1つのhtmlにする
+
+    Attributes:
+        fig: 追加したチャートのfigureのリスト
+
+    """
 
     def __init__(self):
         self.fig = []
 
     def add(self,
             data: pd.DataFrame,
-            strategy: Strategy,
+            strategy: Strategy | None = None,
             title: str | None = None,
-            hatch_range: tuple[date | None, date | None] = (None, None)
+            hatch_range: tuple[date | None, date | None] = (None, None),
+            max_bars: int | None = None,
             ):
-        strategy.next = lambda self: False
+        """ローソク足チャートを追加する
 
-        bt = Backtest(data, strategy)
-        bt.run()
+        バックテストを実行せず、価格データから直接ローソク足だけを描画する
 
-        fig = bt.plot(superimpose=False, open_browser=False)
-        for model in fig.select({'type': Model}):
-            prev_doc = model.document
-            model._document = None
-            if prev_doc:
-                prev_doc.remove_root(model)
+        Args:
+            data: 日々の価格データ
+            strategy: 互換性のために残している 使用しない
+            title: チャートのタイトル
+            hatch_range: 色付けする期間の開始日と終了日
+            max_bars: 描画するローソク足の最大数 超える場合は複数の足をまとめて間引く
+
+        """
+        from bokeh.models import CustomJS, BoxAnnotation
+        from bokeh.events import DoubleTap
 
-        fig_ohlc = fig.children[0].children[0][0]
+        fig_ohlc, index = _ohlc_figure(data, max_bars)
         fig_ohlc.height = 200
         fig_ohlc.js_on_event(DoubleTap, CustomJS(
             args=dict(p=fig_ohlc), code='p.reset.emit()'
@@ -49,20 +56,118 @@ class StackCharts:
         if hatch_range[0] is not None:
             fig_ohlc.add_layout(
                     BoxAnnotation(
-                        left=bt._data.index.get_indexer(
-                            [hatch_range[0]], method='nearest')[0],
-                        right=bt._data.index.get_indexer(
-                            [hatch_range[1]], method='nearest')[0],
+                        left=index.get_indexer([hatch_range[0]], method='nearest')[0],
+                        right=index.get_indexer([hatch_range[1]], method='nearest')[0],
                         fill_color='red',
                         fill_alpha=0.1,
                         )
                     )
         fig_ohlc.title = title
-        self.fig.append(fig)
+        self.fig.append(fig_ohlc)
 
-    def save(self, filename):
+    def save(self, filename: str, compact: bool = False):
+        """チャートを保存する
+
+        Args:
+            filename: 出力するファイル名
+            compact: データを別ファイルに分けた小さなhtmlで保存する 詳しくはsave_compact
+
+        """
+        from bokeh.plotting import save, output_file
+        from bokeh.layouts import gridplot
+
+        layout = gridplot(self.fig, sizing_mode='stretch_width', ncols=1)
+        if compact:
+            save_compact(layout, filename)
+            return
         output_file(filename)
-        save(gridplot(self.fig, sizing_mode='stretch_width', ncols=1))
+        save(layout)
+
+
+def _decimate_ohlc(data: pd.DataFrame, max_bars: int) -> pd.DataFrame:
+    """連続するローソク足をまとめて、本数をmax_bars以下にする"""
+    step = int(np.ceil(len(data) / max_bars))
+    group = np.arange(len(data)) // step
+    decimated = data.groupby(group).agg({
+        'Open': 'first',
+        'High': 'max',
+        'Low': 'min',
+        'Close': 'last',
+        'Volume': 'sum',
+        })
+    decimated.index = data.index[::step]
+    return decimated
+
+
+def _ohlc_figure(
+        data: pd.DataFrame,
+        max_bars: int | None = None,
+        ) -> tuple[Figure, pd.DatetimeIndex]:
+    """価格データからローソク足だけのfigureを作る
+
+    backtesting.pyのプロットと同じく、横軸は日付ではなく足の番号にして休日の隙間をなくす
+
+    Args:
+        data: 日々の価格データ
+        max_bars: 描画するローソク足の最大数
+
+    Returns:
+        ローソク足のfigureと、足の番号に対応する日付
+
+    """
+    from bokeh.plotting import figure
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.models import NumeralTickFormatter, FuncTickFormatter, Range1d
+    from bokeh.transform import linear_cmap
+
+    if max_bars is not None and len(data) > max_bars:
+        data = _decimate_ohlc(data, max_bars)
+
+    # 文字列や64bit整数の列はhtmlにリストで書き出されて大きくなるので、小さい整数型にする
+    source = ColumnDataSource({
+        'index': np.arange(len(data), dtype='int32'),
+        'datetime': data.index,
+        'Open': data['Open'].to_numpy(),
+        'High': data['High'].to_numpy(),
+        'Low': data['Low'].to_numpy(),
+        'Close': data['Close'].to_numpy(),
+        'inc': (data['Close'] >= data['Open']).to_numpy(dtype='uint8'),
+        })
+
+    pad = max(len(data) / 20, 1)
+    fig = figure(
+            x_range=Range1d(-1, len(data), bounds=(-pad, len(data) + pad)),
+            tools='xpan,xwheel_zoom,box_zoom,reset,save',
+            active_drag='xpan',
+            active_scroll='xwheel_zoom',
+            )
+    fig.xaxis.formatter = FuncTickFormatter(
+            args=dict(source=source),
+            code="""
+            const t = source.data.datetime[tick];
+            return t === undefined ? '' : new Date(t).toISOString().slice(0, 10);
+            """)
+    fig.yaxis.formatter = NumeralTickFormatter(format='0,0.[00]')
+
+    fig.segment('index', 'High', 'index', 'Low', source=source, color='black')
+    ohlc_bars = fig.vbar(
+            'index', 0.8, 'Open', 'Close', source=source,
+            line_color='black',
+            fill_color=linear_cmap('inc', ['tomato', 'lime'], 0, 1),
+            )
+    fig.add_tools(HoverTool(
+        tooltips=[
+            ('日付', '@datetime{%F}'),
+            ('始値', '@Open{0,0.[00]}'),
+            ('高値', '@High{0,0.[00]}'),
+            ('安値', '@Low{0,0.[00]}'),
+            ('終値', '@Close{0,0.[00]}'),
+            ],
+        formatters={'@datetime': 'datetime'},
+        mode='vline',
+        renderers=[ohlc_bars],
+        ))
+    return fig, data.index
 
 
 class PlotTradeResults:
@@ -77,9 +182,14 @@ class PlotTradeResults:
     Args:
         title: プロットのタイトル
         bins: サイドにおいた度数分布のビン数
+        max_points: 散布図に点で描くトレード数の上限 これを超える凡例は
+            2次元の度数分布で描く Noneのときはすべて点で描く
+        density_bins: 2次元の度数分布の各軸のビン数
 
     Attributes:
         bins: 度数分布のビン数
+        max_points: 凡例ごとに点で描くトレード数の上限
+        density_bins: 2次元の度数分布の各軸のビン数
         p: 散布図用のfigure
         ph: 保持期間の度数分布用のfigure
         pv: リターンの度数分布用のfigure
@@ -87,8 +197,21 @@ class PlotTradeResults:
 
     """
 
-    def __init__(self, title: str, bins: int = 20) -> None:
+    def __init__(
+            self,
+            title: str,
+            bins: int = 20,
+            max_points: int | None = None,
+            density_bins: int = 50,
+            ) -> None:
+        from bokeh.plotting import figure
+        from bokeh.models import CustomJS, HoverTool, Span
+        from bokeh.models import NumeralTickFormatter
+        from bokeh.events import DoubleTap
+
         self.bins = bins
+        self.max_points = max_points
+        self.density_bins = density_bins
         self.p = figure(
                 title=title,
                 tools='pan,wheel_zoom,crosshair',
@@ -148,7 +271,8 @@ class PlotTradeResults:
                     code='p.reset.emit(); pv.reset.emit(); ph.reset.emit();')
                 )
 
-        self.df_trades = None
+        self._df_trades = None
+        self._records = []
 
     def add_record(self, trades: pd.DataFrame, legend: str) -> None:
         """トレード履歴を追加する
@@ -161,61 +285,94 @@ class PlotTradeResults:
         trades['legend'] = legend
         # trades['Duration'] = trades['Duration'].dt.days
         trades['DurationBars'] = trades['ExitBar'] - trades['EntryBar']
-        self.df_trades = pd.concat([
-            self.df_trades,
-            trades,
-            ])
+        # 追加のたびに連結すると全体のコピーが繰り返されるので、参照時にまとめて連結する
+        self._records.append(trades)
 
-    def _plot(self, legend_col: str = 'legend') -> None:
-        legends = self.df_trades[legend_col].unique()
+    @property
+    def df_trades(self) -> pd.DataFrame | None:
+        """追加したすべてのトレード履歴"""
+        if self._records:
+            self._df_trades = pd.concat([self._df_trades, *self._records])
+            self._records = []
+        return self._df_trades
 
-        scatter_source = ColumnDataSource(self.df_trades)
-        h_df = self._set_hist_source(self.df_trades['DurationBars'], legend_col)
-        v_df = self._set_hist_source(self.df_trades['ReturnPct'], legend_col)
+    def _plot(self, legend_col: str = 'legend') -> None:
+        from bokeh.models import ColumnDataSource, CDSView, CustomJS
+        from bokeh.models import HoverTool, GroupFilter
+        from bokeh.palettes import Category10_10 as palette
 
+        legends = self.df_trades[legend_col].unique()
+        counts = self.df_trades[legend_col].value_counts()
+        if self.max_points is None:
+            dense = set()
+        else:
+            dense = set(counts.index[counts > self.max_points])
+
+        # 散布図には点で描く凡例の、ホバーに使う列だけを渡す
+        sparse_trades = self.df_trades[~self.df_trades[legend_col].isin(dense)]
+        scatter_source = ColumnDataSource(sparse_trades[[
+            'EntryTime', 'DurationBars', 'ReturnPct', legend_col]])
+        h_x, h_hist = self._set_hist_source(self.df_trades['DurationBars'], legend_col)
+        v_x, v_hist = self._set_hist_source(self.df_trades['ReturnPct'], legend_col)
+
+        positions = self.df_trades.groupby(legend_col, sort=False).indices
+        x_range = (self.df_trades['DurationBars'].min(), self.df_trades['DurationBars'].max())
+        y_range = (self.df_trades['ReturnPct'].min(), self.df_trades['ReturnPct'].max())
+        scatter_renderers = []
+        density_renderers = []
         for i, legend in enumerate(legends):
-            p = self.p.scatter(
-                    'DurationBars',
-                    'ReturnPct',
-                    source=scatter_source,
-                    view=CDSView(
+            if legend in dense:
+                p = self._plot_density(
+                        self.df_trades.iloc[positions[legend]],
+                        x_range, y_range,
+                        legend_label=legend,
+                        color=palette[i % 10],
+                        )
+                density_renderers.append(p)
+            else:
+                p = self.p.scatter(
+                        'DurationBars',
+                        'ReturnPct',
                         source=scatter_source,
-                        filters=[GroupFilter(
-                            column_name=legend_col,
-                            group=legend,
-                            )]
-                        ),
-                    legend_label=legend,
-                    size=12,
-                    color=palette[i % 10],
-                    alpha=0.4
-                    )
+                        view=CDSView(
+                            source=scatter_source,
+                            filters=[GroupFilter(
+                                column_name=legend_col,
+                                group=legend,
+                                )]
+                            ),
+                        legend_label=legend,
+                        size=12,
+                        color=palette[i % 10],
+                        alpha=0.4
+                        )
+                scatter_renderers.append(p)
 
             ph1 = self.ph.scatter(
-                    h_df[h_df[legend_col] == legend]['x'],
-                    h_df[h_df[legend_col] == legend]['hist'],
+                    h_x,
+                    h_hist[i],
                     color=palette[i % 10],
                     alpha=0.5,
                     size=6,
                     )
             ph2 = self.ph.line(
-                    h_df[h_df[legend_col] == legend]['x'],
-                    h_df[h_df[legend_col] == legend]['hist'],
+                    h_x,
+                    h_hist[i],
                     color=palette[i % 10],
                     line_width=4,
                     alpha=0.4,
                     )
 
             pv1 = self.pv.scatter(
-                    v_df[h_df[legend_col] == legend]['hist'],
-                    v_df[h_df[legend_col] == legend]['x'],
+                    v_hist[i],
+                    v_x,
                     color=palette[i % 10],
                     alpha=0.5,
                     size=6,
                     )
             pv2 = self.pv.line(
-                    v_df[h_df[legend_col] == legend]['hist'],
-                    v_df[h_df[legend_col] == legend]['x'],
+                    v_hist[i],
+                    v_x,
                     color=palette[i % 10],
                     line_width=4,
                     alpha=0.4,
@@ -230,39 +387,103 @@ class PlotTradeResults:
                 """
                 ))
 
+        self.p.select_one(HoverTool).renderers = scatter_renderers
+        if density_renderers:
+            self.p.add_tools(HoverTool(
+                tooltips=[
+                    ('足の本数', '@left{0}-@right{0} 本'),
+                    ('リターン', '@bottom{%0.2f}-@top{%0.2f}'),
+                    ('トレード数', '@count'),
+                    ],
+                formatters={'@bottom': 'printf', '@top': 'printf'},
+                renderers=density_renderers,
+                ))
+
+    def _plot_density(
+            self,
+            trades: pd.DataFrame,
+            x_range: tuple[float, float],
+            y_range: tuple[float, float],
+            legend_label: str,
+            color: str,
+            ) -> GlyphRenderer:
+        """トレードを足の本数とリターンの2次元の度数分布にして描画する
+
+        トレード数が多い凡例は点の代わりに、トレードのあるマスだけを
+        トレード数に応じた濃さの矩形で描く
+
+        """
+        from bokeh.models import ColumnDataSource
+
+        hist, x_edges, y_edges = np.histogram2d(
+                trades['DurationBars'], trades['ReturnPct'],
+                bins=self.density_bins, range=[x_range, y_range],
+                )
+        ix, iy = np.nonzero(hist)
+        count = hist[ix, iy]
+        source = ColumnDataSource({
+            'left': x_edges[ix],
+            'right': x_edges[ix + 1],
+            'bottom': y_edges[iy],
+            'top': y_edges[iy + 1],
+            'count': count.astype(int),
+            'alpha': 0.15 + 0.75 * np.log1p(count) / np.log1p(count.max()),
+            })
+        return self.p.quad(
+                left='left', right='right', bottom='bottom', top='top',
+                source=source,
+                legend_label=legend_label,
+                fill_color=color,
+                fill_alpha='alpha',
+                line_color=None,
+                )
+
     def _set_hist_source(
             self,
             sr_line: pd.Series,
             legend_col: str = 'legend'
-            ) -> pd.DataFrame:
-        range_max = sr_line.max()
-        range_min = sr_line.min()
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """すべての凡例の度数分布を1回の走査で計算する
 
-        source_line = None
-        legends = self.df_trades[legend_col].unique()
-        for legend in legends:
-            sr = sr_line[self.df_trades[legend_col] == legend]
-            hist, edge = np.histogram(
-                    sr,
-                    bins=self.bins,
-                    range=(range_min, range_max),
-                    )
-            mid_point = (edge[:-1] + edge[1:]) / 2
-            df_new = pd.DataFrame({
-                'x': mid_point,
-                'hist': hist,
-                legend_col: legend,
-                })
-            source_line = pd.concat([source_line, df_new])
-        return source_line
-
-    def save(self, output: str, legend_col: str = 'legend'):
+        凡例を整数のコードにし、ビン番号と組み合わせた番号をbincountで数える
+        ビンはすべての凡例で共通で、np.histogramと同じく最後のビンだけ右端を含む
+
+        Args:
+            sr_line: 度数分布をとる値
+            legend_col: 凡例の列名
+
+        Returns:
+            ビンの中点と、(凡例の数 x ビン数)の度数
+            凡例の順番はdf_trades[legend_col].unique()と同じ
+
+        """
+        codes, legends = pd.factorize(self.df_trades[legend_col])
+        values = sr_line.to_numpy(dtype='float')
+        range_min, range_max = values.min(), values.max()
+        if range_min == range_max:
+            range_min, range_max = range_min - 0.5, range_max + 0.5
+
+        edge = np.linspace(range_min, range_max, self.bins + 1)
+        bin_index = np.digitize(values, edge[1:-1])
+        hist = np.bincount(
+                codes * self.bins + bin_index,
+                minlength=len(legends) * self.bins,
+                ).reshape(len(legends), self.bins)
+        mid_point = (edge[:-1] + edge[1:]) / 2
+        return mid_point, hist
+
+    def save(self, output: str, legend_col: str = 'legend', compact: bool = False):
         """プロットを保存する
 
         Args:
             output: 出力するパス、ファイル名を文字列で入力
+            legend_col: 凡例に使う列名
+            compact: データを別ファイルに分けた小さなhtmlで保存する 詳しくはsave_compact
 
         """
+        from bokeh.plotting import save, output_file
+        from bokeh.layouts import gridplot
+
         self._plot(legend_col)
 
         self.p.legend.location = 'top_left'
@@ -273,6 +494,9 @@ class PlotTradeResults:
                 [[self.p, self.pv], [self.ph, None]],
                 merge_tools=False
                 )
+        if compact:
+            save_compact(layout, output)
+            return
         output_file(output)
         save(layout)
 
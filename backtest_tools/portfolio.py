@@ -0,0 +1,124 @@
+"""多数の銘柄に資金を配分するポートフォリオのバックテストを行う関数を提供する
+
+銘柄ごとに独立してバックテストするbacktest_for_multiple_dataと異なり、
+すべての銘柄の価格を日付×銘柄の表(パネル)にそろえ、
+同じ日に全銘柄を順位付けして資金を配分する。
+計算は銘柄ごとのループではなく、パネル全体の配列演算で行う。
+"""
+
+from __future__ import annotations
+
+from typing import Callable
+
+import pandas as pd
+import numpy as np
+
+
+def make_price_panel(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        calendar: pd.DatetimeIndex | None = None,
+        columns: tuple[str, ...] = ('Open', 'High', 'Low', 'Close', 'Volume'),
+        ) -> dict[str, pd.DataFrame]:
+    """価格データを共通の営業日にそろえた日付×銘柄のパネルにする
+
+    Args:
+        data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+        calendar: 共通の営業日 省略するとすべてのデータの日付を合わせたもの
+            トヨタ(7203)の日付などを指定すると、取引の少ない日を除ける
+        columns: パネルにする列
+
+    Returns:
+        列名をキーにした、日付×銘柄のDataFrameの辞書
+        取引のない日はNaNになる
+
+    """
+    names = [str(name) for _, name in data_name_tpl_lst]
+    # 銘柄ごとにreindexするより、一度に連結してから列を取り出すほうが速い
+    wide = pd.concat(
+            [data[list(columns)] for data, _ in data_name_tpl_lst],
+            axis=1, keys=names, names=['name', 'column'],
+            ).sort_index()
+    if calendar is not None:
+        wide = wide.reindex(calendar)
+    return {col: wide.xs(col, axis=1, level='column') for col in columns}
+
+
+def portfolio_backtest(
+        panel: dict[str, pd.DataFrame],
+        score: pd.DataFrame | Callable[[dict[str, pd.DataFrame]], pd.DataFrame],
+        signal: pd.DataFrame | Callable[[dict[str, pd.DataFrame]], pd.DataFrame] | None = None,
+        top_n: int = 10,
+        cash: float = 1_000_000,
+        commission: float = .002,
+        rebalance: int = 1,
+        ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """ポートフォリオのバックテストを行う
+
+    各日の終値の時点で、signalがTrueの銘柄をscoreの大きい順にtop_n銘柄選び、
+    等金額で保有する。保有は翌日の終値までのリターンを得る。
+    選べる銘柄がtop_nに満たないときは、残りを現金で持つ。
+    リバランスの日以外は売買せず、各銘柄のウェイトは値動きにしたがって変わる。
+    売買代金(値動きで変わったウェイトと新しいウェイトの差の絶対値の合計)に
+    commissionをかけた額をコストとして引く。
+
+    Args:
+        panel: make_price_panelで作ったパネル
+        score: 順位付けに使う値のパネル、またはパネルから計算する関数 NaNの銘柄は選ばない
+        signal: 保有してよい銘柄をTrueにしたパネル、またはパネルから計算する関数
+            省略するとscoreがNaNでない銘柄すべて
+        top_n: 保有する銘柄数
+        cash: 初期資金
+        commission: 売買代金に対する手数料率
+        rebalance: 何日ごとに保有銘柄を入れ替えて等金額に戻すか
+
+    Returns:
+        日ごとの資産(Equity)、リターン(Return)、売買代金の比率(Turnover)、
+        コスト(Cost)、保有銘柄数(# Positions)と、日ごとの終値での売買後の各銘柄のウェイト
+
+    """
+    close = panel['Close']
+    if callable(score):
+        score = score(panel)
+    if callable(signal):
+        signal = signal(panel)
+
+    s = score.reindex_like(close).to_numpy(dtype=float, copy=True)
+    eligible = np.isfinite(s) & np.isfinite(close.to_numpy())
+    if signal is not None:
+        eligible &= signal.reindex_like(close).fillna(False).to_numpy(dtype=bool)
+    s[~eligible] = -np.inf
+
+    n_days, n_codes = s.shape
+    top_n = min(top_n, n_codes)
+    # 上位top_n銘柄だけが必要なので、全体をソートせずargpartitionで取り出す
+    top = np.argpartition(-s, top_n - 1, axis=1)[:, :top_n]
+    rows = np.arange(n_days)[:, None]
+    target = np.zeros_like(s)
+    target[rows, top] = np.where(np.isfinite(s[rows, top]), 1. / top_n, 0.)
+
+    # 終値で決めたウェイトは翌日のリターンに効く 取引のない日のリターンは0とする
+    returns = np.nan_to_num(close.ffill().pct_change().to_numpy(), nan=0.)
+    weights = np.empty_like(target)
+    turnover = np.empty(n_days)
+    gross = np.empty(n_days)
+    held = np.zeros(n_codes)
+    # 前日のウェイトが値動きで変わるため日ごとにループするが、各日はすべての銘柄をまとめて計算する
+    for t in range(n_days):
+        grown = held * (1 + returns[t])
+        gross[t] = grown.sum() - held.sum()
+        drifted = grown / (1 + gross[t])
+        held = target[t] if t % rebalance == 0 else drifted
+        turnover[t] = np.abs(held - drifted).sum()
+        weights[t] = held
+    cost = turnover * commission
+    ret = gross - cost
+    equity = cash * np.cumprod(1 + ret)
+
+    result = pd.DataFrame({
+        'Equity': equity,
+        'Return': ret,
+        'Turnover': turnover,
+        'Cost': cost * np.concatenate([[cash], equity[:-1]]),
+        '# Positions': (weights > 0).sum(axis=1),
+        }, index=close.index)
+    return result, pd.DataFrame(weights, index=close.index, columns=close.columns)
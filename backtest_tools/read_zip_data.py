@@ -4,14 +4,15 @@ Todo:
 
 """
 
+import io
 import os
 from pathlib import Path
 import zipfile
 import re
 import pickle
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 from pandas.errors import EmptyDataError
@@ -63,26 +64,9 @@ class StockData:
 
         """
 
-        use_cols = {
-                '<DATE>': 'Date',
-                '<OPEN>': 'Open',
-                '<HIGH>': 'High',
-                '<LOW>': 'Low',
-                '<CLOSE>': 'Close',
-                '<VOL>': 'Volume',
-                }
         with zipfile.ZipFile(self.zip_dir) as zip_dir:
             with zip_dir.open(self.file_path) as f:
-                data = pd.read_csv(f, usecols=use_cols.keys())
-
-        if data.empty:
-            raise EmptyDataError('空のデータです')
-
-        data['<DATE>'] = pd.to_datetime(data['<DATE>'], format='%Y%m%d')
-        data = data.rename(columns=use_cols)
-        data = data.set_index('Date')
-
-        return data
+                return _parse_daily(f)
 
     def check_len_to_toyota(self) -> float:
         """トヨタの取引日数に対する、取引日数の比率を返す
@@ -91,25 +75,69 @@ class StockData:
 
         """
         toyota = StockData('7203').read()
+        return _ratio_to_toyota(self.read(), toyota)
+
+
+_USE_COLS = {
+        '<DATE>': 'Date',
+        '<OPEN>': 'Open',
+        '<HIGH>': 'High',
+        '<LOW>': 'Low',
+        '<CLOSE>': 'Close',
+        '<VOL>': 'Volume',
+        }
+_MEMBER_PATTERN = re.compile(r'data/daily/jp/.*/([^/]+)\.jp\.txt$')
+
+
+def _parse_daily(f) -> pd.DataFrame:
+    """Stooqの日足のファイルを読み込む 空のときはEmptyDataErrorを出す"""
+    data = pd.read_csv(f, usecols=_USE_COLS.keys())
+
+    if data.empty:
+        raise EmptyDataError('空のデータです')
 
-        me = self.read()
-        toyota_match_range = toyota.query('''
-                @me.index.min() <= index <= @me.index.max()
-                ''')
-        return len(me) / len(toyota_match_range)
+    data['<DATE>'] = pd.to_datetime(data['<DATE>'], format='%Y%m%d')
+    data = data.rename(columns=_USE_COLS)
+    data = data.set_index('Date')
 
+    return data
+
+
+def _ratio_to_toyota(me: pd.DataFrame, toyota: pd.DataFrame) -> float:
+    lo = toyota.index.searchsorted(me.index.min(), side='left')
+    hi = toyota.index.searchsorted(me.index.max(), side='right')
+    return len(me) / (hi - lo)
+
+
+def set_multiple_data_from_codes(
+        codes,
+        io_threads: int = 1,
+        ) -> list[tuple[pd.DataFrame, str]]:
+    """多数のコード番号の株価をマルチプロセスで読み込む
+
+    取引日数がトヨタの8割に満たない銘柄は除く
+
+    Args:
+        codes: コード番号
+        io_threads: 各プロセスでzipの展開と読み込みを並行させるスレッドの数
+            zlibの展開はGILを解放するので、プロセスの中でもスレッドで並行できる
 
-def set_multiple_data_from_codes(codes) -> list[tuple[pd.DataFrame, str]]:
+    Returns:
+        データとコード番号のタプルのリスト codesの順に並ぶ
+
+    """
+    from tqdm import tqdm
 
     code_batches = list(_batch(codes))
-    
+
     list_code = []
     list_data = []
     with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(_read_data, b_codes)
+        futures = [executor.submit(_read_data, b_codes, io_threads)
                 for b_codes in code_batches]
 
-        for future in tqdm(as_completed(futures), total=len(futures)):
+        # 呼び出し側が渡したコードの順に並ぶよう、投入した順に結果を受け取る
+        for future in tqdm(futures):
             lst_data, lst_code = future.result()
             list_code.extend(lst_code)
             list_data.extend(lst_data)
@@ -118,6 +146,30 @@ def set_multiple_data_from_codes(codes) -> list[tuple[pd.DataFrame, str]]:
     return data_name_tpl_lst
 
 
+def read_data_from_codes(
+        codes,
+        shard: int = 0,
+        n_shards: int = 1,
+        io_threads: int = 1,
+        ) -> list[tuple[pd.DataFrame, str]]:
+    """コード番号の一部の株価を、このプロセスの中で読み込む
+
+    BacktestSessionのloaderに使うと、各ワーカーが担当するコードだけを読み込む
+
+    Args:
+        codes: コード番号
+        shard: 読み込む分割の番号
+        n_shards: 分割の数 codes[shard::n_shards]を読み込む
+        io_threads: zipの展開と読み込みを並行させるスレッドの数
+
+    Returns:
+        データとコード番号のタプルのリスト
+
+    """
+    list_data, list_code = _read_data(list(codes)[shard::n_shards], io_threads)
+    return list(zip(list_data, list_code))
+
+
 def cache_all_data(
         cache_file: Path = Path(__file__).parent.joinpath('data/cache_data.pkl')
         ) -> None:
@@ -142,21 +194,154 @@ def _batch(seq: list):
         yield seq[i: i+n]
 
 
-def _read_data(codes) -> tuple[list[pd.DataFrame], list[str]]:
+def _read_data(codes, io_threads: int = 1) -> tuple[list[pd.DataFrame], list[str]]:
+    # zipを開いてファイル一覧を調べるのと、トヨタの読み込みはバッチごとに一度だけにする
+    with zipfile.ZipFile(StockData.zip_dir) as zip_dir:
+        members = {}
+        for member in zip_dir.namelist():
+            m = _MEMBER_PATTERN.search(member)
+            if m:
+                members.setdefault(m.group(1), []).append(member)
+
+        def load(code):
+            file_path = members.get(str(code), [])
+            if len(file_path) >= 2:
+                raise Exception('２つ以上のファイルを読み込んでいる')
+            elif len(file_path) == 0:
+                return None
+            return _parse_daily(io.BytesIO(zip_dir.read(file_path[0])))
+
+        toyota = load('7203')
+        if io_threads > 1:
+            with ThreadPoolExecutor(io_threads) as executor:
+                frames = list(executor.map(load, codes))
+        else:
+            frames = [load(code) for code in codes]
+
     list_data = []
     list_code = []
-    for code in codes:
-        try:
-            sd = StockData(code)
-        except FileNotFoundError as e:
-            print(code, e)
+    for code, data in zip(codes, frames):
+        if data is None:
+            print(code, 'ファイルなし')
             continue
 
-        if sd.check_len_to_toyota() < 0.8:
+        if _ratio_to_toyota(data, toyota) < 0.8:
             print(code, ' 取引日数がトヨタと比べて少ない')
             continue
 
-        list_data.append(sd.read())
+        list_data.append(data)
         list_code.append(code)
     return list_data, list_code
 
+
+# 足の種類と、pandasの期間の指定 週足は金曜日で区切る
+TIMEFRAMES = {'W': 'W-FRI', 'M': 'M'}
+
+
+def resample_ohlcv(data: pd.DataFrame, timeframe: str = 'W') -> pd.DataFrame:
+    """日足を週足や月足にまとめる
+
+    祝日で金曜日や月末が休場のときも、その期間の最後の取引日を日付にする
+
+    Args:
+        data: 日足の価格データ
+        timeframe: 'W'(週足)または'M'(月足)
+
+    Returns:
+        まとめた価格データ 日付はその期間の最後の取引日
+
+    """
+    periods = data.index.to_period(TIMEFRAMES[timeframe])
+    grouped = data.groupby(periods)
+    resampled = grouped.agg({
+        'Open': 'first',
+        'High': 'max',
+        'Low': 'min',
+        'Close': 'last',
+        'Volume': 'sum',
+        })
+    last_days = pd.Series(data.index, index=periods).groupby(level=0).last()
+    resampled.index = pd.DatetimeIndex(last_days.to_numpy(), name=data.index.name)
+    return resampled
+
+
+def cache_resampled_data(
+        timeframe: str = 'W',
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]] | None = None,
+        cache_file: Path | None = None,
+        ) -> None:
+    """週足や月足を作って保存する すでに保存していれば新しい日足の分だけ更新する
+
+    保存済みの最後の足の期間は途中の可能性があるので、その期間から作り直す
+    保存済みの足の終値が日足と合わない銘柄(株式分割の調整など)はすべて作り直す
+
+    Args:
+        timeframe: 'W'(週足)または'M'(月足)
+        data_name_tpl_lst: 日足のデータ 省略すると日足のキャッシュ(read_cache_data)を使う
+        cache_file: 保存先のパス 省略するとdata/cache_data_{timeframe}.pkl
+
+    """
+    cache_file = cache_file or _resampled_cache_file(timeframe)
+    if data_name_tpl_lst is None:
+        data_name_tpl_lst = read_cache_data()
+
+    cache = {}
+    if cache_file.exists():
+        with cache_file.open('rb') as p:
+            cache = pickle.load(p)
+
+    freq = TIMEFRAMES[timeframe]
+    for data, name in data_name_tpl_lst:
+        old = cache.get(name)
+        if old is not None and len(old) > 1:
+            cut = pd.Period(old.index[-1], freq).start_time
+            kept = old[old.index < cut]
+            label = kept.index[-1]
+            if label in data.index and data.at[label, 'Close'] == kept['Close'].iloc[-1]:
+                cache[name] = pd.concat(
+                        [kept, resample_ohlcv(data[data.index >= cut], timeframe)])
+                continue
+        cache[name] = resample_ohlcv(data, timeframe)
+
+    with cache_file.open('wb') as p:
+        pickle.dump(cache, p)
+
+
+def read_resampled_data(
+        timeframe: str = 'W',
+        codes: list[str] | None = None,
+        start: date | None = None,
+        end: date | None = None,
+        cache_file: Path | None = None,
+        ) -> list[tuple[pd.DataFrame, str]]:
+    """cache_resampled_dataで保存した週足や月足を読み込む
+
+    Args:
+        timeframe: 'W'(週足)または'M'(月足)
+        codes: 読み込むコード番号 省略するとすべて
+        start: 開始日(この日を含む)
+        end: 終了日(この日を含まない)
+        cache_file: 保存したパス 省略するとdata/cache_data_{timeframe}.pkl
+
+    Returns:
+        read_cache_dataと同じく、データとコード番号のタプルのリスト
+
+    """
+    cache_file = cache_file or _resampled_cache_file(timeframe)
+    with cache_file.open('rb') as p:
+        cache = pickle.load(p)
+
+    names = cache.keys() if codes is None else [c for c in codes if c in cache]
+    data_name_tpl_lst = []
+    for name in names:
+        data = cache[name]
+        if start is not None:
+            data = data[data.index >= pd.Timestamp(start)]
+        if end is not None:
+            data = data[data.index < pd.Timestamp(end)]
+        data_name_tpl_lst.append((data, name))
+    return data_name_tpl_lst
+
+
+def _resampled_cache_file(timeframe: str) -> Path:
+    return Path(__file__).parent.joinpath(f'data/cache_data_{timeframe}.pkl')
@@ -1,17 +1,161 @@
+"""バックテスト結果のチャートとその一覧ページを作成する関数を提供する"""
+
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import warnings
+import multiprocessing as mp
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from jinja2 import Template, Environment, FileSystemLoader
+import pandas as pd
 
+from .backtest import _batch
+from .plottings import _ohlc_figure
+from .compact_html import save_compact
 
-def make_report():
-    template_dir = Path(__file__).parent.joinpath('template/')
-    charts_dir = Path(__file__).parent.parent.joinpath('tests/outputs/charts/')
-    report_file = Path(__file__).parent.parent.joinpath('tests/outputs/report.html')
+_MANIFEST = 'manifest.json'
+
+
+def make_report(
+        charts_dir: str | Path | None = None,
+        report_file: str | Path | None = None,
+        ) -> None:
+    """チャートの一覧ページを作成する
+
+    Args:
+        charts_dir: チャートのhtmlがあるディレクトリ 省略するとtests/outputs/charts
+        report_file: 出力する一覧ページのパス 省略するとtests/outputs/report.html
+
+    """
+    from jinja2 import Environment, FileSystemLoader
 
+    root = Path(__file__).parent.parent
+    charts_dir = Path(charts_dir or root.joinpath('tests/outputs/charts/'))
+    report_file = Path(report_file or root.joinpath('tests/outputs/report.html'))
+
+    template_dir = Path(__file__).parent.joinpath('template/')
     env = Environment(loader=FileSystemLoader(template_dir, encoding='utf-8'))
     tmpl = env.get_template('report.j2')
 
-    list_charts = [f.stem for f in charts_dir.glob('*html')]
-    rendered_html = tmpl.render(list_charts=list_charts)
+    list_charts = sorted(f.stem for f in charts_dir.glob('*html'))
+    charts_url = Path(os.path.relpath(charts_dir, report_file.parent)).as_posix()
+    rendered_html = tmpl.render(list_charts=list_charts, charts_url=charts_url)
+    report_file.parent.mkdir(parents=True, exist_ok=True)
     with report_file.open('w') as f:
         f.write(rendered_html)
+
+
+def build_report(
+        data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+        trades: pd.DataFrame,
+        charts_dir: str | Path,
+        report_file: str | Path,
+        max_bars: int | None = None,
+        compact: bool = False,
+        ) -> list[str]:
+    """銘柄ごとのチャートを作成し、一覧ページを作り直す
+
+    チャートはローソク足にトレードの保有期間を色付けしたもの。
+    価格データとトレード履歴の指紋をcharts_dirのmanifest.jsonに残しておき、
+    指紋が変わった銘柄とhtmlがない銘柄だけをマルチプロセスで作り直す。
+    一覧ページはすべてのチャートを作り終えてから一度だけ作る。
+
+    Args:
+        data_name_tpl_lst: データと識別用の名前をタプルにして、それを多数用意し、リスト化したもの
+        trades: name列をもつトレード履歴 backtest_for_multiple_dataの結果を想定
+        charts_dir: チャートを出力するディレクトリ
+        report_file: 出力する一覧ページのパス
+        max_bars: 描画するローソク足の最大数 詳しくはStackCharts.add
+        compact: データを別ファイルに分けた小さなhtmlで保存する 詳しくはsave_compact
+
+    Returns:
+        作り直したチャートの名前
+
+    """
+    from tqdm import tqdm
+
+    charts_dir = Path(charts_dir)
+    charts_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = charts_dir.joinpath(_MANIFEST)
+    manifest = {}
+    if manifest_file.exists():
+        with manifest_file.open() as f:
+            manifest = json.load(f)
+
+    trades_by_name = dict(tuple(trades.groupby(trades['name'].astype(str))))
+    jobs = []
+    for data, name in data_name_tpl_lst:
+        name = str(name)
+        trade = trades_by_name.get(name, trades.iloc[:0])
+        fp = _fingerprint(data, trade, max_bars, compact)
+        if manifest.get(name) == fp and charts_dir.joinpath(f'{name}.html').exists():
+            continue
+        manifest[name] = fp
+        jobs.append((data, trade, name, charts_dir.joinpath(f'{name}.html')))
+
+    job_batches = list(_batch(jobs))
+    if len(job_batches) > 1 and mp.get_start_method(allow_none=False) == 'fork':
+        with ProcessPoolExecutor() as executor:
+            futures = [
+                    executor.submit(_batch_render, b_jobs, max_bars, compact)
+                    for b_jobs in job_batches]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+    else:
+        if len(job_batches) > 1 and os.name == 'posix':
+            warnings.warn(
+                    "For multiprocessing support"
+                    "set multiprocessing start method to 'fork'.")
+        _batch_render(jobs, max_bars, compact)
+
+    # 途中で失敗したときに作っていないチャートを作成済みとしないよう、最後に書き込む
+    with manifest_file.open('w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    make_report(charts_dir, report_file)
+    return [job[2] for job in jobs]
+
+
+def _fingerprint(
+        data: pd.DataFrame,
+        trades: pd.DataFrame,
+        max_bars: int | None,
+        compact: bool,
+        ) -> str:
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(data).to_numpy().tobytes())
+    h.update(pd.util.hash_pandas_object(
+        trades[['EntryTime', 'ExitTime', 'PnL']], index=False).to_numpy().tobytes())
+    h.update(repr((max_bars, compact)).encode())
+    return h.hexdigest()
+
+
+def _batch_render(
+        jobs: list[tuple[pd.DataFrame, pd.DataFrame, str, Path]],
+        max_bars: int | None,
+        compact: bool,
+        ) -> None:
+    from bokeh.plotting import save, output_file
+    from bokeh.models import BoxAnnotation
+
+    for data, trades, name, filename in jobs:
+        fig, index = _ohlc_figure(data, max_bars)
+        fig.title.text = name
+        fig.sizing_mode = 'stretch_width'
+        fig.height = 300
+        left = index.get_indexer(trades['EntryTime'], method='nearest')
+        right = index.get_indexer(trades['ExitTime'], method='nearest')
+        for lt, rt, pnl in zip(left, right, trades['PnL']):
+            fig.add_layout(BoxAnnotation(
+                left=lt, right=rt,
+                fill_color='lime' if pnl > 0 else 'tomato',
+                fill_alpha=0.15,
+                ))
+        if compact:
+            save_compact(fig, filename, title=name)
+        else:
+            output_file(filename, title=name)
+            save(fig)
@@ -0,0 +1,270 @@
+"""トレード履歴を再標本化して、戦略の結果の頑健さを調べるクラスを提供する
+
+Montecarloが資産の推移をシミュレートするのに対し、このモジュールは
+勝率や平均リターンの信頼区間、無作為なエントリーとの比較、
+ブロックブートストラップによる資産曲線の分布を求める。
+
+トレード履歴は最初にグループの順に並べ、リターン、勝ち、対数リターンの累積和の配列にしておく。
+再標本化は各グループの開始位置に[0, トレード数)の乱数を足した番号の行列で行い、
+すべてのグループをまとめてNumPyの配列演算で集計する。
+"""
+
+from __future__ import annotations
+
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from .montecarlo import _SUMMARY_Q, _chunk_sizes
+
+
+class TradeResampler:
+    """トレード履歴の再標本化による統計量をグループごとにまとめて求めるクラス
+
+    Args:
+        trades: トレード履歴 ReturnPctの列が必要
+            random_entry_testにはEntryTime、ExitTime、Sizeの列も使う
+        by: グループ分けに使う列名 Strategy、nameなど 省略するとすべてを1つのグループにする
+        seed: ランダム値を再現するための設定
+
+    Attributes:
+        trades(pd.DataFrame): グループの順に並べ替えたトレード履歴
+        by(list[str]): グループ分けに使う列名
+        groups(list): グループ名のリスト byを省略したときは['All']
+        seed_seq(np.random.SeedSequence): 乱数列の元 各メソッドは呼ぶたびに同じ乱数列を使う
+            block_bootstrapはグループ名ごとに派生させた乱数列を使い、
+            結果は他のグループによらない
+
+    """
+
+    def __init__(
+            self,
+            trades: pd.DataFrame,
+            by: str | list[str] | None = None,
+            seed: int = 2022,
+            ) -> None:
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.by = [] if by is None else [by] if isinstance(by, str) else list(by)
+
+        if self.by:
+            grouped = trades.groupby(self.by if len(self.by) > 1 else self.by[0], sort=True)
+            self.groups = list(grouped.indices)
+            order = [grouped.indices[g] for g in self.groups]
+            order = np.concatenate(order) if order else np.array([], dtype=np.intp)
+            sizes = [len(o) for o in grouped.indices.values()]
+        else:
+            self.groups = ['All'] if len(trades) else []
+            order = np.arange(len(trades))
+            sizes = [len(trades)] if len(trades) else []
+        self.trades = trades.iloc[order]
+
+        # グループの境界と、区間の合計をO(1)で求めるための累積和(先頭に0をつける)
+        self._offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.intp)
+        self._sizes = np.diff(self._offsets)
+        self._returns = self.trades['ReturnPct'].to_numpy(dtype=float)
+        self._cum_returns = _prefix_sum(self._returns)
+        self._cum_wins = _prefix_sum(self._returns > 0)
+        # 空売りで-100%を超えて損をしたトレードは、資産がほぼ0になったものとして扱う
+        self._cum_log = _prefix_sum(np.log1p(np.maximum(self._returns, -1 + 1e-12)))
+        # 再標本化で使う、トレードの列ごとのグループの開始位置とトレード数
+        group_of = np.repeat(np.arange(len(self._sizes)), self._sizes)
+        self._base = self._offsets[group_of]
+        self._n_of = self._sizes[group_of]
+
+    def bootstrap(
+            self,
+            n_boot: int = 2000,
+            confidence: float = 0.95,
+            chunk_size: int = 1000,
+            ) -> pd.DataFrame:
+        """勝率と平均リターンのブートストラップ信頼区間を求める
+
+        各グループのトレードを復元抽出し、パーセンタイル法で区間を求める
+
+        Args:
+            n_boot: 再標本化の回数
+            confidence: 信頼水準
+            chunk_size: 一度にまとめて再標本化する回数 メモリ使用量はこれ×トレード数に比例する
+
+        Returns:
+            グループごとのトレード数、勝率、平均リターンと、それぞれの信頼区間の下限(Low)、上限(High)
+
+        """
+        n = self._sizes
+        observed_win = _range_sum(self._cum_wins, self._offsets) / n
+        observed_ret = _range_sum(self._cum_returns, self._offsets) / n
+
+        wins, rets = [], []
+        for r in self._resample(n_boot, chunk_size):
+            wins.append(np.add.reduceat(r > 0, self._offsets[:-1], axis=1, dtype=np.int64) / n)
+            rets.append(np.add.reduceat(r, self._offsets[:-1], axis=1) / n)
+        q = ((1 - confidence) / 2, (1 + confidence) / 2)
+        win_lo, win_hi = _quantiles(wins, q, len(n))
+        ret_lo, ret_hi = _quantiles(rets, q, len(n))
+
+        return self._frame({
+            '# Trades': n,
+            'Win Rate [%]': observed_win * 100,
+            'Win Rate [%] Low': win_lo * 100,
+            'Win Rate [%] High': win_hi * 100,
+            'Avg. Return [%]': observed_ret * 100,
+            'Avg. Return [%] Low': ret_lo * 100,
+            'Avg. Return [%] High': ret_hi * 100,
+            })
+
+    def block_bootstrap(
+            self,
+            n_boot: int = 2000,
+            block_size: int | None = None,
+            chunk_size: int = 1000,
+            ) -> pd.DataFrame:
+        """連続するトレードのブロックを復元抽出し、資産曲線のリターンと最大ドローダウンの分布を求める
+
+        トレードの結果の自己相関(連勝、連敗)を残したまま再標本化する。
+        ブロックの中の資産の推移は対数リターンの累積和の差で求める。
+
+        Args:
+            n_boot: 再標本化の回数
+            block_size: ブロックの長さ 省略するとトレード数の立方根
+            chunk_size: 一度にまとめて再標本化する回数
+
+        Returns:
+            グループごとのブロックの長さと、リターンと最大ドローダウンの分位点
+            値はMontecarlo.summaryと同じく比率で表す
+
+        """
+        rows = []
+        # ブロックの長さがグループごとに異なるため、グループごとに計算する
+        for group, start, n in zip(self.groups, self._offsets[:-1], self._sizes):
+            rng = np.random.default_rng(self._group_seed(group))
+            size = min(block_size or max(int(round(n ** (1 / 3))), 1), n)
+            n_blocks = -(-n // size)
+            steps = np.arange(1, size + 1)
+            rets, dds = [], []
+            for b in _chunk_sizes(n_boot, chunk_size):
+                first = start + (rng.random((b, n_blocks)) * (n - size + 1)).astype(np.intp)
+                # ブロックの各位置までの対数リターン (b, ブロック数, ブロックの長さ)
+                seg = self._cum_log[first[..., None] + steps] - self._cum_log[first][..., None]
+                offset = np.cumsum(seg[..., -1], axis=1) - seg[..., -1]
+                equity = np.exp((offset[..., None] + seg).reshape(b, -1)[:, :n])
+                peak = np.maximum(np.maximum.accumulate(equity, axis=1), 1.)
+                rets.append(equity[:, -1] - 1)
+                dds.append((equity / peak - 1).min(axis=1))
+            rets, dds = np.concatenate(rets), np.concatenate(dds)
+            rows.append({
+                'Block Size': size,
+                **{f'Return {q:.0%}': np.quantile(rets, q) for q in _SUMMARY_Q},
+                **{f'Max. Drawdown {q:.0%}': np.quantile(dds, q) for q in _SUMMARY_Q},
+                })
+        return self._frame(pd.DataFrame(rows).to_dict('list') if rows else {})
+
+    def random_entry_test(
+            self,
+            data_name_tpl_lst: list[tuple[pd.DataFrame, str]],
+            n_perm: int = 1000,
+            chunk_size: int = 1000,
+            ) -> pd.DataFrame:
+        """同じ銘柄、保有期間、売買方向で無作為な日にエントリーした場合と平均リターンを比べる
+
+        リターンはエントリー日とエグジット日の終値で計算し、実際のトレードも同じ方法で計算し直す。
+        銘柄ごとの対数終値を1つの配列につなげておき、
+        無作為なエントリーのリターンは配列の2点の差で求める。
+
+        Args:
+            data_name_tpl_lst: トレードの銘柄の価格データと名前のリスト
+                トレード履歴にname列がないときは、価格データを1つだけ渡す
+            n_perm: 無作為なエントリーを試す回数
+            chunk_size: 一度にまとめて試す回数
+
+        Returns:
+            グループごとのトレード数、実際の平均リターン、無作為なエントリーの平均リターンの平均、
+            実際の平均リターン以上になった割合から求めたp値
+
+        """
+        if 'name' in self.trades:
+            names = self.trades['name'].astype(str).to_numpy()
+        elif len(data_name_tpl_lst) == 1:
+            names = np.full(len(self.trades), str(data_name_tpl_lst[0][1]))
+        else:
+            raise ValueError('トレード履歴にname列がないときは、価格データを1つだけ渡す')
+
+        log_close, starts, indexes = [], {}, {}
+        n_total = 0
+        for data, name in data_name_tpl_lst:
+            close = data['Close'].dropna()
+            log_close.append(np.log(close.to_numpy(dtype=float)))
+            starts[str(name)] = n_total
+            indexes[str(name)] = close.index
+            n_total += len(close)
+        log_close = np.concatenate(log_close) if log_close else np.array([])
+        missing = set(names) - set(starts)
+        if missing:
+            raise ValueError(f'価格データのない銘柄: {sorted(missing)}')
+
+        # トレードごとのエントリーとエグジットの位置(つなげた配列の番号)と、その銘柄の足の数
+        base = np.empty(len(names), dtype=np.intp)
+        entry = np.empty(len(names), dtype=np.intp)
+        hold = np.empty(len(names), dtype=np.intp)
+        n_bars = np.empty(len(names), dtype=np.intp)
+        for name in np.unique(names):
+            mask = names == name
+            index = indexes[name]
+            e = index.searchsorted(self.trades['EntryTime'].to_numpy()[mask])
+            x = index.searchsorted(self.trades['ExitTime'].to_numpy()[mask])
+            e, x = np.minimum(e, len(index) - 1), np.minimum(x, len(index) - 1)
+            base[mask], entry[mask], hold[mask], n_bars[mask] = starts[name], e, x - e, len(index)
+        side = np.sign(self.trades['Size'].to_numpy(dtype=float))
+
+        def period_returns(e: np.ndarray) -> np.ndarray:
+            return side * np.expm1(log_close[base + e + hold] - log_close[base + e])
+
+        n = self._sizes
+        observed = np.add.reduceat(period_returns(entry), self._offsets[:-1]) / n
+        rng = np.random.default_rng(self.seed_seq)
+        random_means = []
+        for b in _chunk_sizes(n_perm, chunk_size):
+            e = (rng.random((b, len(names))) * (n_bars - hold)).astype(np.intp)
+            random_means.append(np.add.reduceat(period_returns(e), self._offsets[:-1], axis=1) / n)
+        random_means = np.concatenate(random_means) if random_means else np.empty((0, len(n)))
+
+        return self._frame({
+            '# Trades': n,
+            'Avg. Return [%]': observed * 100,
+            'Random Avg. Return [%]': random_means.mean(axis=0) * 100,
+            'p-value': (1 + (random_means >= observed).sum(axis=0)) / (n_perm + 1),
+            })
+
+    def _group_seed(self, group) -> np.random.SeedSequence:
+        """グループ名から派生させた乱数列の元 他のグループの有無や順番によらない"""
+        key = zlib.crc32(repr(group).encode())
+        return np.random.SeedSequence(self.seed_seq.entropy, spawn_key=(key,))
+
+    def _resample(self, n_boot: int, chunk_size: int):
+        """各グループの中でトレードを復元抽出したリターンの行列を分割して返す"""
+        rng = np.random.default_rng(self.seed_seq)
+        for b in _chunk_sizes(n_boot, chunk_size):
+            idx = self._base + (rng.random((b, len(self._returns))) * self._n_of).astype(np.intp)
+            yield self._returns[idx]
+
+    def _frame(self, columns: dict) -> pd.DataFrame:
+        if self.by:
+            index = (pd.MultiIndex.from_tuples(self.groups, names=self.by) if len(self.by) > 1
+                     else pd.Index(self.groups, name=self.by[0]))
+        else:
+            index = pd.Index(self.groups)
+        return pd.DataFrame(columns, index=index)
+
+
+def _prefix_sum(x: np.ndarray) -> np.ndarray:
+    return np.concatenate([[0.], np.cumsum(x, dtype=float)])
+
+
+def _range_sum(cum: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    return cum[offsets[1:]] - cum[offsets[:-1]]
+
+
+def _quantiles(chunks: list[np.ndarray], q: tuple[float, float], n_groups: int):
+    if not chunks:
+        return np.full(n_groups, np.nan), np.full(n_groups, np.nan)
+    return np.quantile(np.concatenate(chunks), q, axis=0)
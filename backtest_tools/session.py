@@ -0,0 +1,172 @@
+"""価格データを読み込んだままのワーカーで、繰り返しバックテストを行うクラスを提供する"""
+
+from __future__ import annotations
+
+import os
+import inspect
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .utils import cut_not_closed_trades
+
+if TYPE_CHECKING:
+    from backtesting import Strategy
+
+# ワーカーのプロセスが受け持つ価格データ
+_UNIVERSE = []
+
+
+class BacktestSession:
+    """ワーカーを一度だけ起動し、価格データを読み込ませたまま、戦略やパラメータを変えて実行する
+
+    backtest_for_multiple_dataは呼び出すたびにプロセスを起動し、すべての価格データを送るが、
+    このクラスはワーカーの起動時にloaderで価格データを読み込み、以降はトレード履歴だけを受け取る。
+    価格データはワーカーの数に分けて、各ワーカーがその一部だけを保持する。
+    loaderがshardとn_shardsの引数を受け取るときは、それを渡して担当分だけを読み込ませる
+    (read_zip_data.read_data_from_codesなど)。受け取らないときは、読み込んだ後に担当分を取り出す。
+
+    戦略クラスはワーカーに名前で送られるので、モジュールに定義して読み込めるようにしておく。
+    戦略のコードを変えたときはrestartでワーカーを起動し直す。
+
+    with文で使うと、抜けるときにワーカーを終了する::
+
+        with BacktestSession(read_data_from_codes, (codes,), n_workers=8) as session:
+            trades = session.run(EmaCross, {'n1': 10, 'n2': 40})
+
+    Args:
+        loader: 価格データ(データと名前のタプルのリスト)を返す関数 ワーカーごとに呼ばれる
+            shardとn_shardsを受け取るときは、codes[shard::n_shards]のように担当分だけを返す
+        loader_args: loaderに渡す引数
+        n_workers: ワーカーの数 省略するとCPU数
+        max_rss_mb: ワーカーのメモリ使用量の上限[MB] 実行後に超えていたワーカーは起動し直す
+        backtest_config: バックテストクラス用の設定
+
+    Attributes:
+        restarts(int): メモリ使用量の上限を超えて起動し直したワーカーの数
+
+    """
+
+    def __init__(
+            self,
+            loader: Callable[..., list[tuple[pd.DataFrame, str]]],
+            loader_args: tuple = (),
+            n_workers: int | None = None,
+            max_rss_mb: float | None = None,
+            backtest_config: dict | None = None,
+            ) -> None:
+        self.loader = loader
+        self.loader_args = loader_args
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.max_rss_mb = max_rss_mb
+        self.backtest_config = backtest_config or {}
+        self.restarts = 0
+        self._executors = []
+
+    def __enter__(self) -> BacktestSession:
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """ワーカーを起動し、価格データを読み込ませる"""
+        if not self._executors:
+            # すべてのワーカーを起動してから待ち、価格データを並行して読み込ませる
+            self._executors = [self._start_worker(i) for i in range(self.n_workers)]
+            _wait_ready(self._executors)
+
+    def close(self) -> None:
+        """ワーカーを終了する"""
+        for executor in self._executors:
+            executor.shutdown()
+        self._executors = []
+
+    def restart(self) -> None:
+        """ワーカーを起動し直す"""
+        self.close()
+        self.start()
+
+    def run(self, strategy: Strategy, params: dict | None = None) -> pd.DataFrame:
+        """すべての価格データで戦略のバックテストを行う
+
+        Args:
+            strategy: 戦略クラス インスタンスではない
+            params: 戦略のパラメータ Backtest.runに渡す
+
+        Returns:
+            バックテストのトレード履歴 backtest_for_multiple_dataの結果と同じ形式
+
+        """
+        self.start()
+        futures = [
+                executor.submit(_run_shard, strategy, params or {}, self.backtest_config)
+                for executor in self._executors]
+
+        frames = []
+        restarted = []
+        for i, future in enumerate(futures):
+            trades, rss_mb = future.result()
+            frames.append(trades)
+            if self.max_rss_mb is not None and rss_mb > self.max_rss_mb:
+                self._executors[i].shutdown()
+                self._executors[i] = self._start_worker(i)
+                restarted.append(self._executors[i])
+        _wait_ready(restarted)
+        self.restarts += len(restarted)
+        return pd.concat(frames)
+
+    def _start_worker(self, shard: int) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+                max_workers=1,
+                initializer=_init_worker,
+                initargs=(self.loader, self.loader_args, shard, self.n_workers),
+                )
+
+
+def _wait_ready(executors: list[ProcessPoolExecutor]) -> None:
+    # 初期化をすぐに終わらせておき、最初のrunで待たないようにする
+    for future in [executor.submit(len, ()) for executor in executors]:
+        future.result()
+
+
+def _init_worker(
+        loader: Callable[..., list[tuple[pd.DataFrame, str]]],
+        loader_args: tuple,
+        shard: int,
+        n_shards: int,
+        ) -> None:
+    global _UNIVERSE
+    params = inspect.signature(loader).parameters
+    if 'shard' in params and 'n_shards' in params:
+        _UNIVERSE = loader(*loader_args, shard=shard, n_shards=n_shards)
+    else:
+        _UNIVERSE = loader(*loader_args)[shard::n_shards]
+
+
+def _run_shard(
+        strategy: Strategy,
+        params: dict,
+        backtest_config: dict,
+        ) -> tuple[pd.DataFrame, float]:
+    from backtesting import Backtest
+
+    trades = []
+    for data, name in _UNIVERSE:
+        stats = Backtest(data, strategy, **backtest_config).run(**params)
+        trades.append(cut_not_closed_trades(stats).assign(name=name))
+    trades = pd.concat(trades) if trades else pd.DataFrame({})
+    return trades, _rss_mb()
+
+
+def _rss_mb() -> float:
+    """プロセスの現在のメモリ使用量[MB] /procがない環境では最大使用量を返す"""
+    statm = Path('/proc/self/statm')
+    if statm.exists():
+        pages = int(statm.read_text().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
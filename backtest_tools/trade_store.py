@@ -0,0 +1,252 @@
+"""トレード履歴を索引付きで保持するクラスを提供する"""
+
+from __future__ import annotations
+
+import pickle
+from pathlib import Path
+from datetime import date
+
+import pandas as pd
+import numpy as np
+
+
+class TradeStore:
+    """トレード履歴を索引付きで保持し、部分集合の取り出しと集計を行う
+
+    コード番号(name)、戦略(Strategy)、エントリー日時(EntryTime)で
+    ソート済みのMultiIndexを張ったトレード履歴を保持する。
+    取り出しはインデックスの二分探索で行うため、全件をマスクする必要がない。
+    CodeListの属性(業種区分など)や相場のレジームを結合すると、
+    それらを条件にした取り出しやグループ集計ができる。
+
+    Args:
+        trades: 初期に追加するトレード履歴
+
+    Attributes:
+        index_names(list[str]): トレード履歴のインデックスにする列名
+        attributes(pd.DataFrame): コード番号をインデックスにした銘柄の属性
+
+    """
+
+    index_names = ['name', 'Strategy', 'EntryTime']
+
+    def __init__(self, trades: pd.DataFrame | None = None) -> None:
+        self._pending = []
+        self._trades = None
+        self._positions = {}
+        self.attributes = None
+        if trades is not None:
+            self.add(trades)
+
+    def add(
+            self,
+            trades: pd.DataFrame,
+            name: str | None = None,
+            strategy: str | None = None,
+            ) -> None:
+        """トレード履歴を追加する
+
+        追加したトレード履歴は次に参照されるときにまとめて索引付けされる
+
+        Args:
+            trades: トレード履歴(stats._tradesやbacktest_for_multiple_dataの結果を想定)
+            name: コード番号 トレード履歴にname列がない場合に指定する
+            strategy: 戦略名 トレード履歴にStrategy列がない場合に指定する
+
+        """
+        trades = trades.copy()
+        if name is not None:
+            trades['name'] = name
+        if strategy is not None:
+            trades['Strategy'] = strategy
+        for col in ('name', 'Strategy'):
+            if col not in trades.columns:
+                trades[col] = ''
+        trades['name'] = trades['name'].astype(str)
+        trades['Strategy'] = trades['Strategy'].astype(str)
+        self._pending.append(trades)
+
+    @property
+    def trades(self) -> pd.DataFrame:
+        """索引付けされたすべてのトレード履歴"""
+        if self._pending:
+            frames = [] if self._trades is None else [self._trades.reset_index()]
+            df = pd.concat(frames + self._pending, ignore_index=True)
+            self._pending = []
+            self._trades = df.set_index(self.index_names).sort_index()
+            self._positions = {}
+        if self._trades is None:
+            return pd.DataFrame({})
+        return self._trades
+
+    def join_code_list(
+            self,
+            code_list: pd.DataFrame,
+            columns: list[str] | None = None,
+            ) -> None:
+        """CodeListの属性を結合する
+
+        Args:
+            code_list: CodeList.readで得られる株式リスト
+            columns: 結合する属性の列名 Noneのときはコード以外のすべての列
+
+        """
+        attributes = code_list.set_index('コード')
+        if columns is not None:
+            attributes = attributes[columns]
+        attributes.index = attributes.index.astype(str)
+        self.attributes = attributes
+
+    def set_regime(self, regime: pd.Series, column: str = 'regime') -> None:
+        """エントリー時点の相場のレジームを列として追加する
+
+        Args:
+            regime: 日付インデックスにレジーム名を値としてもつSeries
+            column: 追加する列名
+
+        """
+        trades = self.trades
+        entry = trades.index.get_level_values('EntryTime')
+        regime = regime.sort_index()
+        pos = regime.index.searchsorted(entry, side='right') - 1
+        labels = regime.to_numpy()[np.clip(pos, 0, None)]
+        trades[column] = np.where(pos >= 0, labels, None)
+        self._positions.pop(column, None)
+
+    def select(
+            self,
+            codes: str | list[str] | None = None,
+            strategies: str | list[str] | None = None,
+            start: date | None = None,
+            end: date | None = None,
+            attrs: dict | None = None,
+            regime: str | None = None,
+            regime_column: str = 'regime',
+            ) -> pd.DataFrame:
+        """条件に合うトレード履歴を取り出す
+
+        Args:
+            codes: コード番号
+            strategies: 戦略名
+            start: エントリー日時の開始(この日を含む)
+            end: エントリー日時の終了(この日を含まない)
+            attrs: 銘柄の属性による条件 {'33業種区分': '輸送用機器'} のように指定する
+            regime: レジーム名
+            regime_column: レジームを格納している列名
+
+        Returns:
+            条件に合うトレード履歴 インデックスは列に戻している
+
+        """
+        trades = self.trades
+        if trades.empty:
+            return trades
+
+        if attrs:
+            if self.attributes is None:
+                raise ValueError('join_code_listで属性を結合していない')
+            mask = np.ones(len(self.attributes), dtype=bool)
+            for k, v in attrs.items():
+                mask &= self.attributes[k].isin(_as_list(v)).to_numpy()
+            attr_codes = self.attributes.index[mask]
+            codes = (attr_codes.tolist() if codes is None
+                     else [c for c in _as_list(codes) if c in set(attr_codes)])
+
+        period = slice(
+                None if start is None else pd.Timestamp(start),
+                None if end is None else pd.Timestamp(end) - pd.Timedelta(1, 'ns'),
+                )
+        keys = [
+                slice(None) if codes is None else _as_list(codes),
+                slice(None) if strategies is None else _as_list(strategies),
+                period,
+                ]
+        # 存在しないキーはget_locsがKeyErrorを出すので先に除いておく
+        for i, key in enumerate(keys[:2]):
+            if isinstance(key, list):
+                level = trades.index.levels[i]
+                keys[i] = [str(k) for k in key if str(k) in level]
+                if not keys[i]:
+                    return trades.iloc[:0].reset_index()
+        pos = trades.index.get_locs(keys)
+
+        if regime is not None:
+            pos = np.intersect1d(
+                    pos, self._group_positions(regime_column).get(regime, []))
+
+        return trades.iloc[pos].reset_index()
+
+    def summary(self, by: str | list[str] = 'name') -> pd.DataFrame:
+        """グループごとの勝率、平均リターン、平均保有期間を集計する
+
+        Args:
+            by: グループにする列名 インデックスの列、トレード履歴の列、
+                結合した属性の列、エントリー年(EntryYear)が使える
+
+        Returns:
+            グループごとの集計結果
+
+        """
+        trades = self.trades.reset_index()
+        keys = []
+        for key in _as_list(by):
+            if key == 'EntryYear':
+                keys.append(trades['EntryTime'].dt.year.rename(key))
+            elif key in trades.columns:
+                keys.append(trades[key])
+            elif self.attributes is not None and key in self.attributes.columns:
+                keys.append(trades['name'].map(self.attributes[key]).rename(key))
+            else:
+                raise KeyError(key)
+
+        grouped = trades.assign(
+                Win=trades['PnL'] > 0,
+                ReturnPct=trades['ReturnPct'] * 100,
+                ).groupby(keys)
+        result = pd.DataFrame({
+            '# Trades': grouped['ReturnPct'].size(),
+            'Win Rate [%]': grouped['Win'].mean() * 100,
+            'Avg. Trade [%]': grouped['ReturnPct'].mean(),
+            'Avg. Trade Duration': grouped['Duration'].mean(),
+            })
+        return result
+
+    def _group_positions(self, column: str) -> dict:
+        if column not in self._positions:
+            self._positions[column] = self.trades.groupby(
+                    column, sort=False).indices
+        return self._positions[column]
+
+    def save(self, path: Path) -> None:
+        """トレード履歴と属性をファイルに保存する
+
+        Args:
+            path: 保存先のパス
+
+        """
+        with Path(path).open('wb') as p:
+            pickle.dump((self.trades, self.attributes), p)
+
+    @classmethod
+    def load(cls, path: Path) -> TradeStore:
+        """saveで保存したファイルから読み込む
+
+        Args:
+            path: 保存したファイルのパス
+
+        Returns:
+            読み込んだTradeStore
+
+        """
+        with Path(path).open('rb') as p:
+            trades, attributes = pickle.load(p)
+        store = cls()
+        store._trades = trades
+        store.attributes = attributes
+        return store
+
+
+def _as_list(x) -> list:
+    if isinstance(x, (list, tuple, set, pd.Index, np.ndarray, pd.Series)):
+        return list(x)
+    return [x]
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import pandas as pd
+import numpy as np
 from itertools import product, repeat
 from typing import Sequence
 
@@ -55,3 +56,80 @@ def make_optimize_grid(optimize_params: dict) -> list[dict]:
             if constraint(params)]
 
     return param_combos
+
+
+def select_params(
+        heatmap: pd.DataFrame,
+        maximize: str = 'SQN',
+        rule: str = 'best',
+        size: int = 1,
+        by: list[str] | None = None,
+        ) -> pd.DataFrame:
+    """保存した最適化の評価値から、期間ごとにパラメータを選び直す
+
+    バックテストをやり直さずに、最大化する項目や選び方を変えられる
+
+    Args:
+        heatmap: out_of_sampleやwalkforwardでreturn_heatmap=Trueとしたときの評価値
+        maximize: 最大化する評価値の列名
+        rule: 'best'は評価値が最大のパラメータ、
+            'plateau'は前後size個のパラメータとの評価値の平均が最大のパラメータを選ぶ
+            plateauは評価値が周りのパラメータでも安定している(過剰最適化でない)ものを選ぶ
+        size: plateauで平均する範囲 各パラメータの格子で前後いくつまでか
+        by: 期間を表すインデックスの名前 省略するとnameとwindowのうちheatmapにあるもの
+
+    Returns:
+        期間ごとに選んだパラメータと、そのパラメータの評価値
+
+    """
+    if by is None:
+        by = [n for n in ('name', 'window') if n in heatmap.index.names]
+    params = [n for n in heatmap.index.names if n not in by]
+    values = heatmap[maximize].astype(float)
+
+    if rule == 'best':
+        chosen = values.dropna().groupby(level=by).idxmax() if by else [values.idxmax()]
+        chosen = list(chosen)
+    elif rule == 'plateau':
+        groups = values.groupby(level=by) if by else [(None, values)]
+        chosen = [_plateau_idxmax(group, params, size) for _, group in groups]
+    else:
+        raise ValueError(f'rule must be best or plateau: {rule}')
+
+    index = pd.MultiIndex.from_tuples(chosen, names=heatmap.index.names)
+    selected = heatmap.loc[index, [maximize]].reset_index(params)
+    return selected
+
+
+def _plateau_idxmax(values: pd.Series, params: list[str], size: int) -> tuple:
+    """パラメータの格子上で前後size個の平均が最大になるインデックスを返す"""
+    levels = [np.unique(values.index.get_level_values(p)) for p in params]
+    pos = tuple(
+            np.searchsorted(level, values.index.get_level_values(p))
+            for level, p in zip(levels, params))
+    grid = np.full([len(level) for level in levels], np.nan)
+    grid[pos] = values.to_numpy()
+
+    # constraintで除いた格子やNaNは平均に含めない
+    valid = np.isfinite(grid)
+    total = np.where(valid, grid, 0.)
+    count = valid.astype(float)
+    for axis in range(grid.ndim):
+        total = _box_sum(total, axis, size)
+        count = _box_sum(count, axis, size)
+    smooth = np.full(grid.shape, -np.inf)
+    smooth[valid] = total[valid] / count[valid]
+
+    best = np.unravel_index(np.argmax(smooth), grid.shape)
+    flat = np.flatnonzero(
+            np.all([p == b for p, b in zip(pos, best)], axis=0))
+    return values.index[flat[0]]
+
+
+def _box_sum(a: np.ndarray, axis: int, size: int) -> np.ndarray:
+    """axisの方向に前後size個の和をとる 端は範囲内の分だけ足す"""
+    a = np.moveaxis(a, axis, -1)
+    pad = [(0, 0)] * (a.ndim - 1) + [(size + 1, size)]
+    c = np.cumsum(np.pad(a, pad), axis=-1)
+    out = c[..., 2 * size + 1:] - c[..., :-2 * size - 1]
+    return np.moveaxis(out, -1, axis)
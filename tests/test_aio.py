@@ -0,0 +1,96 @@
+import os
+import time
+import asyncio
+from contextlib import aclosing
+
+import pytest
+from backtesting.test import GOOG
+
+from backtest_tools import aio
+from backtest_tools.backtest import backtest_for_multiple_data
+
+
+def test_backtest_for_multiple_data(get_strategy):
+    data_name_tpl_lst = [(GOOG, code) for code in range(6)]
+
+    async def collect():
+        return [e async for e in aio.backtest_for_multiple_data(data_name_tpl_lst, get_strategy)]
+
+    events = asyncio.run(collect())
+    assert sorted(e.name for e in events) == list(range(6))
+    assert [e.done for e in events] == list(range(1, 7))
+    assert all(e.total == 6 for e in events)
+    expected = backtest_for_multiple_data(data_name_tpl_lst, get_strategy)
+    assert sum(len(e.trades) for e in events) == len(expected)
+
+
+def test_walkforward(get_strategy):
+    optimize_params = {'n1': range(5, 16, 5), 'n2': range(20, 41, 10)}
+
+    async def collect():
+        return [e async for e in aio.walkforward(
+            GOOG, get_strategy, 3, 1, optimize_params, name='GOOG')]
+
+    events = asyncio.run(collect())
+    assert sorted(e.window for e in events) == list(range(len(events)))
+    assert all(e.result['name'] == 'GOOG' for e in events)
+    assert all((e.trades['window'] == e.window).all() for e in events)
+
+
+def _counting_strategy(strategy, marker_dir):
+    # ワーカーで始まった単位の数を、マーカーファイルの数で数える
+    def init(self):
+        (marker_dir / f'{os.getpid()}_{time.perf_counter_ns()}').touch()
+        strategy.init(self)
+    return type('Counting' + strategy.__name__, (strategy,), {'init': init})
+
+
+def test_cancel(get_strategy, tmp_path):
+    data_name_tpl_lst = [(GOOG, code) for code in range(50)]
+
+    async def first_event(marker_dir):
+        strategy = _counting_strategy(get_strategy, marker_dir)
+        async with aclosing(aio.backtest_for_multiple_data(
+                data_name_tpl_lst, strategy, max_workers=1, max_in_flight=2)) as events:
+            async for event in events:
+                return event
+
+    (tmp_path / 'aclose').mkdir()
+    event = asyncio.run(first_event(tmp_path / 'aclose'))
+    assert event.done == 1 and event.total == 50
+
+    async def consume_all(marker_dir):
+        strategy = _counting_strategy(get_strategy, marker_dir)
+        # すべての単位を投入しておき、取り消されなければすべて始まるようにする
+        async for _ in aio.backtest_for_multiple_data(
+                data_name_tpl_lst, strategy, max_workers=1,
+                max_in_flight=len(data_name_tpl_lst)):
+            pass
+
+    async def cancelled(marker_dir):
+        task = asyncio.create_task(consume_all(marker_dir))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    (tmp_path / 'cancel').mkdir()
+    asyncio.run(cancelled(tmp_path / 'cancel'))
+
+    # ワーカーが新しい単位を始めなくなるのを待ってから、始まらなかった単位が残っていることを確かめる
+    for marker_dir in ('aclose', 'cancel'):
+        started = _wait_stable(tmp_path / marker_dir)
+        print(marker_dir, started)
+        assert 0 < started < len(data_name_tpl_lst)
+
+
+def _wait_stable(marker_dir, interval=0.5, timeout=10):
+    count = -1
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        new_count = len(list(marker_dir.iterdir()))
+        if new_count == count:
+            break
+        count = new_count
+        time.sleep(interval)
+    return count
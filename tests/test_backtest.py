@@ -1,10 +1,15 @@
 from datetime import date
 
+import pytest
+from backtesting import Backtest, Strategy
 from backtesting.test import GOOG
 
 from backtest_tools.backtest import out_of_sample
+from backtest_tools.backtest import _optimize_grid
 from backtest_tools.backtest import walkforward
 from backtest_tools.backtest import backtest_for_multiple_data
+from backtest_tools.backtest import walkforward_for_multiple_data
+from backtest_tools.utils import select_params
 
 
 def test_out_of_sample(get_strategy):
@@ -50,3 +55,103 @@ def test_backtest_for_multiple_data(get_strategy):
     TestStrategy = get_strategy
     results = backtest_for_multiple_data(data_name_tpl_lst, TestStrategy)
     print(results)
+
+
+def test_backtest_for_multiple_data_to_parquet(get_strategy, tmp_path):
+    data_name_tpl_lst = [(GOOG, code) for code in range(20)]
+    TestStrategy = get_strategy
+    expected = backtest_for_multiple_data(data_name_tpl_lst, TestStrategy)
+    result_set = backtest_for_multiple_data(
+            data_name_tpl_lst, TestStrategy, output_dir=tmp_path, max_in_flight=2)
+
+    assert result_set.strategies == [TestStrategy.__name__]
+    assert len(result_set) == len(expected)
+    trades = result_set.read()
+    assert (trades['Strategy'] == TestStrategy.__name__).all()
+    assert trades['PnL'].sum() == pytest.approx(expected['PnL'].sum())
+    assert set(result_set.read(names=[3])['name']) == {'3'}
+    assert sum(len(part) for part in result_set) == len(expected)
+
+    # 同じ戦略で書き出し直すと前回の結果は残らない
+    backtest_for_multiple_data(data_name_tpl_lst[:5], TestStrategy, output_dir=tmp_path)
+    assert len(result_set) == len(expected) // 4
+
+
+def test_walkforward_for_multiple_data(get_strategy):
+    TestStrategy = get_strategy
+    optimize_params = {
+        'n1': range(5, 16, 5),
+        'n2': range(10, 31, 5),
+        'maximize': 'SQN',
+        'constraint': lambda param: param.n1 < param.n2,
+    }
+    data_name_tpl_lst = [(GOOG, 'GOOG'), (GOOG.iloc[300:], 'GOOG_late')]
+    results, trades = walkforward_for_multiple_data(
+            data_name_tpl_lst, TestStrategy, 3, 1, optimize_params)
+    print(results)
+
+    expected, expected_trades = walkforward(GOOG, TestStrategy, 3, 1, optimize_params)
+    goog = results.query('name == "GOOG"')
+    assert goog['window'].tolist() == list(range(len(expected)))
+    assert goog['開始日'].tolist() == expected['開始日'].tolist()[::-1]
+    assert goog['n1'].tolist() == expected['n1'].tolist()[::-1]
+    assert len(trades.query('name == "GOOG"')) == len(expected_trades)
+
+
+def test_walkforward_heatmap(get_strategy):
+    TestStrategy = get_strategy
+    optimize_params = {
+        'n1': range(5, 16, 5),
+        'n2': range(10, 31, 5),
+        'maximize': 'SQN',
+        'constraint': lambda param: param.n1 < param.n2,
+    }
+    results, trades, heatmap = walkforward(
+            GOOG, TestStrategy, 3, 1, optimize_params, return_heatmap=True)
+    print(heatmap)
+    assert heatmap.index.names == ['window', 'n1', 'n2']
+    assert len(heatmap) == len(results) * 12
+
+    best = select_params(heatmap, 'SQN', rule='best')
+    assert best['n1'].tolist() == results['n1'].tolist()
+    assert best['n2'].tolist() == results['n2'].tolist()
+    assert len(select_params(heatmap, 'Return [%]', rule='plateau')) == len(results)
+
+
+class BuyOnce(Strategy):
+    trade = 1
+    eps = 0
+
+    def init(self):
+        pass
+
+    def next(self):
+        if self.trade and not self.position:
+            self.buy()
+
+
+def test_optimize_grid_no_trades():
+    # 2008年はGOOGが下がったので、トレードしないパラメータのリターン0%が最大になってしまう
+    df = GOOG.loc['2008-01-01':'2009-06-30']
+    bt = Backtest(df, BuyOnce)
+    optimize_params = {'trade': [0, 1], 'maximize': 'Return [%]'}
+
+    expected = bt.optimize(**optimize_params)
+    stats, heatmap = _optimize_grid(bt, optimize_params, ('# Trades',))
+    assert expected._strategy.trade == 1
+    assert stats._strategy.trade == expected._strategy.trade
+    assert heatmap['Return [%]'].isna().tolist() == [True, False]
+
+
+def test_optimize_grid_float32_tie():
+    # float32では同じ値になる評価値でも、Backtest.optimizeと同じパラメータを選ぶ
+    bt = Backtest(GOOG.iloc[:200], BuyOnce)
+    optimize_params = {
+        'eps': [0, 1],
+        'maximize': lambda stats: 1 + stats._strategy.eps * 1e-9,
+    }
+
+    expected = bt.optimize(**optimize_params)
+    stats, heatmap = _optimize_grid(bt, optimize_params)
+    assert heatmap['Maximize'].nunique() == 1
+    assert stats._strategy.eps == expected._strategy.eps == 1
@@ -0,0 +1,77 @@
+import os
+import re
+import json
+import time
+import base64
+
+import numpy as np
+from backtesting.test import GOOG
+from bokeh.models import ColumnDataSource
+from bokeh.plotting import figure
+
+from backtest_tools.compact_html import save_compact
+from backtest_tools.plottings import StackCharts
+
+
+def _make_charts():
+    charts = StackCharts()
+    for _ in range(5):
+        charts.add(GOOG, title='GOOG')
+    return charts
+
+
+def _parse_time(text: str) -> float:
+    """ブラウザでの読み込みの代わりに、jsonの解析とbase64の配列の復元にかかる時間を測る"""
+    def decode(obj):
+        if isinstance(obj, dict):
+            if '__ndarray__' in obj:
+                base64.b64decode(obj['__ndarray__'])
+                return
+            for value in obj.values():
+                decode(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                decode(value)
+
+    times = []
+    for _ in range(10):
+        start = time.perf_counter()
+        decode(json.loads(text))
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_save_compact():
+    _make_charts().save('tests/outputs/stack_full.html')
+    _make_charts().save('tests/outputs/compact/stack.html', compact=True)
+
+    full = os.path.getsize('tests/outputs/stack_full.html')
+    compact = (os.path.getsize('tests/outputs/compact/stack.html')
+               + os.path.getsize('tests/outputs/compact/stack.data.js'))
+    print(full, compact)
+    assert compact < full
+
+    with open('tests/outputs/stack_full.html', encoding='utf-8') as f:
+        full_doc = re.search(
+                r'<script type="application/json" id="[^"]*">\s*(.*?)\s*</script>',
+                f.read(), re.S).group(1)
+    with open('tests/outputs/compact/stack.data.js', encoding='utf-8') as f:
+        compact_doc = f.read().removeprefix('var BACKTEST_TOOLS_ITEM = ').rstrip().rstrip(';')
+    full_time, compact_time = _parse_time(full_doc), _parse_time(compact_doc)
+    print(full_time, compact_time)
+    assert compact_time < full_time
+    assert os.path.exists('tests/outputs/compact/static/js/bokeh.min.js')
+
+
+def test_save_compact_keeps_data(tmp_path):
+    fig = figure()
+    fig.line('x', 'y', source=ColumnDataSource({'x': np.arange(10.), 'y': np.arange(10.)}))
+    save_compact(fig, tmp_path / 'fig.html')
+    source, = fig.select({'type': ColumnDataSource})
+    assert source.data['x'].dtype == np.float64
+
+    # 古いBokehJSが残っていれば、中身を比べてコピーし直す
+    bokeh_js = tmp_path / 'static/js/bokeh.min.js'
+    bokeh_js.write_text('old')
+    save_compact(fig, tmp_path / 'fig.html')
+    assert bokeh_js.stat().st_size > 1000
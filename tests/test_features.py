@@ -0,0 +1,50 @@
+import numpy as np
+import talib
+from backtesting import Backtest, Strategy
+from backtesting.lib import crossover
+from backtesting.test import GOOG
+
+from backtest_tools.features import compute_features, attach_features
+from backtest_tools.portfolio import make_price_panel
+
+
+class FeatureEmaCross(Strategy):
+    def init(self):
+        self.ema1 = self.I(lambda: self.data.EMA_15)
+        self.ema2 = self.I(lambda: self.data.EMA_50)
+
+    def next(self):
+        if crossover(self.ema1, self.ema2):
+            self.position.close()
+            self.buy()
+
+        elif crossover(self.ema2, self.ema1):
+            self.position.close()
+            self.sell()
+
+
+def test_compute_features():
+    # 途中で取引のない期間がある銘柄も、その銘柄の足だけでTA-Libと同じ値になる
+    gap = GOOG.iloc[300:].drop(GOOG.index[500:520])
+    panel = make_price_panel([(GOOG, 'GOOG'), (gap, 'GAP')])
+    features = compute_features(panel, {
+        'EMA_20': ('EMA', 20), 'RSI_14': ('RSI', 14), 'ATR_14': ('ATR', 14)})
+
+    high, low, close = (gap[c].astype(float) for c in ('High', 'Low', 'Close'))
+    expected = {
+        'EMA_20': talib.EMA(close, 20),
+        'RSI_14': talib.RSI(close, 14),
+        'ATR_14': talib.ATR(high, low, close, 14),
+    }
+    for key, values in expected.items():
+        np.testing.assert_allclose(
+                features[key]['GAP'].reindex(gap.index), values, rtol=1e-9)
+
+
+def test_attach_features(sample_stats):
+    panel = make_price_panel([(GOOG, 'GOOG')])
+    features = compute_features(panel, {'EMA_15': ('EMA', 15), 'EMA_50': ('EMA', 50)})
+    (data, _), = attach_features([(GOOG, 'GOOG')], features)
+    stats = Backtest(data, FeatureEmaCross).run()
+    assert stats['# Trades'] == sample_stats['# Trades']
+    assert np.isclose(stats['Return [%]'], sample_stats['Return [%]'])
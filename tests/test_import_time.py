@@ -0,0 +1,35 @@
+import re
+import subprocess
+import sys
+
+import pytest
+
+# pandasの読み込みだけで0.3秒ほどかかるので、それに余裕をもたせた上限にしている
+IMPORT_BUDGET_US = 1_500_000
+HEAVY_MODULES = ['bokeh', 'backtesting', 'jinja2', 'tqdm']
+
+
+def _import_time(module: str) -> dict[str, int]:
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, text=True, check=True,
+            )
+    times = {}
+    for line in result.stderr.splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \|(\s+)(\S+)$', line)
+        if m:
+            times[m.group(3)] = int(m.group(1))
+    return times
+
+
+@pytest.mark.parametrize('module', [
+    'backtest_tools.backtest',
+    'backtest_tools.read_zip_data',
+    'backtest_tools.montecarlo',
+    'backtest_tools.plottings',
+    ])
+def test_import_time(module):
+    times = _import_time(module)
+    print(module, times[module])
+    assert not [m for m in times if m.split('.')[0] in HEAVY_MODULES]
+    assert times[module] < IMPORT_BUDGET_US
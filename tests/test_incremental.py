@@ -0,0 +1,68 @@
+from backtesting import Backtest, Strategy
+from backtesting.test import GOOG
+
+from backtest_tools.incremental import IncrementalBacktest
+from backtest_tools.utils import cut_not_closed_trades
+
+
+def test_incremental_update(get_strategy, tmp_path):
+    inc = IncrementalBacktest(get_strategy, tmp_path)
+    inc.update([(GOOG.iloc[:-100], 'GOOG')])
+    assert inc.last_update == {'GOOG': 'full'}
+
+    trades = inc.update([(GOOG, 'GOOG')])
+    assert inc.last_update == {'GOOG': 'incremental'}
+    expected = cut_not_closed_trades(Backtest(GOOG, get_strategy).run())
+    print(trades.tail(), expected.tail())
+    assert trades['EntryTime'].tolist() == expected['EntryTime'].tolist()
+    assert trades['ExitBar'].tolist() == expected['ExitBar'].tolist()
+    assert (trades['ReturnPct'] - expected['ReturnPct'].to_numpy()).abs().max() < 1e-9
+
+    inc.update([(GOOG, 'GOOG')])
+    assert inc.last_update == {'GOOG': 'unchanged'}
+
+    # 過去の足が調整された(株式分割など)ときは全期間でやり直す
+    revised = GOOG.copy()
+    revised.iloc[:1000, :4] /= 2
+    inc.update([(revised, 'GOOG')])
+    assert inc.last_update == {'GOOG': 'full'}
+
+
+def test_incremental_strategy_changed(get_strategy, tmp_path):
+    IncrementalBacktest(get_strategy, tmp_path).update([(GOOG, 'GOOG')])
+
+    # 名前もモジュールも同じで、クラス変数のパラメータだけを変えた戦略では保存済みの結果を使わない
+    Slow = type(get_strategy.__name__, (get_strategy,), {'n2': 60})
+    Slow.__qualname__ = get_strategy.__qualname__
+    Slow.__module__ = get_strategy.__module__
+    inc = IncrementalBacktest(Slow, tmp_path)
+    inc.update([(GOOG, 'GOOG')])
+    assert inc.last_update == {'GOOG': 'full'}
+
+
+class Pyramiding(Strategy):
+    """月曜日ごとに買い増し、3の倍数の月に建てたトレードだけ長く持つ"""
+
+    def init(self):
+        pass
+
+    def next(self):
+        for trade in self.trades:
+            hold = 40 if trade.entry_time.month % 3 == 0 else 3
+            if len(self.data) - 1 - trade.entry_bar >= hold:
+                trade.close()
+        if self.data.index[-1].weekday() == 0:
+            self.buy(size=1)
+
+
+def test_incremental_overlapping_trades(tmp_path):
+    # 建玉中のトレードより後にエントリーして決済したトレードを、二重に数えない
+    config = {'cash': 100_000, 'exclusive_orders': False}
+    inc = IncrementalBacktest(Pyramiding, tmp_path, warmup=10, backtest_config=config)
+    # 2012-06-26にエントリーしたトレードが建玉中で、その後のトレードが決済済みの時点で保存する
+    inc.update([(GOOG.iloc[:-128], 'GOOG')])
+    trades = inc.update([(GOOG, 'GOOG')])
+    assert inc.last_update == {'GOOG': 'incremental'}
+
+    expected = cut_not_closed_trades(Backtest(GOOG, Pyramiding, **config).run())
+    assert sorted(trades['EntryTime']) == sorted(expected['EntryTime'])
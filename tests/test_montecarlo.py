@@ -1,4 +1,7 @@
-from backtest_tools.montecarlo import Montecarlo
+import pandas as pd
+import pytest
+
+from backtest_tools.montecarlo import Montecarlo, GroupedMontecarlo
 
 
 def test_mont_report(sample_stats):
@@ -7,3 +10,107 @@ def test_mont_report(sample_stats):
     mont = Montecarlo(trades, 1_000_000., 800_000)
     mont.run(sim_times=2000)
     mont.make_report_graph('tests/outputs/mont.html')
+
+
+def test_mont_seed(sample_stats):
+    trades = sample_stats._trades
+
+    mont1 = Montecarlo(trades, 1_000_000., 800_000, seed=1)
+    mont1.run(sim_times=500)
+    mont2 = Montecarlo(trades, 1_000_000., 800_000, seed=1)
+    mont2.run(sim_times=500)
+    assert mont1.ret_list == mont2.ret_list
+    assert len(mont1.dd_list) == 500
+    assert all(-1 <= dd <= 0 for dd in mont1.dd_list)
+
+
+def test_mont_n_jobs(sample_stats):
+    trades = sample_stats._trades
+
+    mont1 = Montecarlo(trades, 1_000_000., 800_000)
+    mont1.run(sim_times=2500, n_jobs=1, chunk_size=1000)
+    mont2 = Montecarlo(trades, 1_000_000., 800_000)
+    mont2.run(sim_times=2500, n_jobs=3, chunk_size=1000)
+    assert mont1.ret_list == mont2.ret_list
+    assert mont1.ruin_list == mont2.ruin_list
+
+
+def test_mont_streaming(sample_stats):
+    trades = sample_stats._trades
+
+    mont = Montecarlo(trades, 1_000_000., 800_000)
+    mont.run(sim_times=20000, chunk_size=2000)
+    mont_stream = Montecarlo(trades, 1_000_000., 800_000)
+    mont_stream.run(sim_times=20000, chunk_size=2000, streaming=True)
+    assert mont_stream.ret_list is None
+    assert mont_stream.result.sim_times == 20000
+
+    summary = mont.summary()
+    summary_stream = mont_stream.summary()
+    print(summary_stream)
+    assert summary['Ruin Rate'] == summary_stream['Ruin Rate']
+    assert abs(summary['Return 50%'] - summary_stream['Return 50%']) < 0.01
+    assert abs(summary['Max. Drawdown 50%'] - summary_stream['Max. Drawdown 50%']) < 0.01
+    mont_stream.make_report_graph('tests/outputs/mont_stream.html')
+
+
+def test_mont_ci_targets(sample_stats):
+    trades = sample_stats._trades
+
+    mont = Montecarlo(trades, 1_000_000., 800_000)
+    mont.run(sim_times=1000, ci_targets={'Ruin Rate': 0.03}, max_sim_times=20000)
+    print(mont.convergence)
+    assert mont.convergence['Converged']
+    assert mont.convergence['Sim Times'] == len(mont.ret_list)
+    assert mont.convergence['Intervals'].loc['Ruin Rate', 'width'] <= 0.03
+
+    mont = Montecarlo(trades, 1_000_000., 800_000)
+    mont.run(sim_times=1000, ci_targets={'Return 50%': 1e-6}, max_sim_times=3000)
+    assert not mont.convergence['Converged']
+    assert mont.convergence['Sim Times'] == 3000
+
+    # 項目名の間違いは無視せずにエラーにする
+    with pytest.raises(KeyError):
+        mont.run(sim_times=1000, ci_targets={'Ruin rate': 0.03})
+
+
+def test_mont_horizons(sample_stats):
+    trades = sample_stats._trades
+
+    mont = Montecarlo(trades, 1_000_000., 800_000)
+    mont.run(sim_times=2000, horizons=[1, 3, 5])
+    summary = mont.summary()
+    print(summary)
+    assert list(summary.index) == [1, 3, 5]
+    # 期間が長いほど最大ドロップダウンは深く、破産は増える
+    assert (summary['Max. Drawdown 50%'].diff().dropna() <= 0).all()
+    assert (summary['Ruin Rate'].diff().dropna() >= 0).all()
+    mont.make_report_graph('tests/outputs/mont_horizons.html')
+
+
+def test_grouped_mont(sample_stats):
+    trades = sample_stats._trades
+    trades = pd.concat([trades.assign(Strategy='A'), trades.assign(Strategy='B')])
+
+    mont = GroupedMontecarlo(trades, 'Strategy', 1_000_000., 800_000)
+    mont.run(sim_times=2000, horizons=[1, 3])
+    summary = mont.summary()
+    print(summary)
+    assert len(summary) == 4
+    # 同じトレード履歴のグループは同じ乱数を使うので1年の結果は一致する
+    one_year = summary.query('Horizon == 1').set_index('Strategy')
+    assert one_year.loc['A'].equals(one_year.loc['B'])
+    mont.make_report_graph('tests/outputs/mont_grouped.html')
+
+
+def test_grouped_mont_long_horizon(sample_stats):
+    trades = sample_stats._trades
+    # 保有期間の違うグループCがあっても、AとBはすべての期間で同じ乱数を使う
+    trades = pd.concat([
+        trades.assign(Strategy='A'), trades.assign(Strategy='B'),
+        trades.iloc[::2].assign(Strategy='C')])
+
+    mont = GroupedMontecarlo(trades, 'Strategy', 1_000_000., 800_000)
+    mont.run(sim_times=2000, horizons=[1, 5])
+    summary = mont.summary().set_index(['Strategy', 'Horizon'])
+    assert summary.loc['A'].equals(summary.loc['B'])
@@ -0,0 +1,72 @@
+import sys
+import json
+import pickle
+
+from backtesting.test import GOOG
+
+from backtest_tools.cli import main
+from backtest_tools.pipeline import Pipeline, load_config
+
+
+def test_pipeline(tmp_path):
+    cache = tmp_path / 'data.pkl'
+    with cache.open('wb') as p:
+        pickle.dump([(GOOG, 'GOOG'), (GOOG.iloc[:1000], 'GOOG_head')], p)
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({
+        'strategy': 'conftest:EmaCross',
+        'universe': {'cache': 'data.pkl'},
+        'walkforward': {'in_period': 2, 'out_period': 1,
+                        'optimize_params': {'n1': [10, 20], 'n2': [40, 60]}},
+        'montecarlo': {'init_assets': 1_000_000, 'ruin_point': 800_000, 'sim_times': 500},
+        'outputs': {'dir': 'outputs', 'charts': True},
+        }))
+
+    assert main([str(config_file)]) == 0
+    assert (tmp_path / 'outputs/report.html').exists()
+
+    pipeline = Pipeline(load_config(config_file))
+    pipeline.run()
+    print(pipeline.timing_table())
+    # 価格データはキャッシュに複製せず、毎回読み込む
+    assert pipeline.cached == {
+            'universe': False, 'backtest': True, 'montecarlo': True, 'report': True}
+    assert sorted(p.name for p in (tmp_path / '.pipeline_cache').iterdir()) == [
+            'backtest.pkl', 'montecarlo.pkl', 'report.pkl']
+
+    # モンテカルロテストの設定だけ変えると、それより前の段階はキャッシュを使う
+    config = load_config(config_file)
+    config['montecarlo']['sim_times'] = 600
+    pipeline = Pipeline(config)
+    pipeline.run()
+    assert pipeline.cached == {
+            'universe': False, 'backtest': True, 'montecarlo': False, 'report': False}
+
+    # 価格データが変わると、それを使う段階はやり直す
+    with cache.open('wb') as p:
+        pickle.dump([(GOOG, 'GOOG'), (GOOG.iloc[:1200], 'GOOG_head')], p)
+    pipeline = Pipeline(load_config(config_file))
+    pipeline.run()
+    assert not any(pipeline.cached.values())
+
+
+def test_cli_strategy_next_to_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    (tmp_path / 'pipeline_strategies.py').write_text(
+            'from conftest import EmaCross\n\n\nclass MyEmaCross(EmaCross):\n    pass\n')
+    cache = tmp_path / 'data.pkl'
+    with cache.open('wb') as p:
+        pickle.dump([(GOOG.iloc[:1000], 'GOOG_head')], p)
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({
+        'strategy': 'pipeline_strategies:MyEmaCross',
+        'universe': {'cache': 'data.pkl'},
+        'walkforward': {'in_period': 2, 'out_period': 1,
+                        'optimize_params': {'n1': [10, 20], 'n2': [40, 60]}},
+        'montecarlo': {'init_assets': 1_000_000, 'ruin_point': 800_000, 'sim_times': 100},
+        'outputs': {'dir': 'outputs', 'charts': False},
+        }))
+
+    monkeypatch.chdir('/')
+    assert main([str(config_file)]) == 0
+    assert (tmp_path / 'outputs/montecarlo.html').exists()
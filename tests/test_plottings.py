@@ -1,3 +1,4 @@
+import numpy as np
 from backtesting.test import GOOG
 from datetime import date
 
@@ -46,3 +47,34 @@ def test_stack_charts(get_strategy):
             hatch_range=(date(2005, 6, 1), date(2007, 7, 1))
             )
     charts.save(filename='tests/outputs/stack.html')
+
+
+def test_stack_charts_decimate():
+    charts = StackCharts()
+    charts.add(GOOG, title='GOOG', hatch_range=(date(2006, 1, 1), date(2007, 1, 1)))
+    charts.add(GOOG, title='GOOG', max_bars=300)
+    assert len(charts.fig[1].renderers[0].data_source.data['index']) <= 300
+    charts.save(filename='tests/outputs/stack_goog.html')
+
+
+def test_result_plot_density(sample_stats):
+    trades = sample_stats._trades
+
+    plot = PlotTradeResults(title='test', bins=15, max_points=10, density_bins=20)
+    plot.add_record(trades.copy(), 'dense')
+    plot.add_record(trades.head(5).copy(), 'sparse')
+    plot.save('tests/outputs/scatter_density.html')
+
+
+def test_result_plot_hist(sample_stats):
+    trades = sample_stats._trades
+
+    plot = PlotTradeResults(title='test', bins=15)
+    plot.add_record(trades.head(20).copy(), 'a')
+    plot.add_record(trades.tail(30).copy(), 'b')
+    x, hist = plot._set_hist_source(plot.df_trades['ReturnPct'])
+    sr = plot.df_trades['ReturnPct']
+    for i, legend in enumerate(['a', 'b']):
+        expected, _ = np.histogram(
+                sr[plot.df_trades['legend'] == legend], bins=15, range=(sr.min(), sr.max()))
+        assert (hist[i] == expected).all()
@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+import pandas as pd
+from backtesting.test import GOOG
+
+from backtest_tools.portfolio import make_price_panel, portfolio_backtest
+
+
+def test_portfolio_buy_and_hold():
+    panel = make_price_panel([(GOOG, 'GOOG'), (GOOG.iloc[500:], 'GOOG_late')])
+    assert panel['Close'].shape == (len(GOOG), 2)
+
+    result, weights = portfolio_backtest(
+            panel, panel['Close'],
+            signal=lambda p: pd.DataFrame({'GOOG': True}, index=p['Close'].index),
+            top_n=1, cash=1_000, commission=0)
+    print(result.tail())
+    expected = 1_000 * GOOG.Close.iloc[-1] / GOOG.Close.iloc[0]
+    assert np.isclose(result['Equity'].iloc[-1], expected)
+    assert result['Turnover'].sum() == 1
+
+
+def test_portfolio_drift_between_rebalances():
+    index = pd.bdate_range('2020-01-01', periods=10)
+    close = pd.DataFrame({'A': 100 * 1.1 ** np.arange(10), 'B': 100.}, index=index)
+    panel = {'Close': close}
+    score = pd.DataFrame(1., index=index, columns=close.columns)
+
+    # 最初の日だけ等金額にすると、その後は買い持ちと同じになる
+    result, weights = portfolio_backtest(
+            panel, score, top_n=2, cash=1_000, commission=0, rebalance=10)
+    assert np.isclose(result['Equity'].iloc[-1], 500 * 1.1 ** 9 + 500)
+    assert weights.iloc[-1, 0] > 0.5 and result['Turnover'].iloc[1:].sum() == 0
+
+    # 等金額に戻す日は、値動きでずれた分も売買代金に含める
+    result, _ = portfolio_backtest(panel, score, top_n=2, cash=1_000, rebalance=2)
+    assert (result['Turnover'].iloc[2::2] > 0).all()
+    assert (result['Turnover'].iloc[1::2] == 0).all()
+
+
+def test_portfolio_universe_speed():
+    rng = np.random.default_rng(2022)
+    n_days, n_codes = 2500, 3000
+    index = pd.bdate_range('2010-01-01', periods=n_days)
+    close = 1000 * np.exp(np.cumsum(rng.normal(0, 0.02, (n_days, n_codes)), axis=0))
+    panel = {'Close': pd.DataFrame(close, index=index)}
+
+    start = time.perf_counter()
+    result, _ = portfolio_backtest(
+            panel, lambda p: p['Close'].pct_change(20), top_n=50, rebalance=5)
+    elapsed = time.perf_counter() - start
+    print(elapsed, result['Equity'].iloc[-1])
+    assert (result['# Positions'].iloc[25:] == 50).all()
+    assert elapsed < 10
@@ -1,6 +1,14 @@
+import time
+import zipfile
+from datetime import date
+
 import pytest
+from backtesting.test import GOOG
+
 from backtest_tools.read_zip_data import StockData, cache_all_data
 from backtest_tools.read_zip_data import read_cache_data, set_multiple_data_from_codes
+from backtest_tools.read_zip_data import read_data_from_codes
+from backtest_tools.read_zip_data import resample_ohlcv, cache_resampled_data, read_resampled_data
 from backtest_tools.code_list import CodeList
 
 
@@ -47,3 +55,67 @@ def test_read_cache_data():
 #         except FileNotFoundError as e:
 #             print(code, ' ', e)
 
+
+def test_resample_ohlcv():
+    weekly = resample_ohlcv(GOOG, 'W')
+    # 2005-03-25(金)は休場なので、その週は木曜日の日付になる
+    week = GOOG.loc['2005-03-21':'2005-03-25']
+    assert week.index[-1] in weekly.index
+    assert weekly.loc[week.index[-1]].tolist() == [
+            week.Open.iloc[0], week.High.max(), week.Low.min(),
+            week.Close.iloc[-1], week.Volume.sum()]
+    monthly = resample_ohlcv(GOOG, 'M')
+    assert monthly.index[0] == GOOG.loc['2004-08'].index[-1]
+
+
+def test_cache_resampled_data(tmp_path):
+    cache_file = tmp_path / 'weekly.pkl'
+    cache_resampled_data('W', [(GOOG.iloc[:-3], 'GOOG')], cache_file)
+    cache_resampled_data('W', [(GOOG, 'GOOG')], cache_file)
+    (weekly, name), = read_resampled_data('W', cache_file=cache_file)
+    assert weekly.equals(resample_ohlcv(GOOG, 'W'))
+
+    (part, _), = read_resampled_data(
+            'W', codes=['GOOG'], start=date(2010, 1, 1), end=date(2011, 1, 1),
+            cache_file=cache_file)
+    assert part.index.min().year == 2010 and part.index.max().year == 2010
+
+
+def _write_stooq_zip(path, codes, n_days=3000):
+    rows = GOOG.iloc[:n_days]
+    body = '\n'.join(
+            f'{{code}}.JP,D,{d:%Y%m%d},000000,{r.Open},{r.High},{r.Low},{r.Close},{r.Volume},0'
+            for d, r in zip(rows.index, rows.itertuples()))
+    header = '<TICKER>,<PER>,<DATE>,<TIME>,<OPEN>,<HIGH>,<LOW>,<CLOSE>,<VOL>,<OPENINT>\n'
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for code in codes:
+            zf.writestr(f'data/daily/jp/tse stocks/1/{code}.jp.txt',
+                        header + body.replace('{code}', code))
+
+
+def test_set_multiple_data_io_threads(tmp_path, monkeypatch):
+    codes = ['7203'] + [str(1000 + i) for i in range(300)]
+    zip_path = tmp_path / 'd_jp_txt.zip'
+    _write_stooq_zip(zip_path, codes)
+    monkeypatch.setattr(StockData, 'zip_dir', zip_path)
+
+    # 書き出した直後の1回目をコールド、2回目以降をウォームとして比べる
+    # (ページキャッシュを捨てる権限はないので、本当のコールドではない)
+    for label in ('cold', 'warm'):
+        for io_threads in (1, 4):
+            start = time.perf_counter()
+            data_name_tpl_lst = set_multiple_data_from_codes(codes + ['9999'], io_threads)
+            elapsed = time.perf_counter() - start
+            print(f'{label} io_threads={io_threads}: {len(codes) / elapsed:.0f} codes/sec')
+            assert [name for _, name in data_name_tpl_lst] == codes
+
+
+def test_read_data_from_codes(tmp_path, monkeypatch):
+    codes = ['7203', '1000', '1001', '1002', '1003']
+    zip_path = tmp_path / 'd_jp_txt.zip'
+    _write_stooq_zip(zip_path, codes, n_days=100)
+    monkeypatch.setattr(StockData, 'zip_dir', zip_path)
+
+    shards = [read_data_from_codes(codes, shard, 2) for shard in range(2)]
+    assert [name for _, name in shards[0]] == ['7203', '1001', '1003']
+    assert [name for _, name in shards[1]] == ['1000', '1002']
@@ -1,4 +1,18 @@
-from backtest_tools.report import make_report
+from backtesting.test import GOOG
+
+from backtest_tools.report import make_report, build_report
 
 def test_report():
     make_report()
+
+
+def test_build_report(sample_stats):
+    trades = sample_stats._trades.assign(name='GOOG')
+    data_lst = [(GOOG, 'GOOG'), (GOOG.iloc[:500], 'GOOG_head')]
+    charts_dir = 'tests/outputs/build_report/charts'
+    report_file = 'tests/outputs/build_report/report.html'
+
+    build_report(data_lst, trades, charts_dir, report_file)
+    assert build_report(data_lst, trades, charts_dir, report_file) == []
+    rebuilt = build_report(data_lst, trades.iloc[:-1], charts_dir, report_file)
+    assert rebuilt == ['GOOG']
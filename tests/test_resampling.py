@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from backtesting.test import GOOG
+
+from backtest_tools.resampling import TradeResampler
+
+
+def test_bootstrap(sample_stats):
+    trades = sample_stats._trades
+    half = len(trades) // 2
+    trades = trades.assign(legend=['a'] * half + ['b'] * (len(trades) - half))
+
+    result = TradeResampler(trades, by='legend').bootstrap(n_boot=500, chunk_size=200)
+    print(result)
+    assert list(result.index) == ['a', 'b']
+    for legend, group in trades.groupby('legend'):
+        row = result.loc[legend]
+        assert row['# Trades'] == len(group)
+        assert row['Win Rate [%]'] == (group['ReturnPct'] > 0).mean() * 100
+        assert np.isclose(row['Avg. Return [%]'], group['ReturnPct'].mean() * 100)
+        assert row['Avg. Return [%] Low'] <= row['Avg. Return [%]'] <= row['Avg. Return [%] High']
+        assert row['Win Rate [%] Low'] <= row['Win Rate [%]'] <= row['Win Rate [%] High']
+
+    # 同じseedなら分割の仕方によらず同じ乱数列を使う
+    again = TradeResampler(trades, by='legend').bootstrap(n_boot=500, chunk_size=500)
+    pd.testing.assert_frame_equal(result, again)
+
+
+def test_block_bootstrap(sample_stats):
+    trades = sample_stats._trades
+    resampler = TradeResampler(trades)
+    result = resampler.block_bootstrap(n_boot=300)
+    print(result)
+    assert result.loc['All', 'Return 5%'] <= result.loc['All', 'Return 95%']
+    assert (result.filter(like='Max. Drawdown') <= 0).all(axis=None)
+
+    # ブロックがトレード履歴全体なら、常に実際の資産曲線になる
+    whole = resampler.block_bootstrap(n_boot=10, block_size=len(trades))
+    actual = (1 + trades['ReturnPct']).prod() - 1
+    assert np.allclose(whole.filter(like='Return').to_numpy(), actual)
+
+    # グループの結果は、他のグループを加えても変わらない
+    half = len(trades) // 2
+    grouped = trades.assign(legend=['a'] * half + ['b'] * (len(trades) - half))
+    both = TradeResampler(grouped, by='legend').block_bootstrap(n_boot=300)
+    only_b = TradeResampler(grouped.iloc[half:], by='legend').block_bootstrap(n_boot=300)
+    pd.testing.assert_series_equal(both.loc['b'], only_b.loc['b'])
+
+
+def test_random_entry_test(sample_stats):
+    trades = sample_stats._trades
+    result = TradeResampler(trades).random_entry_test([(GOOG, 'GOOG')], n_perm=500)
+    print(result)
+
+    close = GOOG['Close']
+    expected = [
+        np.sign(t.Size) * (close[t.ExitTime] / close[t.EntryTime] - 1)
+        for t in trades.itertuples()]
+    assert np.isclose(result.loc['All', 'Avg. Return [%]'], np.mean(expected) * 100)
+    assert 0 < result.loc['All', 'p-value'] <= 1
+
+    named = TradeResampler(trades.assign(name='GOOG'), by='name')
+    assert list(named.random_entry_test([(GOOG, 'GOOG')], n_perm=500).index) == ['GOOG']
@@ -0,0 +1,35 @@
+from backtesting.test import GOOG
+
+from backtest_tools.backtest import backtest_for_multiple_data
+from backtest_tools.session import BacktestSession
+
+
+def _load_universe():
+    return [(GOOG, 'GOOG'), (GOOG.iloc[:1000], 'GOOG_head'), (GOOG.iloc[500:], 'GOOG_tail')]
+
+
+def _load_shard(shard=0, n_shards=1):
+    # 担当分だけを返していることを確かめるため、他の分割を読み込んだら失敗させる
+    shards = [u for i, u in enumerate(_load_universe()) if i % n_shards == shard]
+    assert n_shards == 2 and len(shards) <= 2
+    return shards
+
+
+def test_session(get_strategy):
+    expected = backtest_for_multiple_data(_load_universe(), get_strategy)
+
+    with BacktestSession(_load_shard, n_workers=2) as session:
+        trades = session.run(get_strategy)
+        assert len(trades) == len(expected)
+        assert set(trades['name']) == {'GOOG', 'GOOG_head', 'GOOG_tail'}
+
+        trades_20 = session.run(get_strategy, {'n1': 20})
+        assert not trades_20.equals(trades)
+
+
+def test_session_memory_ceiling(get_strategy):
+    with BacktestSession(_load_universe, n_workers=2, max_rss_mb=1) as session:
+        first = session.run(get_strategy)
+        second = session.run(get_strategy)
+        assert session.restarts == 4
+        assert len(first) == len(second)
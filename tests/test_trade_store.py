@@ -0,0 +1,43 @@
+from datetime import date
+
+import pandas as pd
+
+from backtest_tools.trade_store import TradeStore
+
+
+def test_trade_store_select(sample_stats):
+    trades = sample_stats._trades
+    store = TradeStore()
+    store.add(trades, name='7203', strategy='EmaCross')
+    store.add(trades, name='7201', strategy='EmaCross')
+
+    selected = store.select(codes='7203', start=date(2008, 1, 1), end=date(2010, 1, 1))
+    expected = trades[
+            (trades.EntryTime >= '2008-01-01') & (trades.EntryTime < '2010-01-01')]
+    assert len(selected) == len(expected)
+    assert (selected['name'] == '7203').all()
+    assert store.select(codes='hoge').empty
+
+
+def test_trade_store_attributes_and_summary(sample_stats, tmp_path):
+    trades = sample_stats._trades
+    store = TradeStore(trades.assign(name='7203'))
+    store.add(trades, name='7201')
+    store.join_code_list(pd.DataFrame({
+        'コード': ['7203', '7201'],
+        '33業種区分': ['輸送用機器', '輸送用機器'],
+        '規模区分': ['TOPIX Core30', 'TOPIX Large70'],
+        }))
+    assert len(store.select(attrs={'規模区分': 'TOPIX Core30'})) == len(trades)
+
+    regime = pd.Series(['bull', 'bear'], index=pd.to_datetime(['2004-01-01', '2008-01-01']))
+    store.set_regime(regime)
+    assert (store.select(regime='bear')['EntryTime'] >= '2008-01-01').all()
+
+    summary = store.summary(['規模区分', 'EntryYear'])
+    print(summary)
+    assert summary['# Trades'].sum() == 2 * len(trades)
+
+    store.save(tmp_path / 'trades.pkl')
+    loaded = TradeStore.load(tmp_path / 'trades.pkl')
+    assert len(loaded.trades) == 2 * len(trades)
@@ -1,5 +1,9 @@
+import numpy as np
+import pandas as pd
+
 from backtest_tools.utils import cut_not_closed_trades
 from backtest_tools.utils import make_optimize_grid
+from backtest_tools.utils import select_params
 
 
 def test_cut_not_closed_trades(sample_stats):
@@ -15,3 +19,18 @@ def test_make_optimize_grid():
     }
     params = make_optimize_grid(optimize_params)
     print(params)
+
+
+def test_select_params():
+    # n1, n2が1から3の範囲は全体に高いが、n1=4, n2=4の1点だけが突出している
+    index = pd.MultiIndex.from_product(
+            [[0], range(5), range(5)], names=['window', 'n1', 'n2'])
+    sqn = np.full((5, 5), 0.)
+    sqn[1:4, 1:4] = 1.
+    sqn[4, 4] = 2.
+    heatmap = pd.DataFrame({'SQN': sqn.ravel()}, index=index, dtype='float32')
+
+    best = select_params(heatmap, 'SQN', rule='best')
+    assert best[['n1', 'n2']].values.tolist() == [[4, 4]]
+    plateau = select_params(heatmap, 'SQN', rule='plateau')
+    assert plateau[['n1', 'n2']].values.tolist() == [[2, 2]]